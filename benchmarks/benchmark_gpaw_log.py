@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the parsing of GPAW text logs of increasing size.
+
+Compares the single-pass ``aiida_ase.parsers.gpaw_log.read_gpaw_log`` with the two calls of ``ase.io.read`` that were
+needed before to obtain the trajectory and the final frame. The logs are generated by repeating the ionic step of the
+``default_gpaw`` test fixture. Run with ``python benchmarks/benchmark_gpaw_log.py``.
+"""
+import io
+import pathlib
+import time
+import tracemalloc
+
+from ase.io import read
+
+from aiida_ase.parsers.gpaw_log import read_gpaw_log
+
+FIXTURE = pathlib.Path(__file__).parent.parent / 'tests' / 'parsers' / 'fixtures' / 'ase' / 'default_gpaw' / 'aiida.out'
+
+
+def generate_log(num_steps):
+    """Return the content of a GPAW log with ``num_steps`` ionic steps."""
+    content = FIXTURE.read_text()
+    start = content.index('Positions:')
+    end = content.index('Timing:')
+    return content[:start] + content[start:end] * num_steps + content[end:]
+
+
+def read_with_ase(content):
+    """Read the trajectory and the final frame with ``ase.io.read``."""
+    images = read(io.StringIO(content), index=':', format='gpaw-out')
+    final = read(io.StringIO(content), format='gpaw-out')
+    return images, final
+
+
+def read_single_pass(content):
+    """Read the trajectory and the final frame with ``read_gpaw_log``."""
+    images, _ = read_gpaw_log(io.StringIO(content))
+    return images, images[-1]
+
+
+def measure(function, content):
+    """Return the wall time in seconds and the peak memory in MiB of calling ``function`` on ``content``."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(content)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024**2
+
+
+def main():
+    """Print the parse time and peak memory as a function of the size of the log."""
+    print(f'{"steps":>6} {"size [MiB]":>11} {"ase [s]":>9} {"ase [MiB]":>10} {"single [s]":>11} {"single [MiB]":>13}')
+    for num_steps in (10, 100, 1000):
+        content = generate_log(num_steps)
+        time_ase, memory_ase = measure(read_with_ase, content)
+        time_single, memory_single = measure(read_single_pass, content)
+        size = len(content) / 1024**2
+        print(
+            f'{num_steps:>6} {size:>11.2f} {time_ase:>9.3f} {memory_ase:>10.1f} {time_single:>11.3f} '
+            f'{memory_single:>13.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
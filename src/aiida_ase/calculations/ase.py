@@ -1,25 +1,53 @@
 # -*- coding: utf-8 -*-
 """`CalcJob` implementation that can be used to wrap around the ASE calculators."""
-from aiida import common, engine, orm, plugins
-
-Dict = plugins.DataFactory('core.dict')
-StructureData = plugins.DataFactory('core.structure')
-KpointsData = plugins.DataFactory('core.array.kpoints')
+import os
+import sys
+
+from aiida import common, engine, orm
+from aiida.common.hashing import make_hash
+
+from .node import CANONICAL_INPUTS_HASH_KEY, AseCalcJobNode
+from .script import (
+    get_checkpoint_script,
+    get_kpoints_argsstr,
+    get_log_digest_script,
+    get_profile_script,
+    get_results_script,
+    get_scratch_staging_script,
+    get_sidecar_array,
+    get_walltime_script,
+    write_sidecar,
+)
 
 
 class AseCalculation(engine.CalcJob):
     """`CalcJob` implementation that can be used to wrap around the ASE calculators."""
 
+    _node_class = AseCalcJobNode
     _default_parser = 'ase.ase'
     _INPUT_FILE_NAME = 'aiida_script.py'
     _OUTPUT_FILE_NAME = 'results.json'  # Written at the very end
+    _OUTPUT_ARRAYS_FILE_NAME = 'results.npz'  # The arrays of the results, for the `npz` results format
     _TXT_OUTPUT_FILE_NAME = 'aiida.out'  # The log file of the calculation
     _input_aseatoms = 'aiida_atoms.json'  # The input file written for an ASE calc
     _output_aseatoms = 'aiida_out_atoms.json'  # For a relaxation, equivalent of qn.traj
+    _STRUCTURE_FORMATS = ('json', 'traj')  # Formats of the input and output structure files, by their extension
     _OPTIMIZER_FILE_NAME = 'aiida_optimizer.log'  # stdout for optimiser
+    _TRAJECTORY_FILE_NAME = 'aiida_trajectory.traj'  # Binary trajectory written by the optimiser at each step
+    _OPTIMIZER_STATE_FILE_NAME = 'aiida_optimizer_state.json'  # Restart file in which the optimiser dumps its state
+    # Optimizers of ASE that take the `restart` argument, contrary to e.g. the SciPy ones, which set it themselves
+    _RESTART_OPTIMIZERS = (
+        'bfgs', 'bfgslinesearch', 'fire', 'goodoldquasinewton', 'lbfgs', 'lbfgslinesearch', 'mdmin', 'quasinewton'
+    )
+    _TIMINGS_FILE_NAME = 'aiida_timings.json'  # Duration and peak memory of each phase of the script, when profiling
+    _WALLTIME_FILE_NAME = 'aiida_walltime.json'  # Marker written when the optimiser is stopped before the walltime
+    _MONITOR_FILE_NAME = 'aiida_monitor.json'  # Marker written by a monitor that kills the job, see ``monitors``
+    _LOG_DIGEST_FILE_NAME = 'aiida_log_digest.json'  # Final results and error signatures extracted from the log
     _write_gpw_file = False
     _GPW_FILE_NAME = 'aiida_gpw.gpw'
+    _PARENT_GPW_FILE_NAME = 'aiida_parent.gpw'  # The GPW file of the `parent_folder`, from which the calculator starts
     _freq_gpw_write = 0
+    _SIDECAR_FILE_NAME = 'aiida_arg_{}.npy'  # Array of a calculator argument that is too large to inline in the script
 
     @classmethod
     def define(cls, spec):
@@ -43,15 +71,35 @@ class AseCalculation(engine.CalcJob):
             help='Write the gpw file, useful for post processing')
         spec.input('metadata.options.log_filename', valid_type=str, default=cls._TXT_OUTPUT_FILE_NAME,
             help='Filename for the log file written out by the code')
-        spec.input('structure', valid_type=StructureData, help='The input structure.')
-        spec.input('kpoints', valid_type=KpointsData, required=False, help='The k-points to use for the calculation.')
-        spec.input('parameters', valid_type=Dict, help='Input parameters for the namelists.')
-        spec.input('settings', valid_type=Dict, required=False, help='Optional settings that control the plugin.')
+        cls.define_script_options(spec)
+        spec.input('structure', valid_type=orm.StructureData, required=False, help='The input structure.')
+        spec.input_namespace('structures', valid_type=orm.StructureData, required=False, dynamic=True,
+            help='Structures to compute in a single batched job that reuses one calculator, instead of `structure`.')
+        spec.input('kpoints', valid_type=orm.KpointsData, required=False,
+            help='The k-points to use for the calculation.')
+        spec.input('parameters', valid_type=orm.Dict, help='Input parameters for the namelists.')
+        spec.input('settings', valid_type=orm.Dict, required=False, help='Optional settings that control the plugin.')
+        spec.input('parent_folder', valid_type=orm.RemoteData, required=False,
+            help='Remote folder of a previous calculation, from whose GPW file the calculator is started.')
+        spec.input('optimizer_state', valid_type=orm.SinglefileData, required=False,
+            help='State of the optimiser of a previous relaxation, e.g. the Hessian of BFGS, to continue it.')
+        spec.inputs.validator = validate_inputs
 
         spec.output('structure', valid_type=orm.StructureData, required=False)
         spec.output('parameters', valid_type=orm.Dict, required=False)
         spec.output('array', valid_type=orm.ArrayData, required=False)
         spec.output('trajectory', valid_type=orm.TrajectoryData, required=False)
+        spec.output('timings', valid_type=orm.Dict, required=False,
+            help='Duration in seconds and peak resident memory in kB of each phase of the script, if profiled.')
+        spec.output('gpw_folder', valid_type=orm.RemoteData, required=False,
+            help='Remote folder that contains the GPW file, which can be passed as `parent_folder` without a transfer.')
+        spec.output('scf_telemetry', valid_type=orm.ArrayData, required=False,
+            help='Iterations of the SCF cycles of the GPAW log and their summary per cycle, see `scf_telemetry`.')
+        spec.output('optimizer_log', valid_type=orm.ArrayData, required=False,
+            help='Step, wall time in seconds since the first step, energy and maximum force of each step of the log of '
+            'the optimizer, as the arrays `steps`, `times`, `energies` and `fmax`.')
+        spec.output('optimizer_state', valid_type=orm.SinglefileData, required=False,
+            help='State of the optimiser after the last step, which can be used to continue the relaxation.')
 
         spec.exit_code(300, 'ERROR_OUTPUT_FILES', message='One of the expected output files was missing.')
         spec.exit_code(301, 'ERROR_LOG_FILES', message='The log file from the DFT code was not written out.')
@@ -62,8 +110,222 @@ class AseCalculation(engine.CalcJob):
         spec.exit_code(307, 'ERROR_ATTRIBUTE_ERROR', message='Attribute Error found in the stderr file.')
         spec.exit_code(308, 'ERROR_FERMI_LEVEL_INF', message='Fermi level is infinite.')
         spec.exit_code(400, 'ERROR_OUT_OF_WALLTIME', message='The calculation ran out of walltime.')
+        spec.exit_code(410, 'ERROR_SCF_DIVERGED',
+            message='The job was killed by a monitor because the SCF did not converge.')
+        spec.exit_code(411, 'ERROR_RELAX_STALLED',
+            message='The job was killed by a monitor because the maximum force of the relaxation did not decrease.')
         # yapf: enable
 
+    @classmethod
+    def define_script_options(cls, spec):
+        """Define the options of the generated script: checkpoints, formats, profiling, result cache and preflight."""
+        # yapf: disable
+        spec.input('metadata.options.gpw_keep', valid_type=int, default=1,
+            help='Number of GPW checkpoints to keep: the previous ones are renamed with the index before the '
+            'extension, e.g. `aiida_gpw.1.gpw`.')
+        spec.input('metadata.options.gpw_write_interval', valid_type=int, required=False,
+            help='Seconds between two GPW checkpoints of a relaxation, which replaces the SCF iteration count of '
+            '`freq_gpw_write`.')
+        spec.input('metadata.options.gpw_rotate_async', valid_type=bool, default=False,
+            help='Rotate the GPW checkpoints, and copy them back from the scratch directory, in a background thread '
+            'while the calculation continues. The GPW file itself is still written before the calculation continues.')
+        spec.input('metadata.options.gpw_storage', valid_type=str, default='remote',
+            help='Storage of the GPW file written with `write_gpw`: `remote` leaves it in the remote folder, which is '
+            'referenced by the `gpw_folder` output, `retrieve` stores it in the repository and `retrieve_temporary` '
+            'only retrieves it for the parser.')
+        spec.input('metadata.options.results_format', valid_type=str, default='json',
+            help='Format of the results file: `json` converts arrays to lists, `npz` writes the arrays in binary '
+            'format to a separate file and only the scalars to the JSON file.')
+        spec.input('metadata.options.sidecar_threshold', valid_type=int, default=1000,
+            help='Minimum number of elements of a numeric array argument of the calculator, e.g. `magmoms`, from which '
+            'it is written to a sidecar `.npy` file that is loaded by the script, instead of inlined in the script.')
+        spec.input('metadata.options.reduce_kpoints', valid_type=bool, default=False,
+            help='Reduce the mesh of the `kpoints` input by the symmetry of the structure, which requires `spglib`, '
+            'and pass the irreducible k-points and their weights as an explicit list. Not supported for GPAW, which '
+            'takes no weights and reduces the mesh itself.')
+        spec.input('metadata.options.reduce_kpoints_symprec', valid_type=float, default=1e-5,
+            help='Tolerance in Angstrom to find the symmetry operations of the structure for `reduce_kpoints`.')
+        spec.input('metadata.options.kpoints_weights_arg', valid_type=str, required=False,
+            help='Argument of the calculator that takes the weights of an explicit list of k-points, which is required '
+            'if the weights are not all equal.')
+        spec.input('metadata.options.structure_format', valid_type=str, default='json',
+            help='Format of the input and output structure files: `json` or the binary ASE trajectory format `traj`, '
+            'which is faster to write and read for large structures.')
+        spec.input('metadata.options.walltime_margin', valid_type=int, required=False,
+            help='Seconds before `max_wallclock_seconds` at which a relaxation is stopped cleanly. The script stops '
+            'the optimiser if the next step is expected to end within this margin, writes the current structure and '
+            'the GPW file, if requested, and the parser returns `ERROR_OUT_OF_WALLTIME`.')
+        spec.input('metadata.options.profile', valid_type=bool, default=False,
+            help='Record the duration and the peak resident memory of each phase of the script, and the duration of '
+            'each optimiser step, in a timings file that is parsed into the `timings` output.')
+        spec.input('metadata.options.result_cache', valid_type=bool, default=False,
+            help='Take the outputs of a previous successful calculation with the same structure, up to the '
+            '`result_cache_tolerance`, and the same normalized parameters, instead of submitting the job.')
+        spec.input('metadata.options.result_cache_tolerance', valid_type=float, default=1e-4,
+            help='Spacing in Angstrom of the grid on which the cell and positions are rounded for the result cache.')
+        spec.input('metadata.options.result_cache_max_age', valid_type=int, required=False,
+            help='Maximum age in seconds of the calculations whose outputs are taken from the result cache.')
+        spec.input('metadata.options.scratch_env', valid_type=str, required=False,
+            help='Name of an environment variable, e.g. `TMPDIR`, with a node-local directory in which the script '
+            'runs. The GPW checkpoints are copied back to the working directory when written, and the files to '
+            'retrieve and the GPW file when the script exits. If the variable is not set, the script runs in the '
+            'working directory.')
+        spec.input('metadata.options.log_digest', valid_type=bool, default=False,
+            help='Extract the final results and the error signatures from the GPAW log at the end of the script into '
+            'a compact digest that is parsed instead of the log. The log itself is then only retrieved temporarily.')
+        spec.input('metadata.options.retrieve_log', valid_type=bool, default=True,
+            help='Retrieve the log file written out by the code. If False, the log is left on the remote.')
+        spec.input('metadata.options.scf_telemetry', valid_type=str, required=False,
+            help='Extract the iterations of the SCF cycles from the GPAW log into the `scf_telemetry` output: `none`, '
+            '`summary` for the number of iterations and the wall time of each cycle, or `full` for also the energy, '
+            'the errors and the wall time of each iteration. By default `none`.')
+        spec.input('metadata.options.preflight', valid_type=str, default='compile',
+            help='Validation of the generated script before the job is submitted: `none`, `compile` to find syntax '
+            'errors, `imports` to also run the import lines, or `construct` to also read the structure and construct '
+            'the calculator without computing. The last two run the script with the `preflight_python` interpreter in '
+            'a subprocess and are only supported in a dry run.')
+        spec.input('metadata.options.preflight_python', valid_type=str, required=False,
+            help='Python interpreter with the packages of the environment of the job, for the `imports` and '
+            '`construct` levels of `preflight`. By default the interpreter that runs the dry run.')
+        spec.input('metadata.options.preflight_timeout', valid_type=int, default=60,
+            help='Maximum duration in seconds of the `imports` and `construct` levels of `preflight`.')
+        # yapf: enable
+
+    @classmethod
+    def get_structure_filenames(cls, structure_format='json'):
+        """Return the filenames of the input and output structure files for the given format.
+
+        :param structure_format: the format of the structure files, one of ``_STRUCTURE_FORMATS``.
+        :return: tuple of the filename of the input and of the output structure.
+        """
+        return tuple(
+            f'{os.path.splitext(filename)[0]}.{structure_format}'
+            for filename in (cls._input_aseatoms, cls._output_aseatoms)
+        )
+
+    def _get_parent_gpw(self):
+        """Return the instruction to stage the GPW file of the ``parent_folder``, or ``None`` if it does not exist.
+
+        A parent calculation that did not request the GPW file did not write it, otherwise the existence of the file is
+        checked on the remote, such that the upload does not fail on a missing file. The calculator then starts from
+        scratch.
+
+        :return: tuple of the UUID of the computer, the remote path of the GPW file and its name in the working folder.
+        """
+        parent_folder = self.inputs.parent_folder
+        filename = self._GPW_FILE_NAME
+
+        if parent_folder.creator is not None:
+            if not parent_folder.creator.get_option('write_gpw'):
+                return None
+            filename = parent_folder.creator.get_option('gpw_filename') or filename
+
+        try:
+            exists = filename in parent_folder.listdir()
+        except (OSError, common.exceptions.NotExistent) as exception:
+            self.logger.warning(f'the GPW file of the `parent_folder` could not be found: {exception}')
+            exists = False
+
+        if not exists:
+            return None
+
+        return (
+            parent_folder.computer.uuid,
+            os.path.join(parent_folder.get_remote_path(), filename),
+            self._PARENT_GPW_FILE_NAME,
+        )
+
+    def _get_kpoints_argsstr(self, folder, mesh=None, offset=None):
+        """Return the arguments of the calculator for the k-points of an explicit list or of a mesh reduced by symmetry.
+
+        :param folder: the folder in which the sidecar files of the k-points and their weights are written.
+        :param mesh: the mesh to reduce by symmetry, or ``None`` for the explicit list of the ``kpoints`` input.
+        :param offset: the offset of the mesh.
+        :return: the arguments as a string.
+        """
+        from .kpoints import get_rotations, reduce_kpoints_mesh
+
+        options = self.inputs.metadata.options
+
+        try:
+            if mesh is None:
+                points = self.inputs.kpoints.get_kpoints()
+                arraynames = self.inputs.kpoints.get_arraynames()
+                weights = self.inputs.kpoints.get_array('weights') if 'weights' in arraynames else None
+            elif 'structure' not in self.inputs:
+                raise ValueError('the `reduce_kpoints` option requires the `structure` input.')
+            else:
+                rotations = get_rotations(self.inputs.structure, options.reduce_kpoints_symprec)
+                points, weights = reduce_kpoints_mesh(mesh, offset, rotations)
+            weights_arg = options.get('kpoints_weights_arg', None)
+            return get_kpoints_argsstr(folder, self._SIDECAR_FILE_NAME, points, weights, weights_arg)
+        except ImportError as exception:
+            raise common.InputValidationError('the `reduce_kpoints` option requires `spglib`.') from exception
+        except ValueError as exception:
+            raise common.InputValidationError(str(exception)) from exception
+
+    def _setup_db_record(self):
+        """Create the database record for this process and the links with respect to its inputs.
+
+        The hash of the canonical form of the ``parameters`` and ``settings`` inputs, see ``canonicalize``, is stored as
+        an attribute, which replaces the hashes of the two inputs in the hash of the ``AseCalcJobNode``. This way,
+        inputs that only differ by the order of the keys or by tuples given as lists are equal for the caching of
+        AiiDA, also when the node is rehashed. The type of numbers is kept, so an integer and a float are different.
+        """
+        from .cache import canonicalize
+
+        super()._setup_db_record()
+
+        canonical_inputs = {
+            'parameters': canonicalize(self.inputs.parameters.get_dict()),
+            'settings': canonicalize(self.inputs.settings.get_dict()) if 'settings' in self.inputs else {},
+        }
+        self.node.base.attributes.set(CANONICAL_INPUTS_HASH_KEY, make_hash(canonical_inputs))
+
+    def run(self):
+        """Run the calculation job, unless its outputs can be taken from the result cache.
+
+        With the ``result_cache`` option, the key of the result cache is stored as an extra of the node. If a previous
+        successful calculation has the same key, its outputs are cloned, mapped onto the order and the frame of the
+        atoms of the structure and attached, and the job is not submitted. If the outputs cannot be mapped, the job is
+        submitted.
+        """
+        from .cache import (
+            RESULT_CACHE_EXTRA,
+            RESULT_CACHE_SOURCE_EXTRA,
+            find_cached_calculation,
+            get_cached_outputs,
+            get_result_cache_key,
+        )
+
+        options = self.inputs.metadata.options
+
+        if not options.result_cache or self.inputs.metadata.dry_run or self.node.exit_status is not None:
+            return super().run()
+
+        key = get_result_cache_key(self.inputs, options.result_cache_tolerance)
+        cached = find_cached_calculation(key, self.node.process_type, options.get('result_cache_max_age', None))
+        self.node.base.extras.set(RESULT_CACHE_EXTRA, key)
+
+        if cached is None:
+            return super().run()
+
+        outputs = get_cached_outputs(cached, self.inputs, options.result_cache_tolerance)
+
+        if outputs is None:
+            self.report(
+                f'the outputs of {cached.process_label}<{cached.pk}> cannot be mapped onto the atoms, submitting'
+            )
+            return super().run()
+
+        self.report(f'taking the outputs from the result cache of {cached.process_label}<{cached.pk}>')
+        self.node.base.extras.set(RESULT_CACHE_SOURCE_EXTRA, cached.uuid)
+
+        for link_label, node in outputs.items():
+            self.out(link_label, node)
+
+        return 0
+
     def prepare_for_submission(self, folder):
         """This method is called prior to job submission with a set of calculation input nodes.
 
@@ -80,16 +342,66 @@ class AseCalculation(engine.CalcJob):
         else:
             settings = {}
 
+        results_format = self.inputs.metadata.options.results_format
+        if results_format not in ('json', 'npz'):
+            raise common.InputValidationError(f'unsupported results format `{results_format}`, use `json` or `npz`.')
+
+        scf_telemetry = self.inputs.metadata.options.get('scf_telemetry', 'none')
+        if scf_telemetry not in ('none', 'summary', 'full'):
+            raise common.InputValidationError(
+                f'unsupported SCF telemetry `{scf_telemetry}`, use `none`, `summary` or `full`.'
+            )
+
+        gpw_storage = self.inputs.metadata.options.gpw_storage
+        if gpw_storage not in ('remote', 'retrieve', 'retrieve_temporary'):
+            raise common.InputValidationError(
+                f'unsupported GPW storage `{gpw_storage}`, use `remote`, `retrieve` or `retrieve_temporary`.'
+            )
+
+        write_gpw = self.inputs.metadata.options.write_gpw
+        gpw_keep = self.inputs.metadata.options.gpw_keep
+        if gpw_keep < 1:
+            raise common.InputValidationError('the `gpw_keep` option should be at least 1.')
+
+        profile = self.inputs.metadata.options.profile
+
+        walltime_limit = None
+        walltime_margin = self.inputs.metadata.options.get('walltime_margin', None)
+        max_wallclock_seconds = self.inputs.metadata.options.get('max_wallclock_seconds', None)
+        if walltime_margin is not None and max_wallclock_seconds is not None:
+            walltime_limit = max_wallclock_seconds - walltime_margin
+            if walltime_limit <= 0:
+                raise common.InputValidationError(
+                    'the `walltime_margin` should be smaller than `max_wallclock_seconds`.'
+                )
+
         # default atom getter: I will always retrieve the total energy at least
         default_atoms_getters = [['total_energy', '']]
 
         # ================================
 
+        structure_format = self.inputs.metadata.options.structure_format
+        if structure_format not in self._STRUCTURE_FORMATS:
+            raise common.InputValidationError(
+                f'unsupported structure format `{structure_format}`, use `json` or `traj`.'
+            )
+
+        input_aseatoms, output_aseatoms = self.get_structure_filenames(structure_format)
+
         # save the structure in ase format
-        atoms = self.inputs.structure.get_ase()
+        import ase.io
+
+        from .structure import get_ase_atoms
 
-        with folder.open(self._input_aseatoms, 'w') as handle:
-            atoms.write(handle)
+        if 'structure' in self.inputs:
+            batch_labels = None
+            images = get_ase_atoms(self.inputs.structure)
+        else:
+            # batched mode: all structures go in a single file, in the order of the sorted labels
+            batch_labels = sorted(self.inputs.structures.keys())
+            images = [get_ase_atoms(self.inputs.structures[label]) for label in batch_labels]
+
+        ase.io.write(folder.get_abs_path(input_aseatoms), images, format=structure_format)
 
         # ================== prepare the arguments of functions ================
 
@@ -108,8 +420,21 @@ class AseCalculation(engine.CalcJob):
                 raise common.InputValidationError("Don't have access to the optimizer name")
 
             # prepare the arguments to be passed to the optimizer class
-            optimizer_argsstr = f"atoms, logfile='{self.inputs.metadata.options.optimizer_stdout}', "\
-                     + convert_the_args(optimizer.pop('args', []))
+            optimizer_args = optimizer.pop('args', [])
+            optimizer_argsstr = f"atoms, logfile='{self.inputs.metadata.options.optimizer_stdout}', "
+
+            # the optimizer writes each step to a binary trajectory, unless one was explicitly specified
+            write_trajectory = not (isinstance(optimizer_args, dict) and 'trajectory' in optimizer_args)
+            if write_trajectory:
+                optimizer_argsstr += f"trajectory='{self._TRAJECTORY_FILE_NAME}', "
+
+            # the optimizer dumps its state at each step to a restart file, from which it is read again on a restart
+            custom_state = isinstance(optimizer_args, dict) and 'restart' in optimizer_args
+            write_state = optimizer_name.lower() in self._RESTART_OPTIMIZERS and not custom_state
+            if write_state:
+                optimizer_argsstr += f"restart='{self._OPTIMIZER_STATE_FILE_NAME}', "
+
+            optimizer_argsstr += convert_the_args(optimizer_args)
 
             # prepare the arguments to be passed to optimizer.run()
             optimizer_runargsstr = convert_the_args(optimizer.pop('run_args', []))
@@ -131,8 +456,12 @@ class AseCalculation(engine.CalcJob):
             # transform a in "a" if a is a string (needed for formatting)
             calc_args = {}
             for k, v in read_calc_args.items():
+                array = get_sidecar_array(v, self.inputs.metadata.options.sidecar_threshold)
                 if isinstance(v, str):
                     the_v = f'"{v}"'
+                elif array is not None:
+                    # large arrays are loaded from a binary file, converted to lists as if they were inlined
+                    the_v = write_sidecar(folder, self._SIDECAR_FILE_NAME.format(k), array)
                 else:
                     the_v = v
                 calc_args[k] = the_v
@@ -165,21 +494,25 @@ class AseCalculation(engine.CalcJob):
 
             # add kpoints if present
             if 'kpoints' in self.inputs:
-                #TODO: here only the mesh is supported
-                # maybe kpoint lists are supported as well in ASE calculators
                 try:
-                    mesh = self.inputs.kpoints.get_kpoints_mesh()[0]
+                    mesh, offset = self.inputs.kpoints.get_kpoints_mesh()
                 except AttributeError:
-                    raise common.InputValidationError("Coudn't find a mesh of kpoints in the KpointsData")
-                if 'kpoints_options' in parameters_dict:
+                    mesh, offset = None, None
+
+                if mesh is None or self.inputs.metadata.options.reduce_kpoints:
+                    # an explicit list, or the mesh reduced by symmetry, is passed as arrays in sidecar files
+                    kpts_argsstr = self._get_kpoints_argsstr(folder, mesh, offset)
+                elif 'kpoints_options' in parameters_dict:
                     kpts_argsstr = "kpts={'size':" + '({}, {}, {})'.format(*mesh)  # pylint: disable=consider-using-f-string
                     for k, v in parameters_dict['kpoints_options'].items():
                         kpts_argsstr += f", '{k}':{v}"
                     kpts_argsstr += '}'
                     parameters_dict.pop('kpoints_options')
-                    calc_argsstr = ', '.join([calc_argsstr] + [kpts_argsstr])
                 else:
-                    calc_argsstr = ', '.join([calc_argsstr] + ['kpts=({},{},{})'.format(*mesh)])  # pylint: disable=consider-using-f-string
+                    kpts_argsstr = 'kpts=({},{},{})'.format(*mesh)  # pylint: disable=consider-using-f-string
+
+                # the calculator can have no other arguments
+                calc_argsstr = ', '.join(filter(None, [calc_argsstr, kpts_argsstr]))
 
         # =============== prepare the methods of atoms.get(), to save results
 
@@ -195,6 +528,8 @@ class AseCalculation(engine.CalcJob):
 
         if optimizer is not None:
             all_imports.append(optimizer_import_string)
+            if walltime_limit is not None and not profile:
+                all_imports.append('import time')
 
         try:
             if 'PW' in calc_args['mode'].values():
@@ -221,13 +556,60 @@ class AseCalculation(engine.CalcJob):
         if self.options.get('withmpi', False):
             all_imports.append('from ase.parallel import paropen')
 
-        all_imports_string = '\n'.join(all_imports) + '\n'
+        if 'parent_folder' in self.inputs:
+            all_imports.append('import os')
+
+        log_digest = self.inputs.metadata.options.log_digest
+        if log_digest:
+            all_imports.extend(['import atexit', 'import sys'])
+
+        scratch_env = self.inputs.metadata.options.get('scratch_env', None)
+        if scratch_env is not None:
+            all_imports.extend([
+                'import atexit', 'import glob', 'import os', 'import shutil', 'import tempfile',
+                'from ase.parallel import world'
+            ])
+
+        if write_gpw:
+            all_imports.extend(['import os', 'import threading', 'import time', 'from ase.parallel import world'])
+
+        # the same module can be needed by more than one feature of the script
+        all_imports_string = '\n'.join(dict.fromkeys(all_imports)) + '\n'
+        right_open = 'paropen' if self.options.get('withmpi', False) else 'open'
 
         # =================== prepare the python script ========================
 
-        input_txt = all_imports_string
+        input_txt = ''
+        if profile:
+            # the timers are started before the imports, such that their duration is recorded as well
+            input_txt += get_profile_script(self._TIMINGS_FILE_NAME, right_open)
+
+        input_txt += all_imports_string
         input_txt += '\n'
 
+        if profile:
+            input_txt += "record_timing('imports')\n"
+            input_txt += '\n'
+
+        # the staging in the scratch directory is inserted here when the files to copy back are known, such that the
+        # files are copied back by the exit handler after those of the other exit handlers are written
+        scratch_offset = len(input_txt)
+
+        if log_digest:
+            # the digest is written at exit, such that also the error signatures of a failed calculation are extracted
+            input_txt += get_log_digest_script(
+                self.inputs.metadata.options.log_filename, self._LOG_DIGEST_FILE_NAME, right_open
+            )
+
+        # the walltime is only tracked for a relaxation, where the optimiser can be stopped between two steps
+        track_walltime = optimizer is not None and walltime_limit is not None
+        if track_walltime:
+            input_txt += 'walltime_start = time.time()\n'
+            input_txt += '\n'
+
+        # the part of the script that reads the structure and constructs the calculator, for the preflight validation
+        setup_offset = len(input_txt)
+
         pre_lines = parameters_dict.pop('pre_lines', None)
         if pre_lines is not None:
             if not isinstance(pre_lines, (list, tuple)):
@@ -236,45 +618,86 @@ class AseCalculation(engine.CalcJob):
                 raise ValueError('Prelines must be a list of strings')
             input_txt += '\n'.join(pre_lines) + '\n\n'
 
-        input_txt += f"atoms = ase.io.read('{self._input_aseatoms}')\n"
-        input_txt += '\n'
-        input_txt += f'calculator = custom_calculator({calc_argsstr})\n'
-        input_txt += 'atoms.calc = calculator\n'
-        input_txt += '\n'
+        calculator_txt = f'calculator = custom_calculator({calc_argsstr})\n'
+        if 'parent_folder' in self.inputs:
+            # start from the wavefunctions and density of the parent, if its GPW file was found
+            restart_argsstr = f"restart='{self._PARENT_GPW_FILE_NAME}'"
+            if calc_argsstr:
+                restart_argsstr += f', {calc_argsstr}'
+            calculator_txt = f"if os.path.isfile('{self._PARENT_GPW_FILE_NAME}'):\n"
+            calculator_txt += f'    calculator = custom_calculator({restart_argsstr})\n'
+            calculator_txt += 'else:\n'
+            calculator_txt += f'    calculator = custom_calculator({calc_argsstr})\n'
+
+        if batch_labels is None:
+            input_txt += f"atoms = ase.io.read('{input_aseatoms}')\n"
+            input_txt += '\n'
+            input_txt += calculator_txt
+            input_txt += 'atoms.calc = calculator\n'
+            input_txt += '\n'
+        else:
+            input_txt += f"images = ase.io.read('{input_aseatoms}', index=':')\n"
+            input_txt += f'labels = {batch_labels!r}\n'
+            input_txt += '\n'
+            input_txt += calculator_txt
+            input_txt += '\n'
+
+        setup_txt = input_txt[setup_offset:]
+
+        if write_gpw:
+            # the GPW file is written to a temporary file that is renamed, such that a killed job leaves no partial file
+            input_txt += get_checkpoint_script(scratch_env is not None)
+            input_txt += f"checkpoint = Checkpoint('{self.inputs.metadata.options.gpw_filename}', keep={gpw_keep}, "
+            input_txt += f'background={self.inputs.metadata.options.gpw_rotate_async})\n'
+            input_txt += '\n'
+
+        if profile:
+            input_txt += "record_timing('setup')\n"
+            input_txt += '\n'
 
         if optimizer is not None:
             # check if the gpw file has been requested
-            if self.inputs.metadata.options.write_gpw:
-                # attach a class which tells the calculator
-                # when to write the gpw file
+            if write_gpw:
+                # attach the checkpoint to the calculator, such that the GPW file is written during the relaxation
                 # (this is needed for the restart)
                 # Similar to https://wiki.fysik.dtu.dk/gpaw/documentation/manual.html#restarting-a-calculation
-                gpw_filename = self.metadata.options.gpw_filename
+                interval = self.inputs.metadata.options.get('gpw_write_interval', None)
                 occasion = self.inputs.metadata.options.freq_gpw_write
-                if occasion > 0:
-                    input_txt += 'class WriteIntervals:\n'
-                    input_txt += '    def __init__(self, fname):\n'
-                    input_txt += '        self.fname = fname\n'
-                    input_txt += '        self.iter=0\n'
-                    input_txt += '    def write(self):\n'
-                    input_txt += '        calculator.write(self.fname)\n'
-                    input_txt += f'        self.iter += {occasion}\n'
-                    input_txt += f"calculator.attach(WriteIntervals('{gpw_filename}').write, {occasion})\n"
+                if interval is not None:
+                    input_txt += f'calculator.attach(checkpoint.write_if_due, 1, {interval})\n'
+                elif occasion > 0:
+                    input_txt += f'calculator.attach(checkpoint.write, {occasion})\n'
 
             # here block the trajectory file name: trajectory = 'aiida.traj'
             input_txt += f'optimizer = custom_optimizer({optimizer_argsstr})\n'
-            input_txt += f'optimizer.run({optimizer_runargsstr})\n'
+            if profile:
+                input_txt += 'optimizer.attach(record_step)\n'
+            if track_walltime:
+                # stop before the walltime if the slowest step so far would not fit in the remaining time
+                input_txt += get_walltime_script(
+                    optimizer_runargsstr,
+                    walltime_limit,
+                    self._WALLTIME_FILE_NAME,
+                    right_open,
+                    structure_filename=output_aseatoms,
+                    profile=profile,
+                    gpw=write_gpw,
+                )
+            else:
+                input_txt += f'optimizer.run({optimizer_runargsstr})\n'
+                if profile:
+                    input_txt += "record_timing('optimizer')\n"
             input_txt += '\n'
 
         # now dump / calculate the results
-        input_txt += 'results = {}\n'
+        results_txt = 'results = {}\n'
         for getter, getter_args in atoms_getters:
-            input_txt += f"results['{getter}'] = atoms.get_{getter}({getter_args})\n"
-        input_txt += '\n'
+            results_txt += f"results['{getter}'] = atoms.get_{getter}({getter_args})\n"
+        results_txt += '\n'
 
         for getter, getter_args in calculator_getters:
-            input_txt += f"results['{getter}'] = calculator.get_{getter}({getter_args})\n"
-        input_txt += '\n'
+            results_txt += f"results['{getter}'] = calculator.get_{getter}({getter_args})\n"
+        results_txt += '\n'
 
         post_lines = parameters_dict.pop('post_lines', None)
         if post_lines is not None:
@@ -282,33 +705,35 @@ class AseCalculation(engine.CalcJob):
                 raise ValueError('Postlines must be a list of strings')
             if not all([isinstance(_, str) for _ in post_lines]):
                 raise ValueError('Postlines must be a list of strings')
-            input_txt += '\n'.join(post_lines) + '\n\n'
+            results_txt += '\n'.join(post_lines) + '\n\n'
+
+        input_txt += get_results_script(results_txt, results_format, batch_labels is not None)
 
-        # Convert to lists
-        input_txt += 'for k,v in results.items():\n'
-        input_txt += '    if isinstance(results[k],(numpy.matrix,numpy.ndarray)):\n'
-        input_txt += '        results[k] = results[k].tolist()\n'
+        if profile:
+            input_txt += "record_timing('results')\n"
 
         input_txt += '\n'
         # Dump results to file
-        right_open = 'paropen' if self.options.get('withmpi', False) else 'open'
         input_txt += f"with {right_open}('{self._OUTPUT_FILE_NAME}', 'w') as f:\n"
         input_txt += '    json.dump(results,f)'
         input_txt += '\n'
+        if results_format == 'npz':
+            input_txt += f"with {right_open}('{self._OUTPUT_ARRAYS_FILE_NAME}', 'wb') as f:\n"
+            input_txt += '    numpy.savez(f, **arrays)\n'
 
         # Dump trajectory if present
         if optimizer is not None:
-            input_txt += f"atoms.write('{self._output_aseatoms}')\n"
+            input_txt += f"atoms.write('{output_aseatoms}')\n"
             input_txt += '\n'
 
         # Write out the final gpw file if requested
-        if self.inputs.metadata.options.write_gpw:
-            input_txt += f"calculator.write('{self.inputs.metadata.options.gpw_filename}')\n"
+        if write_gpw:
+            input_txt += 'checkpoint.write(wait=True)\n'
             input_txt += '\n'
 
-        # write all the input script to a file
-        with folder.open(self._INPUT_FILE_NAME, 'w') as handle:
-            handle.write(input_txt)
+        if profile:
+            input_txt += "record_timing('dump')\n"
+            input_txt += 'write_timings()\n'
 
         # ============================ calcinfo ================================
 
@@ -318,6 +743,25 @@ class AseCalculation(engine.CalcJob):
 
         local_copy_list = []
         remote_copy_list = []
+        remote_symlink_list = []
+
+        parent_folder_symlink = settings.pop('PARENT_FOLDER_SYMLINK', True)
+        parent_gpw = self._get_parent_gpw() if 'parent_folder' in self.inputs else None
+        if parent_gpw is not None:
+            # the GPW file is only read, so it is symlinked by default to avoid copying a potentially large file
+            if parent_folder_symlink:
+                remote_symlink_list.append(parent_gpw)
+            else:
+                remote_copy_list.append(parent_gpw)
+
+        if 'optimizer_state' in self.inputs:
+            if optimizer is None or not write_state:
+                raise common.InputValidationError(
+                    'the `optimizer_state` input requires an `optimizer` that takes a `restart` file, '
+                    f"one of {', '.join(self._RESTART_OPTIMIZERS)}, without a custom one."
+                )
+            optimizer_state = self.inputs.optimizer_state
+            local_copy_list.append((optimizer_state.uuid, optimizer_state.filename, self._OPTIMIZER_STATE_FILE_NAME))
         additional_retrieve_list = settings.pop('ADDITIONAL_RETRIEVE_LIST', [])
 
         calcinfo = common.CalcInfo()
@@ -325,6 +769,7 @@ class AseCalculation(engine.CalcJob):
         calcinfo.uuid = self.uuid
         calcinfo.local_copy_list = local_copy_list
         calcinfo.remote_copy_list = remote_copy_list
+        calcinfo.remote_symlink_list = remote_symlink_list
 
         codeinfo = common.CodeInfo()
         cmdline_params = settings.pop('CMDLINE', [])
@@ -340,16 +785,100 @@ class AseCalculation(engine.CalcJob):
         # Retrieve files
         calcinfo.retrieve_list = []
         calcinfo.retrieve_list.append(self.options.output_filename)
-        calcinfo.retrieve_list.append(self._output_aseatoms)
-        calcinfo.retrieve_list.append(self._TXT_OUTPUT_FILE_NAME)
+        if results_format == 'npz':
+            calcinfo.retrieve_list.append(self._OUTPUT_ARRAYS_FILE_NAME)
+        calcinfo.retrieve_list.append(output_aseatoms)
+        calcinfo.retrieve_temporary_list = []
+        if log_digest:
+            # only the digest is stored, the log is retrieved temporarily to parse, e.g., the trajectory if needed
+            calcinfo.retrieve_list.append(self._LOG_DIGEST_FILE_NAME)
+            if self.inputs.metadata.options.retrieve_log:
+                calcinfo.retrieve_temporary_list.append(self._TXT_OUTPUT_FILE_NAME)
+        elif self.inputs.metadata.options.retrieve_log:
+            calcinfo.retrieve_list.append(self._TXT_OUTPUT_FILE_NAME)
+        if profile:
+            calcinfo.retrieve_list.append(self._TIMINGS_FILE_NAME)
         if optimizer is not None:
             calcinfo.retrieve_list.append(self._OPTIMIZER_FILE_NAME)
+            if write_trajectory:
+                calcinfo.retrieve_list.append(self._TRAJECTORY_FILE_NAME)
+            if write_state:
+                calcinfo.retrieve_list.append(self._OPTIMIZER_STATE_FILE_NAME)
+            if track_walltime:
+                calcinfo.retrieve_list.append(self._WALLTIME_FILE_NAME)
+        if 'monitors' in self.inputs:
+            calcinfo.retrieve_list.append(self._MONITOR_FILE_NAME)
+
+        # the GPW file is left on the remote by default, since it can be very large
+        if self.inputs.metadata.options.write_gpw:
+            if gpw_storage == 'retrieve':
+                calcinfo.retrieve_list.append(self.inputs.metadata.options.gpw_filename)
+            elif gpw_storage == 'retrieve_temporary':
+                calcinfo.retrieve_temporary_list.append(self.inputs.metadata.options.gpw_filename)
 
         calcinfo.retrieve_list += additional_retrieve_list
 
+        if scratch_env is not None:
+            # the restart file of the optimiser is rewritten at each step, the other input files are only read
+            stage_in = [self._OPTIMIZER_STATE_FILE_NAME] if 'optimizer_state' in self.inputs else []
+            stage_out = []
+            for item in calcinfo.retrieve_list + calcinfo.retrieve_temporary_list:
+                stage_out.append(item if isinstance(item, str) else item[0])
+            # the GPW file is copied back by the checkpoint each time it is written
+            if write_gpw:
+                stage_out = [item for item in stage_out if item != self.inputs.metadata.options.gpw_filename]
+            staging_txt = get_scratch_staging_script(scratch_env, stage_in, list(dict.fromkeys(stage_out)))
+            input_txt = input_txt[:scratch_offset] + staging_txt + input_txt[scratch_offset:]
+
+        # write all the input script to a file
+        with folder.open(self._INPUT_FILE_NAME, 'w') as handle:
+            handle.write(input_txt)
+
+        # reject a broken script before the job waits in the queue
+        from .preflight import validate_script
+
+        options = self.inputs.metadata.options
+        try:
+            validate_script(
+                level=options.preflight,
+                script=input_txt,
+                filename=self._INPUT_FILE_NAME,
+                import_lines=list(dict.fromkeys(all_imports)),
+                setup_script=setup_txt,
+                directory=folder.abspath,
+                python=options.get('preflight_python', sys.executable),
+                timeout=options.preflight_timeout,
+            )
+        except ValueError as exception:
+            raise common.InputValidationError(str(exception)) from exception
+
         return calcinfo
 
 
+def validate_inputs(value, port_namespace):
+    """Validate the top-level inputs namespace."""
+    metadata = value.get('metadata', {})
+    if metadata.get('options', {}).get('preflight', None) in ('imports', 'construct') and not metadata.get('dry_run'):
+        return 'the `imports` and `construct` levels of the `preflight` option are only supported in a dry run.'
+
+    # GPAW, the default calculator, has no argument for the weights of the k-points
+    calculator = value['parameters'].get_dict().get('calculator', {}) if 'parameters' in value else {}
+    gpaw = (calculator.get('name', None) or 'gpaw').lower() == 'gpaw'
+    if metadata.get('options', {}).get('reduce_kpoints', False) and gpaw:
+        return 'the `reduce_kpoints` option is not supported for GPAW: pass the mesh, which GPAW reduces by symmetry.'
+
+    if 'structure' not in port_namespace or 'structures' not in port_namespace:
+        return None
+
+    if ('structure' in value) == bool(value.get('structures', None)):
+        return 'exactly one of the `structure` and `structures` inputs should be specified.'
+
+    if value.get('structures', None) and 'parameters' in value and 'optimizer' in value['parameters'].get_dict():
+        return 'the `optimizer` is not supported for a batched calculation with the `structures` input.'
+
+    return None
+
+
 def get_calculator_impstr(calculator_name):
     """
     Returns the import string for the calculator
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of the results of ``AseCalculation`` jobs.
+
+Contrary to the caching of AiiDA, which requires the hash of all inputs to be identical, the key of this cache is built
+from a fingerprint of the structure, which does not depend on the order of the atoms and on translations and whose cell
+and positions are rounded with a tolerance, and from the normalized ``parameters``. The key is stored as an extra of
+each calculation that uses the cache, such that a later calculation with the same key can take the outputs of the most
+recent successful one instead of being submitted. The per-atom outputs are then mapped onto the order and the frame of
+the atoms of the new calculation.
+"""
+import datetime
+import hashlib
+import json
+
+from aiida import orm
+from aiida.common import LinkType, timezone
+from aiida.orm.nodes.data.structure import Site
+import numpy
+
+RESULT_CACHE_EXTRA = 'result_cache_key'
+RESULT_CACHE_SOURCE_EXTRA = 'result_cache_source'
+
+# options, besides the parser and the GPW file, that change the outputs of a calculation
+RESULT_CACHE_OPTIONS = (
+    'gpw_keep', 'kpoints_weights_arg', 'log_digest', 'profile', 'reduce_kpoints', 'reduce_kpoints_symprec',
+    'results_format', 'scf_telemetry', 'structure_format'
+)
+
+# names of the arrays of the outputs whose first dimension, or second for a trajectory, is the index of the atom
+PER_ATOM_ARRAYS = (
+    'charges', 'forces', 'initial_charges', 'initial_magnetic_moments', 'magmoms', 'masses', 'momenta', 'numbers',
+    'positions', 'tags', 'velocities'
+)
+
+
+def canonicalize(value):
+    """Return a canonical form of a JSON-serializable value.
+
+    Dictionaries are sorted by key and tuples are converted to lists, such that semantically identical values, e.g.
+    ``{'size': (2, 2, 2), 'gamma': True}`` and ``{'gamma': True, 'size': [2, 2, 2]}``, are equal. The type of numbers is
+    kept, since a calculator can treat an integer differently from a float with the same value.
+
+    :param value: the value to canonicalize.
+    :return: the canonical form of the value.
+    """
+    if isinstance(value, dict):
+        return {str(key): canonicalize(value[key]) for key in sorted(value, key=str)}
+
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(element) for element in value]
+
+    return value
+
+
+def _get_canonical_form(structure, tolerance):  # pylint: disable=too-many-locals
+    """Return the fingerprint of a structure, with the order of its atoms and the origin used to compute it.
+
+    :param structure: the ``StructureData``.
+    :param tolerance: the spacing in Angstrom of the grid on which the cell and the positions are rounded.
+    :return: tuple of the fingerprint, the indices of the atoms in the order of the fingerprint and the position in
+        Angstrom of the anchor atom relative to which the positions were expressed.
+    :raises ValueError: if the structure is periodic and its cell has a zero volume.
+    """
+    cell = numpy.array(structure.cell, dtype=float)
+    pbc = numpy.array(structure.pbc, dtype=bool)
+    kinds = [site.kind_name for site in structure.sites]
+    positions = numpy.array([site.position for site in structure.sites], dtype=float).reshape(-1, 3)
+
+    if abs(numpy.linalg.det(cell)) > 1e-8:
+        basis = cell
+    elif not pbc.any():
+        basis = numpy.eye(3)
+    else:
+        raise ValueError('the cell of a periodic structure should have a non-zero volume.')
+
+    grid = numpy.maximum(numpy.rint(numpy.linalg.norm(basis, axis=1) / tolerance), 1).astype(int)
+    scaled = numpy.linalg.solve(basis.T, positions.T).T
+
+    # the kinds are replaced by their index in the sorted list of kind names, to sort the rows with numpy
+    names = sorted(set(kinds))
+    indices = numpy.array([names.index(kind) for kind in kinds], dtype=int)
+    counts = numpy.bincount(indices, minlength=len(names)) if kinds else numpy.array([], dtype=int)
+
+    rows, order, origin = [], numpy.arange(len(kinds)), numpy.zeros(3)
+    if kinds:
+        anchor_kind = min(range(len(names)), key=lambda index: (counts[index], names[index]))
+        candidates = []
+        for anchor in numpy.flatnonzero(indices == anchor_kind):
+            relative = scaled - scaled[anchor]
+            relative[:, pbc] %= 1.0
+            rounded = numpy.rint(relative * grid).astype(int)
+            rounded[:, pbc] %= grid[pbc]
+            candidate = numpy.column_stack([indices, rounded])
+            candidate_order = numpy.lexsort(candidate.T[::-1])
+            candidates.append((candidate[candidate_order].tolist(), candidate_order, anchor))
+        rows, order, anchor = min(candidates, key=lambda candidate: candidate[0])
+        origin = positions[anchor]
+
+    fingerprint = [names, rows, numpy.rint(cell / tolerance).astype(int).tolist(), pbc.tolist()]
+
+    return fingerprint, order, origin
+
+
+def get_structure_fingerprint(structure, tolerance):
+    """Return a fingerprint of a structure that is invariant under permutations of the atoms and under translations.
+
+    The positions are expressed relative to each atom of the least abundant kind in turn, wrapped in the cell along the
+    periodic directions and rounded on a grid with the given spacing. The fingerprint is the lexicographically smallest
+    of the sorted lists of kinds and rounded positions, together with the rounded cell and the periodic boundary
+    conditions. Positions that are closer than the tolerance to a grid boundary can still be rounded differently.
+
+    :param structure: the ``StructureData``.
+    :param tolerance: the spacing in Angstrom of the grid on which the cell and the positions are rounded.
+    :return: the fingerprint as a list that can be serialized to JSON.
+    """
+    return _get_canonical_form(structure, tolerance)[0]
+
+
+def get_atom_mapping(structure, source, tolerance):
+    """Return how the atoms of a structure map onto those of a source structure with the same fingerprint.
+
+    If the kinds of the atoms are in the same order and the positions are equal within the tolerance, the mapping is the
+    identity, otherwise it is the one that brings both structures in the order and the frame of their fingerprint.
+
+    :param structure: the ``StructureData``.
+    :param source: the ``StructureData`` of the calculation whose outputs are mapped.
+    :param tolerance: the spacing in Angstrom of the grid on which the cell and the positions are rounded.
+    :return: tuple of the index of the atom of the source for each atom of the structure and the translation in Angstrom
+        from the source to the structure, or ``None`` if the fingerprints of the structures differ.
+    """
+    fingerprint, order, origin = _get_canonical_form(structure, tolerance)
+    source_fingerprint, source_order, source_origin = _get_canonical_form(source, tolerance)
+
+    if fingerprint != source_fingerprint:
+        return None
+
+    kinds = [site.kind_name for site in structure.sites]
+    positions = numpy.array([site.position for site in structure.sites], dtype=float).reshape(-1, 3)
+    source_positions = numpy.array([site.position for site in source.sites], dtype=float).reshape(-1, 3)
+
+    if kinds == [site.kind_name for site in source.sites] and numpy.allclose(positions, source_positions, 0, tolerance):
+        return numpy.arange(len(kinds)), numpy.zeros(3)
+
+    permutation = numpy.empty(len(kinds), dtype=int)
+    permutation[order] = source_order
+
+    return permutation, origin - source_origin
+
+
+def _map_structure(structure, permutation, translation):
+    """Return a ``StructureData`` with the sites of a structure permuted and translated.
+
+    :param structure: the ``StructureData``.
+    :param permutation: the index of the site of the structure for each site of the new structure.
+    :param translation: the translation in Angstrom of the positions.
+    :return: the unstored ``StructureData``.
+    """
+    mapped = orm.StructureData(cell=structure.cell, pbc=structure.pbc)
+
+    for kind in structure.kinds:
+        mapped.append_kind(kind)
+
+    for index in permutation:
+        site = structure.sites[index]
+        position = numpy.array(site.position, dtype=float) + translation
+        mapped.append_site(Site(kind_name=site.kind_name, position=tuple(position.tolist())))
+
+    return mapped
+
+
+def _map_trajectory(trajectory, permutation, translation):
+    """Return a ``TrajectoryData`` with the atoms of a trajectory permuted and translated.
+
+    :param trajectory: the ``TrajectoryData``.
+    :param permutation: the index of the atom of the trajectory for each atom of the new trajectory.
+    :param translation: the translation in Angstrom of the positions.
+    :return: the unstored ``TrajectoryData``, or ``None`` if one of its arrays cannot be mapped.
+    """
+    arraynames = trajectory.get_arraynames()
+    symbols = trajectory.symbols
+
+    mapped = orm.TrajectoryData()
+    mapped.set_trajectory(
+        symbols=[symbols[index] for index in permutation],
+        positions=trajectory.get_positions()[:, permutation] + translation,
+        stepids=trajectory.get_stepids(),
+        cells=trajectory.get_cells(),
+        times=trajectory.get_times(),
+        velocities=trajectory.get_array('velocities')[:, permutation] if 'velocities' in arraynames else None,
+    )
+
+    for name in arraynames:
+        if name in ('positions', 'steps', 'cells', 'times', 'velocities'):
+            continue
+
+        array = trajectory.get_array(name)
+
+        if name in PER_ATOM_ARRAYS:
+            array = array[:, permutation]
+        elif array.ndim > 1 and array.shape[1] == len(permutation):
+            return None
+
+        mapped.set_array(name, array)
+
+    return mapped
+
+
+def _map_array(array_data, mappings):
+    """Return an ``ArrayData`` with the per-atom arrays permuted and translated.
+
+    The arrays of a batched calculation are prefixed with the label of their structure.
+
+    :param array_data: the ``ArrayData``.
+    :param mappings: the permutation and translation of each structure, keyed on its label or on ``None``.
+    :return: the unstored ``ArrayData``, or ``None`` if one of its arrays cannot be mapped.
+    """
+    mapped = orm.ArrayData()
+
+    for name in array_data.get_arraynames():
+        array = array_data.get_array(name)
+
+        if None in mappings:
+            key, mapping = name, mappings[None]
+        else:
+            label, _, key = name.partition('__')
+            mapping = mappings.get(label, None)
+
+        if mapping is not None:
+            permutation, translation = mapping
+            if key in PER_ATOM_ARRAYS:
+                array = array[permutation] + translation if key == 'positions' else array[permutation]
+            elif array.ndim > 0 and array.shape[0] == len(permutation):
+                return None
+
+        mapped.set_array(name, array)
+
+    return mapped
+
+
+def get_cached_outputs(cached, inputs, tolerance):
+    """Return clones of the outputs of a cached calculation, mapped onto the atoms of the structures of the inputs.
+
+    The per-atom arrays, the output structure and the trajectory are brought in the order and the frame of the atoms of
+    the inputs. The outputs of the ``retrieved`` and ``remote_folder`` are the files of the cached calculation, which
+    are not mapped. Arrays of unknown names with a dimension of the number of atoms, the ``gpw_folder`` and the
+    ``optimizer_state`` cannot be mapped, so the outputs are only taken if the atoms already are in the same order and
+    frame.
+
+    :param cached: the ``CalcJobNode`` whose outputs are taken.
+    :param inputs: the inputs of the ``AseCalculation``.
+    :param tolerance: the spacing in Angstrom of the grid on which the cell and the positions are rounded.
+    :return: dictionary of the unstored outputs keyed on their link label, or ``None`` if they cannot be mapped.
+    """
+    sources = cached.base.links.get_incoming(link_type=LinkType.INPUT_CALC).nested()
+
+    if 'structure' in inputs:
+        mappings = {None: get_atom_mapping(inputs['structure'], sources['structure'], tolerance)}
+    else:
+        structures = inputs['structures']
+        mappings = {
+            label: get_atom_mapping(node, sources['structures'][label], tolerance) for label, node in structures.items()
+        }
+
+    if any(mapping is None for mapping in mappings.values()):
+        return None
+
+    identity = all(
+        numpy.array_equal(permutation, numpy.arange(len(permutation))) and not translation.any()
+        for permutation, translation in mappings.values()
+    )
+
+    outputs = {}
+
+    for link_triple in cached.base.links.get_outgoing(link_type=LinkType.CREATE).all():
+        label, node = link_triple.link_label, link_triple.node
+
+        if identity or label in (
+            'retrieved', 'remote_folder', 'parameters', 'timings', 'scf_telemetry', 'optimizer_log'
+        ):
+            outputs[label] = node.clone()
+        elif label == 'array':
+            outputs[label] = _map_array(node, mappings)
+        elif label == 'structure' and None in mappings:
+            outputs[label] = _map_structure(node, *mappings[None])
+        elif label == 'trajectory' and None in mappings:
+            outputs[label] = _map_trajectory(node, *mappings[None])
+        else:
+            return None
+
+        if outputs[label] is None:
+            return None
+
+    return outputs
+
+
+def get_result_cache_key(inputs, tolerance):
+    """Return the key of the result cache for the inputs of an ``AseCalculation``.
+
+    The key depends on the fingerprint of the structure, or of each structure in a batched calculation, on the
+    normalized ``parameters``, ``kpoints`` and ``settings``, on the ``parent_folder`` and ``optimizer_state``, on the
+    code and the parser and on the options that change the outputs, see ``RESULT_CACHE_OPTIONS``.
+
+    :param inputs: the inputs of the ``AseCalculation``.
+    :param tolerance: the spacing in Angstrom of the grid on which the cell and the positions are rounded.
+    :return: the key as a hexadecimal string.
+    """
+    if 'structure' in inputs:
+        structures = get_structure_fingerprint(inputs['structure'], tolerance)
+    else:
+        structures = {label: get_structure_fingerprint(node, tolerance) for label, node in inputs['structures'].items()}
+
+    # the explicit k-points are in reciprocal crystal coordinates, so they are taken exactly instead of being rounded
+    kpoints = None
+    if 'kpoints' in inputs:
+        try:
+            kpoints = list(inputs['kpoints'].get_kpoints_mesh())
+        except AttributeError:
+            kpoints = [inputs['kpoints'].get_kpoints().tolist()]
+            if 'weights' in inputs['kpoints'].get_arraynames():
+                kpoints.append(inputs['kpoints'].get_array('weights').tolist())
+
+    settings = inputs['settings'].get_dict() if 'settings' in inputs else {}
+    settings.pop('CMDLINE', None)  # the command line does not affect the results
+
+    options = inputs['metadata']['options']
+
+    content = {
+        'structures': structures,
+        'parameters': inputs['parameters'].get_dict(),
+        'kpoints': kpoints,
+        'settings': settings,
+        'code': inputs['code'].uuid,
+        'parent_folder': inputs['parent_folder'].uuid if 'parent_folder' in inputs else None,
+        'optimizer_state': inputs['optimizer_state'].uuid if 'optimizer_state' in inputs else None,
+        'parser_name': options['parser_name'],
+        'write_gpw': options['write_gpw'],
+        'options': {option: options.get(option, None) for option in RESULT_CACHE_OPTIONS},
+        'tolerance': tolerance,
+    }
+
+    return hashlib.sha256(json.dumps(canonicalize(content), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def find_cached_calculation(key, process_type, max_age=None):
+    """Return the most recent successful calculation with the given key of the result cache, if any.
+
+    :param key: the key of the result cache.
+    :param process_type: the process type of the calculation.
+    :param max_age: optional maximum age in seconds of the calculation, older ones are ignored.
+    :return: the ``CalcJobNode`` or ``None``.
+    """
+    filters = {
+        f'extras.{RESULT_CACHE_EXTRA}': key,
+        'process_type': process_type,
+        'attributes.exit_status': 0,
+    }
+
+    if max_age is not None:
+        filters['ctime'] = {'>': timezone.now() - datetime.timedelta(seconds=max_age)}
+
+    builder = orm.QueryBuilder().append(orm.CalcJobNode, filters=filters, tag='calculation')
+    builder.order_by({'calculation': {'ctime': 'desc'}}).limit(1)
+
+    return builder.first(flat=True)
+
+
+def evict_result_cache(max_entries=None, max_age=None):
+    """Remove calculations from the result cache, by deleting their key.
+
+    The calculations and their outputs are not deleted, they are only no longer used as a source of cached results.
+
+    :param max_entries: optional number of most recent calculations to keep in the cache.
+    :param max_age: optional maximum age in seconds of the calculations to keep in the cache.
+    :return: the number of calculations that were removed from the cache.
+    """
+    filters = {f'extras.{RESULT_CACHE_EXTRA}': {'of_type': 'string'}}
+    builder = orm.QueryBuilder().append(orm.CalcJobNode, filters=filters, project=['*', 'ctime'], tag='calculation')
+    builder.order_by({'calculation': {'ctime': 'desc'}})
+
+    cutoff = timezone.now() - datetime.timedelta(seconds=max_age) if max_age is not None else None
+    evicted = 0
+
+    for index, (node, ctime) in enumerate(builder.all()):
+        if (max_entries is not None and index >= max_entries) or (cutoff is not None and ctime < cutoff):
+            node.base.extras.delete(RESULT_CACHE_EXTRA)
+            evicted += 1
+
+    return evicted
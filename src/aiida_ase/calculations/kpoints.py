@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Reduction of a mesh of k-points by the symmetry of the structure.
+
+The reduced k-points and their weights can be passed as an explicit list to calculators that do not reduce the mesh by
+symmetry themselves. The rotations of the structure are determined with ``spglib``, which is an optional dependency.
+"""
+import numpy
+
+from .structure import get_ase_atoms
+
+
+def get_rotations(structure, symprec=1e-5):
+    """Return the rotations of the space group of a structure, in fractional coordinates of the direct lattice.
+
+    :param structure: the ``StructureData``.
+    :param symprec: the tolerance in Angstrom of ``spglib`` to find the symmetry operations.
+    :return: array of shape ``(N, 3, 3)`` of the integer rotation matrices.
+    :raises ImportError: if ``spglib`` is not installed.
+    """
+    import spglib  # pylint: disable=import-error
+
+    atoms = get_ase_atoms(structure)
+    cell = (numpy.array(atoms.get_cell()), atoms.get_scaled_positions(), atoms.get_atomic_numbers())
+    dataset = spglib.get_symmetry(cell, symprec=symprec)
+
+    return numpy.array(dataset['rotations'], dtype=int)
+
+
+def reduce_kpoints_mesh(mesh, offset, rotations, time_reversal=True):
+    """Return the irreducible k-points of a mesh and their weights.
+
+    Two k-points of the mesh are equivalent if one is mapped onto the other by the transpose of one of the rotations,
+    modulo a reciprocal lattice vector, or also by its opposite with time reversal symmetry. Each irreducible k-point is
+    the first k-point of its star in the order of ``KpointsData.get_kpoints_mesh(print_list=True)``.
+
+    :param mesh: the number of k-points along each reciprocal lattice vector.
+    :param offset: the offset of the mesh in units of the spacing of the mesh, each either 0 or 0.5.
+    :param rotations: array of shape ``(N, 3, 3)`` of the rotations in fractional coordinates of the direct lattice.
+    :param time_reversal: whether the k-points ``k`` and ``-k`` are equivalent.
+    :return: tuple of the array of the irreducible k-points in fractional coordinates and of the array of their weights,
+        which sum to one.
+    :raises ValueError: if an offset is not 0 or 0.5.
+    """
+    mesh = numpy.array(mesh, dtype=int)
+    offset = numpy.array(offset, dtype=float)
+
+    if not numpy.all(numpy.isclose(offset, 0) | numpy.isclose(offset, 0.5)):
+        raise ValueError(f'only offsets of 0 or 0.5 are supported for the symmetry reduction, got {offset.tolist()}.')
+
+    # the k-points in units of half the spacing of the mesh are integers, also with an offset of 0.5
+    indices = numpy.mgrid[0:mesh[0], 0:mesh[1], 0:mesh[2]].reshape(3, -1).T
+    doubled = 2 * indices + numpy.rint(2 * offset).astype(int)
+
+    rotations = numpy.array(rotations, dtype=int).reshape((-1, 3, 3))
+    if time_reversal:
+        rotations = numpy.concatenate([rotations, -rotations])
+
+    # the image of each k-point by each rotation, as index in the mesh, or -1 if it is not a k-point of the mesh
+    lookup = numpy.full(shape=numpy.prod(2 * mesh), fill_value=-1, dtype=int)
+    lookup[numpy.ravel_multi_index(doubled.T, 2 * mesh)] = numpy.arange(len(doubled))
+    images = numpy.einsum('ij,rjk->rik', doubled, rotations) % (2 * mesh)
+    images = lookup[numpy.ravel_multi_index(images.reshape(-1, 3).T, 2 * mesh)].reshape(len(rotations), -1)
+
+    # since the rotations form a group, the smallest index of the images is the same for all k-points of a star
+    stars = numpy.where(images >= 0, images, len(doubled)).min(axis=0)
+    irreducible, counts = numpy.unique(stars, return_counts=True)
+
+    return doubled[irreducible] / (2 * mesh), counts / len(doubled)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Monitors of a running ``AseCalculation`` that kill the job early if it is not going to succeed.
+
+The monitors are registered in the ``aiida.calculations.monitors`` entry point group and are passed in the ``monitors``
+input of the calculation, e.g. ``{'scf': orm.Dict({'entry_point': 'ase.scf', 'minimum_poll_interval': 600})}``. Each
+call reads the end of a log in the remote working directory. If the job is killed, the monitor first writes the marker
+``AseCalculation._MONITOR_FILE_NAME`` with the name of the exit code, which the parsers return after the usual parsing
+of the retrieved files. The logs are not visible while the script runs in the node-local directory of ``scratch_env``.
+"""
+import json
+import os
+import shlex
+import tempfile
+
+from aiida.engine.processes.calcjobs.monitors import CalcJobMonitorResult
+
+from aiida_ase.parsers.gpaw_log import parse_scf_iteration
+from aiida_ase.parsers.utils import parse_optimizer_log
+
+from .ase import AseCalculation
+
+
+def is_stalled(values, window):
+    """Return whether the last ``window`` values did not improve on the smallest of the previous values.
+
+    :param values: the values of a quantity that should decrease, e.g. the density change of the SCF.
+    :param window: the number of last values.
+    """
+    if len(values) <= window:
+        return False
+
+    return min(values[-window:]) >= min(values[:-window])
+
+
+def tail_remote_file(node, transport, filename, nbytes):
+    """Return the lines of the end of a file in the remote working directory of a calculation.
+
+    :param node: the ``CalcJobNode``.
+    :param transport: the open transport to the computer of the calculation.
+    :param filename: the name of the file in the remote working directory.
+    :param nbytes: the number of bytes at the end of the file to read.
+    :return: the list of complete lines, or ``None`` if the file could not be read.
+    """
+    filepath = os.path.join(node.get_remote_workdir(), filename)
+    retval, stdout, _ = transport.exec_command_wait(f'tail -c {int(nbytes)} {shlex.quote(filepath)}')
+
+    if retval != 0:
+        return None
+
+    lines = stdout.splitlines()
+
+    # the first line is incomplete if the file is longer than the part that was read
+    if len(stdout.encode('utf-8')) >= nbytes:
+        lines = lines[1:]
+
+    return lines
+
+
+def kill_job(node, transport, exit_code, message):
+    """Write the marker with the exit code that the parsers return, and return the result that kills the job.
+
+    :param node: the ``CalcJobNode``.
+    :param transport: the open transport to the computer of the calculation.
+    :param exit_code: the label of the exit code of ``AseCalculation``.
+    :param message: the reason of the kill.
+    :return: the ``CalcJobMonitorResult``.
+    """
+    filename = AseCalculation._MONITOR_FILE_NAME  # pylint: disable=protected-access
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        localpath = os.path.join(dirpath, filename)
+        with open(localpath, 'w', encoding='utf-8') as handle:
+            json.dump({'exit_code': exit_code, 'message': message}, handle)
+        transport.putfile(localpath, os.path.join(node.get_remote_workdir(), filename))
+
+    # the exit code of the parser is kept, which returns the one of the marker
+    return CalcJobMonitorResult(message=message, override_exit_code=False)
+
+
+def monitor_scf(node, transport, window=20, nbytes=65536):
+    """Kill the job if the density change of the current SCF cycle did not decrease in the last iterations.
+
+    Only the iterations since the last start of an SCF cycle in the end of the GPAW log are considered, such that each
+    ionic step of a relaxation is monitored separately. An oscillating or diverging SCF is stopped with the exit code
+    ``ERROR_SCF_DIVERGED`` instead of running until ``maxiter`` or the walltime.
+
+    :param node: the ``CalcJobNode``.
+    :param transport: the open transport to the computer of the calculation.
+    :param window: the number of iterations in which the density change should reach a new minimum.
+    :param nbytes: the number of bytes at the end of the log to read.
+    :return: the ``CalcJobMonitorResult`` that kills the job, or ``None``.
+    """
+    lines = tail_remote_file(node, transport, node.get_option('log_filename'), nbytes)
+
+    densities = []
+    for line in lines or []:
+        iteration = parse_scf_iteration(line)
+        if iteration is None:
+            continue
+        number, _, _, _, density = iteration
+        if number == 1:
+            densities = []
+        if density is not None:
+            densities.append(density)
+
+    if not is_stalled(densities, window):
+        return None
+
+    message = (
+        f'the log10 of the density change of the SCF did not decrease below {min(densities[:-window]):.2f} in the '
+        f'last {window} iterations.'
+    )
+    return kill_job(node, transport, 'ERROR_SCF_DIVERGED', message)
+
+
+def monitor_relaxation(node, transport, window=10, nbytes=65536):
+    """Kill the job if the maximum force of the relaxation did not decrease in the last steps of the optimizer.
+
+    The maximum force is read from the steps in the log of the optimizer, also of line search optimizers. A stalled
+    relaxation is stopped with the exit code ``ERROR_RELAX_STALLED``, after which it can be restarted with a fresh
+    optimizer.
+
+    :param node: the ``CalcJobNode``.
+    :param transport: the open transport to the computer of the calculation.
+    :param window: the number of steps in which the maximum force should reach a new minimum.
+    :param nbytes: the number of bytes at the end of the log of the optimizer to read.
+    :return: the ``CalcJobMonitorResult`` that kills the job, or ``None``.
+    """
+    filename = node.get_option('optimizer_stdout')
+    lines = tail_remote_file(node, transport, filename, nbytes)
+
+    forces = parse_optimizer_log('\n'.join(lines or []))['fmax'].tolist()
+
+    if not is_stalled(forces, window):
+        return None
+
+    message = (
+        f'the maximum force of the relaxation did not decrease below {min(forces[:-window]):.4f} in the last '
+        f'{window} steps.'
+    )
+    return kill_job(node, transport, 'ERROR_RELAX_STALLED', message)
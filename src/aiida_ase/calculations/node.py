@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""Node of the ``AseCalculation``, whose hash for the caching of AiiDA includes its inputs in canonical form."""
+from aiida import orm
+from aiida.orm.nodes.process.calculation.calcjob import CalcJobNodeCaching
+
+CANONICAL_INPUTS_HASH_KEY = 'canonical_inputs_hash'
+
+
+class AseCalcJobNodeCaching(CalcJobNodeCaching):
+    """Caching interface of the ``AseCalcJobNode``.
+
+    The hashes of the ``parameters`` and ``settings`` inputs are ignored, since the node stores the hash of their
+    canonical form in the ``canonical_inputs_hash`` attribute, which is part of the hash of the node.
+    """
+
+    _hash_ignored_inputs = [*CalcJobNodeCaching._hash_ignored_inputs, 'parameters', 'settings']
+
+
+class AseCalcJobNode(orm.CalcJobNode):
+    """Node of an ``AseCalculation``, whose hash includes the ``parameters`` and ``settings`` in canonical form."""
+
+    _CLS_NODE_CACHING = AseCalcJobNodeCaching
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Validation of the generated script of an ``AseCalculation`` before the job is submitted.
+
+Errors in the ``parameters``, e.g. a wrong argument of the calculator or a module in ``extra_imports`` that does not
+exist, otherwise only show when the job starts, after it waited in the queue. The checks of increasing cost are:
+
+* ``compile``: the script is compiled, which finds syntax errors, e.g. in ``pre_lines`` or in literal arguments.
+* ``imports``: the import lines of the script are executed in a local Python interpreter.
+* ``construct``: the structure is read and the calculator constructed in a local Python interpreter, which finds wrong
+  arguments of the calculator, without computing anything.
+
+The last two checks run in a subprocess, in a copy of the folder with the input files, and are only meaningful if the
+interpreter has the same packages as the environment in which the job runs. Since they would block the daemon, they are
+only supported in a dry run, see ``validate_inputs`` of the ``AseCalculation``, which runs in the interpreter of the
+user before the calculation is submitted.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import textwrap
+
+PREFLIGHT_LEVELS = ('none', 'compile', 'imports', 'construct')
+
+PREFLIGHT_FILE_NAME = 'aiida_preflight.py'
+
+
+def compile_script(script, filename):
+    """Compile a script and raise if it has a syntax error.
+
+    :param script: the content of the script.
+    :param filename: the filename of the script, used in the error message.
+    :raises ValueError: if the script has a syntax error.
+    """
+    try:
+        compile(script, filename, 'exec')
+    except SyntaxError as exception:
+        line = (exception.text or '').strip()
+        raise ValueError(
+            f'the generated script `{filename}` has a syntax error at line {exception.lineno}: {exception.msg}: {line}'
+        ) from exception
+
+
+def get_import_check_script(import_lines):
+    """Return a script that executes each import line and exits with an error listing the ones that failed.
+
+    :param import_lines: the import lines of the generated script.
+    :return: the script as a string.
+    """
+    return textwrap.dedent(
+        f"""\
+        import sys
+
+        failed = []
+        for line in {list(import_lines)!r}:
+            try:
+                exec(line, {{}})
+            except Exception as exception:  # any exception of the imported module makes the job fail the same way
+                failed.append(f'`{{line}}`: {{exception!r}}')
+
+        if failed:
+            sys.stderr.write('the import lines failed: ' + '; '.join(failed) + '\\n')
+            sys.exit(1)
+
+        """
+    )
+
+
+def run_script(script, directory, python, timeout):
+    """Run a script with a Python interpreter in a temporary copy of a directory and raise if it fails.
+
+    :param script: the content of the script.
+    :param directory: the directory with the files that the script reads, which is copied.
+    :param python: the Python interpreter.
+    :param timeout: the maximum duration in seconds of the script.
+    :raises ValueError: if the script fails or does not finish in time.
+    """
+    with tempfile.TemporaryDirectory() as dirpath:
+        workdir = os.path.join(dirpath, 'preflight')
+        shutil.copytree(directory, workdir)
+
+        with open(os.path.join(workdir, PREFLIGHT_FILE_NAME), 'w', encoding='utf-8') as handle:
+            handle.write(script)
+
+        try:
+            process = subprocess.run([python, PREFLIGHT_FILE_NAME],
+                                     cwd=workdir,
+                                     capture_output=True,
+                                     text=True,
+                                     timeout=timeout,
+                                     check=False)
+        except subprocess.TimeoutExpired as exception:
+            raise ValueError(f'the validation of the script did not finish within {timeout} seconds.') from exception
+        except OSError as exception:
+            raise ValueError(f'the validation of the script could not run `{python}`: {exception}') from exception
+
+    if process.returncode != 0:
+        lines = process.stderr.strip().splitlines()
+        raise ValueError(f"the validation of the script failed: {lines[-1] if lines else 'no error message'}")
+
+
+def validate_script(*, level, script, filename, import_lines, setup_script, directory, python, timeout):
+    """Validate the generated script up to the given level of ``PREFLIGHT_LEVELS``.
+
+    :param level: the level of the validation.
+    :param script: the content of the generated script.
+    :param filename: the filename of the generated script.
+    :param import_lines: the import lines of the generated script.
+    :param setup_script: the part of the generated script that reads the structure and constructs the calculator.
+    :param directory: the directory with the input files of the script.
+    :param python: the Python interpreter for the ``imports`` and ``construct`` levels.
+    :param timeout: the maximum duration in seconds of the ``imports`` and ``construct`` levels.
+    :raises ValueError: if the level is not supported or the script is not valid.
+    """
+    if level not in PREFLIGHT_LEVELS:
+        raise ValueError(f"unsupported preflight level `{level}`, use one of {', '.join(PREFLIGHT_LEVELS)}.")
+
+    if level == 'none':
+        return
+
+    compile_script(script, filename)
+
+    if level == 'compile':
+        return
+
+    check_script = get_import_check_script(import_lines)
+
+    if level == 'construct':
+        check_script += '\n'.join(import_lines) + '\n\n' + setup_script
+
+    run_script(check_script, directory, python, timeout)
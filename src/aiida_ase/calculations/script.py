@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""Helpers that generate the parts of the script of the ``AseCalculation``.
+
+The sidecar files of large arrays and the snippets of the script, which are returned as strings that are inserted in
+the script written by ``prepare_for_submission``.
+"""
+import textwrap
+
+
+def write_sidecar(folder, filename, array):
+    """Write an array to a sidecar file and return the expression of the script that loads it as a list.
+
+    :param folder: the folder in which the sidecar file is written.
+    :param filename: the filename of the sidecar file.
+    :param array: the array.
+    :return: the expression as a string.
+    """
+    import numpy
+
+    with folder.open(filename, 'wb') as handle:
+        numpy.save(handle, numpy.asarray(array))
+
+    return f"numpy.load('{filename}').tolist()"
+
+
+def get_sidecar_array(value, threshold):
+    """Return a calculator argument as an array if it should be written to a sidecar file.
+
+    :param value: the value of the calculator argument.
+    :param threshold: the minimum number of elements of the array.
+    :return: the numeric array, or ``None`` if the value is not a list of numbers or has fewer elements.
+    """
+    import numpy
+
+    if not isinstance(value, (list, tuple)):
+        return None
+
+    try:
+        array = numpy.asarray(value)
+    except ValueError:  # nested lists of different lengths
+        return None
+
+    if array.dtype.kind not in 'biuf' or array.size < threshold:
+        return None
+
+    return array
+
+
+def get_kpoints_argsstr(folder, sidecar_filename, points, weights=None, weights_arg=None):
+    """Return the arguments of the calculator for an explicit list of k-points, which are written to sidecar files.
+
+    The k-points, in fractional coordinates, are written to a sidecar file. Their weights are written to another one
+    and passed to the argument of the calculator named by ``weights_arg``, if they are not all equal, since the
+    calculator would otherwise treat the k-points as equivalent.
+
+    :param folder: the folder in which the sidecar files are written.
+    :param sidecar_filename: the name of the sidecar files, with a placeholder for the name of the argument.
+    :param points: the k-points in fractional coordinates.
+    :param weights: the weights of the k-points, or ``None`` if they are all equal.
+    :param weights_arg: the argument of the calculator that takes the weights.
+    :return: the arguments as a string.
+    :raises ValueError: if the weights are not all equal and ``weights_arg`` is not defined.
+    """
+    import numpy
+
+    kpts_argsstr = f"kpts={write_sidecar(folder, sidecar_filename.format('kpts'), points)}"
+
+    if weights is not None and not numpy.allclose(weights, weights[0]):
+        if weights_arg is None:
+            raise ValueError(
+                'the k-points have different weights: set the `kpoints_weights_arg` option to the argument of the '
+                'calculator that takes them.'
+            )
+        weights = numpy.asarray(weights, dtype=float) / numpy.sum(weights)
+        kpts_argsstr += f', {weights_arg}={write_sidecar(folder, sidecar_filename.format(weights_arg), weights)}'
+
+    return kpts_argsstr
+
+
+def get_checkpoint_script(staged):
+    """Return the lines of the script that define the ``Checkpoint`` class, which writes the GPW file of the calculator.
+
+    The GPW file is written to a temporary file, which is renamed once it is complete, such that a job that is killed
+    while writing does not leave a truncated file. The previous files are kept up to the given number, with the index
+    before the extension. The serialization itself is synchronous, since it reads the state of the calculator and is
+    collective under MPI, but the rotation and the copy back from the scratch directory can run in a background thread.
+
+    :param staged: whether the script runs in a scratch directory, from which the GPW file is copied back.
+    :return: the lines of the script.
+    """
+    stage_out = '        stage_out([self.fname])\n' if staged else ''
+
+    return textwrap.dedent(
+        """\
+        class Checkpoint:
+            def __init__(self, fname, keep=1, background=False):
+                self.fname = fname
+                self.keep = keep
+                self.background = background
+                self.last = time.time()
+                self.thread = None
+
+            def write(self, wait=False):
+                self.wait()
+                root, ext = os.path.splitext(self.fname)
+                calculator.write(f'{root}.tmp{ext}')
+                self.last = time.time()
+                if self.background:
+                    self.thread = threading.Thread(target=self.rotate)
+                    self.thread.start()
+                else:
+                    self.rotate()
+                if wait:
+                    self.wait()
+
+            def write_if_due(self, interval):
+                if time.time() - self.last >= interval:
+                    self.write()
+
+            def wait(self):
+                if self.thread is not None:
+                    self.thread.join()
+                    self.thread = None
+
+            def rotate(self):
+                if world.rank == 0:
+                    root, ext = os.path.splitext(self.fname)
+                    names = [self.fname] + [f'{root}.{index}{ext}' for index in range(1, self.keep)]
+                    for older, newer in zip(names[:0:-1], names[-2::-1]):
+                        if os.path.exists(newer):
+                            os.replace(newer, older)
+                    os.replace(f'{root}.tmp{ext}', self.fname)
+        """
+    ) + stage_out + '\n'
+
+
+def get_scratch_staging_script(variable, stage_in, stage_out):
+    """Return the lines of the script that move it to a node-local scratch directory and copy files back on exit.
+
+    The entries of the working directory are symlinked in the scratch directory, except for the files in ``stage_in``,
+    which are copied because the script writes to them. Only the master rank copies files back to the working directory,
+    and only those that match the patterns of ``stage_out``, such that no other file of the scratch directory is written
+    to the shared filesystem. If the environment variable is not set, the script runs in the working directory.
+
+    :param variable: the name of the environment variable with the scratch directory.
+    :param stage_in: the filenames of the input files to copy to the scratch directory.
+    :param stage_out: the filenames or glob patterns of the files to copy back to the working directory.
+    :return: the lines of the script.
+    """
+    return textwrap.dedent(
+        f"""
+        workdir = os.getcwd()
+        scratch = None
+        if os.environ.get('{variable}'):
+            scratch = tempfile.mkdtemp(prefix='aiida-', dir=os.environ['{variable}'])
+            for name in os.listdir(workdir):
+                if name in {stage_in!r}:
+                    shutil.copy2(os.path.join(workdir, name), os.path.join(scratch, name))
+                else:
+                    os.symlink(os.path.join(workdir, name), os.path.join(scratch, name))
+            os.chdir(scratch)
+
+
+        def stage_out(patterns):
+            if scratch is None or world.rank != 0:
+                return
+            for pattern in patterns:
+                for filename in glob.glob(os.path.join(scratch, pattern)):
+                    if os.path.isfile(filename) and not os.path.islink(filename):
+                        shutil.copy2(filename, os.path.join(workdir, os.path.relpath(filename, scratch)))
+
+
+        def leave_scratch():
+            if scratch is None:
+                return
+            stage_out({stage_out!r})
+            os.chdir(workdir)
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+        atexit.register(leave_scratch)
+
+        """
+    )
+
+
+def get_log_digest_script(log_filename, digest_filename, right_open):
+    """Return the lines of the script that write a digest of the log of GPAW when the script exits.
+
+    The digest contains the names of the error signatures found in the log, see ``ERROR_SIGNATURES``, and the results of
+    the last step as they are read from the log by the ``GpawParser``, such that the log itself need not be retrieved.
+
+    :param log_filename: the filename of the log.
+    :param digest_filename: the filename of the digest.
+    :param right_open: the name of the function with which files are opened for writing.
+    :return: the lines of the script.
+    """
+    from aiida_ase.parsers.gpaw_log import ERROR_SIGNATURES
+
+    return textwrap.dedent(
+        f"""
+        def write_log_digest():
+            sys.stdout.flush()
+            digest = {{'errors': [], 'parameters': None}}
+            try:
+                with open('{log_filename}') as handle:
+                    for line in handle:
+                        for name, signature in {ERROR_SIGNATURES!r}.items():
+                            if signature in line.lower() and name not in digest['errors']:
+                                digest['errors'].append(name)
+                atoms_log = ase.io.read('{log_filename}', index=-1, format='gpaw-out')
+                results_log = atoms_log.calc.results
+                digest['parameters'] = {{
+                    'energy': atoms_log.get_potential_energy(),
+                    'energy_contributions': atoms_log.calc.energy_contributions,
+                    'forces': atoms_log.get_forces(),
+                    'stress': results_log.get('stress', None),
+                    'magmoms': results_log.get('magmoms', None),
+                    'dipole': results_log.get('dipole', None),
+                    'pbc': atoms_log.get_pbc(),
+                    'fermi_energy': atoms_log.calc.eFermi,
+                    'eigenvalues': atoms_log.calc.get_eigenvalues(),
+                }}
+            except Exception:
+                pass
+            with {right_open}('{digest_filename}', 'w') as f:
+                json.dump(digest, f, default=lambda value: numpy.asarray(value).tolist())
+
+
+        atexit.register(write_log_digest)
+
+        """
+    )
+
+
+def get_profile_script(timings_filename, right_open):
+    """Return the part of the script that defines the timers of the phases and the steps of the script.
+
+    The timers are started before the imports, such that their duration is recorded as well.
+
+    :param timings_filename: the name of the file in which the timings are written.
+    :param right_open: the name of the function with which the file is opened.
+    :return: the part of the script.
+    """
+    return textwrap.dedent(
+        f"""\
+        import resource
+        import time
+
+        timings = {{'phases': {{}}, 'peak_rss': {{}}, 'steps': []}}
+        clock = {{'phase': time.perf_counter()}}
+
+
+        def record_timing(phase):
+            now = time.perf_counter()
+            timings['phases'][phase] = now - clock['phase']
+            timings['peak_rss'][phase] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            clock['phase'] = now
+
+
+        def record_step():
+            now = time.perf_counter()
+            timings['steps'].append(now - clock.get('step', clock['phase']))
+            clock['step'] = now
+
+
+        def write_timings():
+            timings['total'] = sum(timings['phases'].values())
+            with {right_open}('{timings_filename}', 'w') as f:
+                json.dump(timings, f)
+
+
+        """
+    )
+
+
+def get_walltime_script(run_args, walltime_limit, marker_filename, right_open, *, structure_filename, profile, gpw):
+    """Return the part of the script that runs the optimizer and stops it before the walltime.
+
+    The optimizer is stopped if the slowest step so far would not fit in the remaining time, after which the current
+    structure, the GPW file and a marker with the elapsed time, the number of steps and the slowest step are written.
+
+    :param run_args: the arguments of ``optimizer.run`` as a string.
+    :param walltime_limit: the time in seconds after the start of the script before which the optimizer should stop.
+    :param marker_filename: the name of the file that marks that the optimizer was stopped.
+    :param right_open: the name of the function with which the marker is opened.
+    :param structure_filename: the name of the file in which the current structure is written.
+    :param profile: whether the duration of the optimizer is recorded.
+    :param gpw: whether the GPW file is written by the ``checkpoint``.
+    :return: the part of the script.
+    """
+    script = textwrap.dedent(
+        f"""\
+        walltime_limit = {walltime_limit}
+        step_start = time.time()
+        step_time = 0.0
+        out_of_walltime = False
+        for converged in optimizer.irun({run_args}):
+            step_time = max(step_time, time.time() - step_start)
+            step_start = time.time()
+            if not converged and step_start - walltime_start + step_time > walltime_limit:
+                out_of_walltime = True
+                break
+
+        """
+    )
+    if profile:
+        script += "record_timing('optimizer')\n"
+    script += 'if out_of_walltime:\n'
+    script += f"    atoms.write('{structure_filename}')\n"
+    if gpw:
+        script += '    checkpoint.write(wait=True)\n'
+    script += f"    with {right_open}('{marker_filename}', 'w') as f:\n"
+    script += "        json.dump({'elapsed': time.time() - walltime_start, 'steps': optimizer.nsteps, "
+    script += "'step_time': step_time}, f)\n"
+    if profile:
+        script += '    write_timings()\n'
+    script += '    raise SystemExit(0)\n'
+
+    return script
+
+
+def get_results_script(results_script, results_format, batch):
+    """Return the part of the script that collects the results, with the arrays converted for the results format.
+
+    With the ``npz`` format the arrays are moved out of the results, since they are written in binary format, otherwise
+    they are converted to lists. In a batched calculation, the same calculator is reused for all structures and the
+    results are collected under the label of the structure, which also prefixes the names of the arrays.
+
+    :param results_script: the part of the script that fills the ``results`` of a structure.
+    :param results_format: the format of the results, ``json`` or ``npz``.
+    :param batch: whether the calculation is batched.
+    :return: the part of the script.
+    """
+    if results_format == 'npz':
+        array_key = "f'{label}__{k}'" if batch else 'k'
+        results_script += 'for k,v in list(results.items()):\n'
+        results_script += '    if isinstance(v,(numpy.matrix,numpy.ndarray)):\n'
+        results_script += f'        arrays[{array_key}] = numpy.asarray(results.pop(k))\n'
+    else:
+        results_script += 'for k,v in results.items():\n'
+        results_script += '    if isinstance(results[k],(numpy.matrix,numpy.ndarray)):\n'
+        results_script += '        results[k] = results[k].tolist()\n'
+
+    script = 'arrays = {}\n' if results_format == 'npz' else ''
+
+    if not batch:
+        return script + results_script
+
+    script += 'all_results = {}\n'
+    script += 'for label, atoms in zip(labels, images):\n'
+    script += '    atoms.calc = calculator\n'
+    script += textwrap.indent(results_script, '    ')
+    script += '    all_results[label] = results\n'
+    script += 'results = all_results\n'
+
+    return script
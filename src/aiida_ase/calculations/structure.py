@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Conversion between ``StructureData`` and ``ase.Atoms`` through arrays.
+
+``StructureData.get_ase`` and ``StructureData(ase=...)`` convert the structure site by site, and the former recomputes
+the tags of all kinds for every site, which takes minutes for supercells with 10^5 atoms. The functions of this module
+convert the kinds once and the sites as arrays, and give the same result for the structures they support. Structures
+with alloys or vacancies, and atoms of the same element and tag with different masses, are delegated to ``aiida-core``.
+"""
+from aiida import orm
+import numpy
+
+
+def get_ase_atoms(structure):
+    """Return the ``ase.Atoms`` of a ``StructureData``, equivalent to ``structure.get_ase()``.
+
+    :param structure: the ``StructureData``.
+    :return: the ``ase.Atoms``.
+    :raises ValueError: if a kind is an alloy or has vacancies, like ``get_ase``.
+    """
+    import ase
+
+    kinds = structure.kinds
+    sites = structure.base.attributes.get('sites', [])
+
+    if any(kind.is_alloy or kind.has_vacancies for kind in kinds):
+        return structure.get_ase()
+
+    # the symbol, mass and tag of each kind are those of an atom of that kind, which are determined only once per kind
+    species = {}
+    for kind in kinds:
+        atom = orm.Site(kind_name=kind.name, position=(0., 0., 0.)).get_ase(kinds=kinds)
+        species[kind.name] = (atom.symbol, atom.mass, atom.tag)
+
+    names = [site['kind_name'] for site in sites]
+    symbols = [species[name][0] for name in names]
+    masses = [species[name][1] for name in names]
+    tags = [species[name][2] for name in names]
+    positions = numpy.array([site['position'] for site in sites], dtype=float).reshape(-1, 3)
+
+    atoms = ase.Atoms(symbols=symbols, positions=positions, cell=structure.cell, pbc=structure.pbc, masses=masses)
+    if any(tags):
+        atoms.set_tags(tags)
+
+    return atoms
+
+
+def get_structure_data(atoms):
+    """Return the ``StructureData`` of an ``ase.Atoms``, equivalent to ``StructureData(ase=atoms)``.
+
+    :param atoms: the ``ase.Atoms``.
+    :return: the unstored ``StructureData``.
+    """
+    symbols = atoms.get_chemical_symbols()
+    masses = atoms.get_masses()
+    tags = atoms.get_tags()
+
+    kinds = {}
+    names = []
+    for symbol, mass, tag in zip(symbols, masses.tolist(), tags.tolist()):
+        name = f'{symbol}{tag}' if tag != 0 else symbol
+        if kinds.setdefault(name, (symbol, mass)) != (symbol, mass):
+            # the same kind name for atoms with different masses is resolved by ``aiida-core``
+            return orm.StructureData(ase=atoms)
+        names.append(name)
+
+    structure = orm.StructureData(cell=atoms.cell.tolist(), pbc=atoms.pbc.tolist())
+    for name, (symbol, mass) in kinds.items():
+        structure.append_kind(orm.Kind(name=name, symbols=symbol, mass=mass))
+
+    positions = atoms.get_positions().tolist()
+    sites = [{'kind_name': name, 'position': position} for name, position in zip(names, positions)]
+    structure.base.attributes.set('sites', sites)
+
+    return structure
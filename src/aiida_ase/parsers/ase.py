@@ -2,14 +2,21 @@
 """Parser implementation for the ``AseCalculation``."""
 import json
 
-from aiida import parsers, plugins
-from ase.io import read
-import numpy
+from aiida import orm, parsers
 
-Dict = plugins.DataFactory('core.dict')
-ArrayData = plugins.DataFactory('core.array')
-StructureData = plugins.DataFactory('core.structure')
-AseCalculation = plugins.CalculationFactory('ase.ase')
+from aiida_ase.calculations.ase import AseCalculation
+
+from .utils import (
+    create_array_data,
+    create_gpw_folder,
+    read_monitor_kill,
+    read_optimizer_log,
+    read_optimizer_state,
+    read_output_structure,
+    read_timings,
+    read_trajectory_data,
+    split_batch_results,
+)
 
 
 class AseParser(parsers.Parser):
@@ -22,18 +29,40 @@ class AseParser(parsers.Parser):
         # check what is inside the folder
         list_of_files = retrieved.base.repository.list_object_names()
 
+        # timings of the phases of the script, if it was profiled
+        timings = read_timings(retrieved)
+        if timings is not None:
+            self.out('timings', timings)
+
+        # reference to the GPW file left on the remote, also for an incomplete calculation that may have written it
+        gpw_folder = create_gpw_folder(self.node)
+        if gpw_folder is not None:
+            self.out('gpw_folder', gpw_folder)
+
+        # a relaxation stopped before the walltime only wrote the current structure and trajectory
+        if AseCalculation._WALLTIME_FILE_NAME in list_of_files:  # pylint: disable=protected-access
+            self._parse_relaxation(list_of_files)
+            self.logger.error('The relaxation was stopped before reaching the walltime')
+            return self.exit_codes.ERROR_OUT_OF_WALLTIME
+
+        # a job killed early by a monitor only wrote the steps of the relaxation that were completed
+        monitor_kill = read_monitor_kill(retrieved)
+        if monitor_kill is not None:
+            self._parse_relaxation(list_of_files)
+            self.logger.error(f"The job was killed by a monitor: {monitor_kill['message']}")
+            return self.exit_codes[monitor_kill['exit_code']]
+
         # at least the stdout should exist
         if AseCalculation._OUTPUT_FILE_NAME not in list_of_files:  # pylint: disable=protected-access
             self.logger.error('Standard output not found')
             return self.exit_codes.ERROR_OUTPUT_FILES
 
-        # output structure
-        if AseCalculation._output_aseatoms in list_of_files:  # pylint: disable=protected-access
-            with retrieved.base.repository.open(AseCalculation._output_aseatoms, 'r') as handle:  # pylint: disable=protected-access
-                atoms = read(handle, format='json')
-                structure = StructureData(ase=atoms)
-                self.out('structure', structure)
+        self._parse_relaxation(list_of_files)
+        self._parse_results()
 
+    def _parse_results(self):
+        """Attach the results of the calculation and the warnings of the stderr."""
+        retrieved = self.retrieved
         filename_stdout = self.node.base.attributes.all.get('output_filename')
 
         # load the results dictionary
@@ -41,10 +70,13 @@ class AseParser(parsers.Parser):
             json_params = json.load(handle)
 
         # extract arrays from json_params
-        dictionary_array = {}
-        for k, v in list(json_params.items()):
-            if isinstance(v, (list, tuple)):
-                dictionary_array[k] = json_params.pop(k)
+        if 'structures' in self.node.inputs:
+            json_params, dictionary_array = split_batch_results(json_params)
+        else:
+            dictionary_array = {}
+            for k, v in list(json_params.items()):
+                if isinstance(v, (list, tuple)):
+                    dictionary_array[k] = json_params.pop(k)
 
         # look at warnings
         warnings = []
@@ -54,13 +86,36 @@ class AseParser(parsers.Parser):
             warnings = [errors]
         json_params['warnings'] = warnings
 
-        if dictionary_array:
-            array_data = ArrayData()
-            for k, v in dictionary_array.items():
-                array_data.set_array(k, numpy.array(v))
+        array_data = create_array_data(retrieved, dictionary_array)
+        if array_data.get_arraynames():
             self.out('array', array_data)
 
         if json_params:
-            self.out('parameters', Dict(json_params))
+            self.out('parameters', orm.Dict(json_params))
+
+    def _parse_relaxation(self, list_of_files):
+        """Attach the output structure and the trajectory of a relaxation, if they were retrieved.
+
+        :param list_of_files: the names of the retrieved files.
+        """
+        # output structure
+        structure = read_output_structure(self.retrieved, self.node)
+        if structure is not None:
+            self.out('structure', structure)
+
+        # binary trajectory written by the optimizer
+        if AseCalculation._TRAJECTORY_FILE_NAME in list_of_files:  # pylint: disable=protected-access
+            with self.retrieved.base.repository.open(AseCalculation._TRAJECTORY_FILE_NAME, 'rb') as handle:  # pylint: disable=protected-access
+                trajectory = read_trajectory_data(handle)
+            if trajectory is not None:
+                self.out('trajectory', trajectory)
+
+        # state of the optimizer, to continue the relaxation
+        optimizer_state = read_optimizer_state(self.retrieved)
+        if optimizer_state is not None:
+            self.out('optimizer_state', optimizer_state)
 
-        return
+        # convergence of each step of the optimizer
+        optimizer_log = read_optimizer_log(self.retrieved)
+        if optimizer_log is not None:
+            self.out('optimizer_log', optimizer_log)
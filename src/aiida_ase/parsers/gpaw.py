@@ -2,16 +2,27 @@
 """Parser implementation for the ``AseCalculation``."""
 import json
 import math
+import os
 
-from aiida import parsers, plugins
-from ase.io import read
+from aiida import orm, parsers
 import numpy
 
-Dict = plugins.DataFactory('core.dict')
-ArrayData = plugins.DataFactory('core.array')
-StructureData = plugins.DataFactory('core.structure')
-TrajectoryData = plugins.DataFactory('core.array.trajectory')
-AseCalculation = plugins.CalculationFactory('ase.ase')
+from aiida_ase.calculations.ase import AseCalculation
+
+from .gpaw_log import ScfTelemetry, read_gpaw_log
+from .utils import (
+    create_array_data,
+    create_gpw_folder,
+    create_trajectory_data,
+    read_log_digest,
+    read_monitor_kill,
+    read_optimizer_log,
+    read_optimizer_state,
+    read_output_structure,
+    read_timings,
+    read_trajectory_data,
+    split_batch_results,
+)
 
 
 def check_paw_missing(lines):
@@ -45,12 +56,12 @@ def create_output_parameters(atoms_log, json_params):
 
 
 def store_to_trajectory_data(all_ase_traj):
-    """Store ase atoms object into a TrajectoryFile."""
-    all_aiida_atoms = []
-    for atoms in all_ase_traj:
-        structure = StructureData(ase=atoms)
-        all_aiida_atoms.append(structure)
-    return TrajectoryData(all_aiida_atoms)
+    """Store ase atoms object into a TrajectoryFile.
+
+    The positions and cells are stacked directly, without creating a ``StructureData`` for each frame, and the energies,
+    forces and stress of the frames are stored as additional arrays, see ``create_trajectory_data``.
+    """
+    return create_trajectory_data(all_ase_traj)
 
 
 class GpawParser(parsers.Parser):
@@ -65,34 +76,102 @@ class GpawParser(parsers.Parser):
         # check if it was a relaxation
         optimizer = self.node.inputs.parameters.get_dict().pop('optimizer', None)
 
+        # the stderr is read once, both to check for errors and to report the warnings
+        stderr = ''
+        if '_scheduler-stderr.txt' in list_of_files:
+            with self.retrieved.base.repository.open('_scheduler-stderr.txt', 'r') as handle:
+                stderr = handle.read()
+
+        # the log is parsed at most once, when it is first needed, instead of the digest if the script did not write one
+        self._log_images = None
+        self._log_errors = set()
+        self._scf_telemetry = None
+        self._retrieved_temporary_folder = kwargs.get('retrieved_temporary_folder', None)
+        digest = read_log_digest(self.retrieved)
+        digest_errors = digest['errors'] if digest is not None else []
+
+        # the state of the optimizer is attached also for an incomplete relaxation, such that it can be continued
+        optimizer_state = read_optimizer_state(self.retrieved)
+        if optimizer_state is not None:
+            self.out('optimizer_state', optimizer_state)
+
+        # the convergence of each step of the optimizer, also for an incomplete relaxation
+        optimizer_log = read_optimizer_log(self.retrieved)
+        if optimizer_log is not None:
+            self.out('optimizer_log', optimizer_log)
+
+        # the iterations of the SCF cycles are extracted in the same pass over the log as the ionic steps, also if the
+        # log does not contain a complete ionic step, e.g. because the first SCF did not converge
+        scf_telemetry = self.node.get_option('scf_telemetry')
+        if scf_telemetry in ('summary', 'full'):
+            try:
+                self._read_log()
+            except OSError:
+                pass
+            if self._scf_telemetry is not None and self._scf_telemetry.rows:
+                array_data = orm.ArrayData()
+                for name, array in self._scf_telemetry.get_arrays(summary=scf_telemetry == 'summary').items():
+                    array_data.set_array(name, array)
+                self.out('scf_telemetry', array_data)
+
+        # timings of the phases of the script, if it was profiled
+        timings = read_timings(self.retrieved)
+        if timings is not None:
+            self.out('timings', timings)
+
+        # reference to the GPW file left on the remote, also for an incomplete calculation that may have written it
+        gpw_folder = create_gpw_folder(self.node)
+        if gpw_folder is not None:
+            self.out('gpw_folder', gpw_folder)
+
         # output json file
+        if AseCalculation._WALLTIME_FILE_NAME in list_of_files:  # pylint: disable=protected-access
+            # The relaxation was stopped cleanly before the walltime, after writing the current structure
+            self.logger.error('The relaxation was stopped before reaching the walltime')
+            structure = read_output_structure(self.retrieved, self.node)
+            if structure is not None:
+                self.out('structure', structure)
+            self.outputs.trajectory = self._get_trajectory(list_of_files)
+            return self.exit_codes.ERROR_OUT_OF_WALLTIME
+
+        monitor_kill = read_monitor_kill(self.retrieved)
+        if monitor_kill is not None:
+            # The job was killed early by a monitor, the steps of a relaxation that were completed are kept
+            self.logger.error(f"The job was killed by a monitor: {monitor_kill['message']}")
+            if optimizer is not None:
+                try:
+                    self.outputs.trajectory = self._get_trajectory(list_of_files)
+                except Exception:  # pylint: disable=broad-except
+                    self.logger.error('First relaxation step not completed')
+            return self.exit_codes[monitor_kill['exit_code']]
+
         if AseCalculation._OUTPUT_FILE_NAME in list_of_files:  # pylint: disable=protected-access
             # This calculation is likely to have been alright
             pass
-        elif AseCalculation._TXT_OUTPUT_FILE_NAME in list_of_files:  # pylint: disable=protected-access
+        elif AseCalculation._TXT_OUTPUT_FILE_NAME in list_of_files or digest is not None:  # pylint: disable=protected-access
             # An output structure was not found but there is a txt file
             # Probably helpful for restarts
             self.logger.error('Output results was not found, inspecting log file')
-            # Checking for possible errors common to all calculations
-            with self.retrieved.base.repository.open('_scheduler-stderr.txt', 'r') as handle:
-                lines = handle.readlines()
-                if check_paw_missing(lines):
-                    self.logger.error('Could not find paw potentials')
-                    return self.exit_codes.ERROR_PAW_NOT_FOUND
-                if check_attribute_error(lines):
-                    self.logger.error('AttributeError in GPAW')
-                    return self.exit_codes.ERROR_ATTRIBUTE_ERROR
+            # Checking for possible errors common to all calculations, also in the log if there is no digest
+            lines = stderr.splitlines()
+            log_errors = set(digest_errors) | (self._read_log_errors() if digest is None else self._log_errors)
+            if check_paw_missing(lines) or 'paw_not_found' in log_errors:
+                self.logger.error('Could not find paw potentials')
+                return self.exit_codes.ERROR_PAW_NOT_FOUND
+            if check_attribute_error(lines) or 'attribute_error' in log_errors:
+                self.logger.error('AttributeError in GPAW')
+                return self.exit_codes.ERROR_ATTRIBUTE_ERROR
 
             if optimizer is not None:
                 # This is a relaxation calculation that did not complete
                 # try to get all the structures that are available
                 try:
-                    with self.retrieved.base.repository.open(
-                        self.node.base.attributes.get('log_filename'), 'r'
-                    ) as handle:
-                        all_ase_traj = read(handle, index=':', format='gpaw-out')
-                    trajectory = store_to_trajectory_data(all_ase_traj)
+                    trajectory = self._get_trajectory(list_of_files)
                     self.outputs.trajectory = trajectory
+                    # the scheduler killed the job at the walltime, before the script could stop the relaxation
+                    if self.node.exit_status == self.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME.status:
+                        self.logger.error('The relaxation was killed by the scheduler at the walltime')
+                        return self.exit_codes.ERROR_OUT_OF_WALLTIME
                     return self.exit_codes.ERROR_RELAX_NOT_COMPLETE
                 except Exception:  # pylint: disable=broad-except
                     # If it made it to here then the error is due to the SCF not completing
@@ -110,21 +189,34 @@ class GpawParser(parsers.Parser):
         # Check if output structure is needed
         if optimizer is not None:
             # If we are here the calculation did complete sucessfully
-            with self.retrieved.base.repository.open(AseCalculation._output_aseatoms, 'r') as handle:  # pylint: disable=protected-access
-                atoms = read(handle, format='json')
-                self.out('structure', StructureData(ase=atoms))
+            structure = read_output_structure(self.retrieved, self.node)
+            if structure is None:
+                return self.exit_codes.ERROR_OUTPUT_FILES
+            self.out('structure', structure)
             # Store the trajectory as well
-            with self.retrieved.base.repository.open(self.node.base.attributes.get('log_filename'), 'r') as handle:
-                all_ase_traj = read(handle, index=':', format='gpaw-out')
-            self.outputs.trajectory = store_to_trajectory_data(all_ase_traj)
+            self.outputs.trajectory = self._get_trajectory(list_of_files)
         # load the results dictionary
         with self.retrieved.base.repository.open(AseCalculation._OUTPUT_FILE_NAME, 'r') as handle:  # pylint: disable=protected-access
             json_params = json.load(handle)
 
-        # get the relavent data from the log file for the final structure
-        with self.retrieved.base.repository.open(self.node.base.attributes.get('log_filename'), 'r') as handle:
-            atoms_log = read(handle, format='gpaw-out')
-        create_output_parameters(atoms_log, json_params)
+        # a batched calculation runs one SCF per structure, so only the results file is parsed
+        if 'structures' in self.node.inputs:
+            json_params, dictionary_array = split_batch_results(json_params)
+            json_params['warnings'] = [stderr] if stderr else []
+
+            array_data = create_array_data(self.retrieved, dictionary_array)
+            if array_data.get_arraynames():
+                self.out('array', array_data)
+
+            self.out('parameters', orm.Dict(json_params))
+            return
+
+        # get the relavent data from the log file for the final structure, unless it was extracted in the digest
+        if digest is not None and digest['parameters'] is not None:
+            json_params.update(digest['parameters'])
+        else:
+            atoms_log = self._read_log()[-1]
+            create_output_parameters(atoms_log, json_params)
 
         # Check that the parameters are not inf or nan
         if math.isnan(json_params['fermi_energy']) or math.isinf(json_params['fermi_energy']):
@@ -132,10 +224,8 @@ class GpawParser(parsers.Parser):
             return self.exit_codes.ERROR_FERMI_LEVEL_INF
 
         # look at warnings
-        with self.retrieved.base.repository.open('_scheduler-stderr.txt', 'r') as handle:
-            errors = handle.read()
-        if errors:
-            json_params['warnings'] = [errors]
+        if stderr:
+            json_params['warnings'] = [stderr]
 
         # extract arrays from json_params
         dictionary_array = {}
@@ -143,13 +233,57 @@ class GpawParser(parsers.Parser):
             if isinstance(v, (list, tuple, numpy.ndarray)):
                 dictionary_array[k] = json_params.pop(k)
 
-        if dictionary_array:
-            array_data = ArrayData()
-            for k, v in dictionary_array.items():
-                array_data.set_array(k, numpy.array(v))
+        array_data = create_array_data(self.retrieved, dictionary_array)
+        if array_data.get_arraynames():
             self.out('array', array_data)
 
         if json_params:
-            self.out('parameters', Dict(json_params))
+            self.out('parameters', orm.Dict(json_params))
 
         return
+
+    def _get_trajectory(self, list_of_files):
+        """Return the trajectory of a relaxation, preferably from the binary trajectory written by the optimizer.
+
+        If the binary trajectory was not retrieved, or does not contain any frame, the trajectory is read from the log.
+        """
+        if AseCalculation._TRAJECTORY_FILE_NAME in list_of_files:  # pylint: disable=protected-access
+            with self.retrieved.base.repository.open(AseCalculation._TRAJECTORY_FILE_NAME, 'rb') as handle:  # pylint: disable=protected-access
+                trajectory = read_trajectory_data(handle)
+            if trajectory is not None:
+                return trajectory
+
+        return store_to_trajectory_data(self._read_log())
+
+    def _read_log(self):
+        """Return the ``ase.Atoms`` of all ionic steps in the log, which is parsed in a single pass on the first call.
+
+        The log is read from the retrieved files or, if it was only retrieved temporarily, from the temporary folder.
+        The iterations of the SCF cycles and the error signatures are collected in ``_scf_telemetry`` and
+        ``_log_errors`` in the same pass.
+        """
+        if self._log_images is None:
+            log_filename = self.node.base.attributes.get('log_filename')
+            self._scf_telemetry = ScfTelemetry()
+            if log_filename in self.retrieved.base.repository.list_object_names():
+                with self.retrieved.base.repository.open(log_filename, 'r') as handle:
+                    self._log_images, _ = read_gpaw_log(handle, self._scf_telemetry, self._log_errors)
+            elif self._retrieved_temporary_folder is not None:
+                filepath = os.path.join(self._retrieved_temporary_folder, log_filename)
+                with open(filepath, 'r', encoding='utf-8') as handle:
+                    self._log_images, _ = read_gpaw_log(handle, self._scf_telemetry, self._log_errors)
+            else:
+                raise FileNotFoundError(f'the log `{log_filename}` was not retrieved.')
+        return self._log_images
+
+    def _read_log_errors(self):
+        """Return the names of the error signatures in the log, which is parsed if it was not yet.
+
+        The signatures are also returned if the log does not contain a complete ionic step.
+        """
+        if self._log_images is None:
+            try:
+                self._read_log()
+            except (OSError, ValueError):
+                pass
+        return self._log_errors
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""Single-pass parser of the text log written by GPAW.
+
+The log is read line by line and each ionic step is converted into an ``ase.Atoms`` with a single point calculator as
+soon as its block is complete, such that the file is never loaded in memory as a whole and is read only once, as opposed
+to repeated calls of ``ase.io.read(..., format='gpaw-out')``. The interpretation of each block mirrors the one of
+``ase.io.gpaw_out.read_gpaw_out``.
+"""
+import re
+
+import numpy
+
+# Signatures of known errors in the log or in the stderr of a GPAW calculation
+ERROR_SIGNATURES = {
+    'paw_not_found': 'could not find required paw dataset file',
+    'attribute_error': 'attributeerror',
+    'scf_not_converged': 'did not converge',
+}
+
+_FERMI_LEVEL = re.compile('(fixed )?fermi level(s)?:')
+_KPOINTS = re.compile(r'\d+ k-point')
+_EIGENVALUES_HEADERS = ('band   eigenvalues  occupancy', 'band  eigenvalues  occupancy')
+
+
+def parse_scf_iteration(line):
+    """Return the number, the time, the total energy and the log10 of the changes of an iteration line of the SCF.
+
+    Depending on the version of GPAW, the energy comes before or after the log10 of the changes of the wave functions or
+    eigenstates and of the density, which have two decimals, whereas the energy has more. The first iteration has no
+    changes, and a converged change is marked with a trailing ``c``.
+
+    :param line: a line of the log.
+    :return: tuple of the number of the iteration, the time of day in seconds, the energy and the log10 of the changes
+        of the eigenstates and of the density, which are ``None`` if they were not printed, or ``None`` if the line is
+        not an iteration of the SCF.
+    """
+    columns = line.split()
+    if len(columns) < 4 or columns[0] != 'iter:' or not columns[1].isdigit():
+        return None
+
+    try:
+        hours, minutes, seconds = (int(value) for value in columns[2].split(':'))
+    except ValueError:
+        return None
+
+    energy = None
+    changes = []
+    for column in columns[3:]:
+        value = column.rstrip('c')
+        try:
+            number = float(value)
+        except ValueError:
+            continue
+        decimals = len(value.partition('.')[2])
+        if decimals > 2 and energy is None:
+            energy = number
+        elif decimals <= 2:
+            changes.append(number)
+
+    if energy is None:
+        return None
+
+    eigenstates, density = changes[:2] if len(changes) > 1 else (None, None)
+
+    return int(columns[1]), 3600 * hours + 60 * minutes + seconds, energy, eigenstates, density
+
+
+class ScfTelemetry:
+    """The iterations of the SCF cycles of a GPAW log, which is fed line by line, e.g. by ``iter_gpaw_log``.
+
+    Each SCF cycle, i.e. each ionic step, starts with its first iteration, such that the cycles are also counted for a
+    log whose positions were not printed, e.g. because it was truncated.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.converged = []
+
+    def feed(self, line):
+        """Process the next line of the log.
+
+        :param line: the line, in any case.
+        """
+        iteration = parse_scf_iteration(line)
+
+        if iteration is not None:
+            if iteration[0] == 1 or not self.converged:
+                self.converged.append(False)
+            values = tuple(numpy.nan if value is None else value for value in iteration)
+            self.rows.append((len(self.converged) - 1,) + values)
+        elif self.converged and line.lower().startswith('converged after'):
+            self.converged[-1] = True
+
+    def get_arrays(self, summary=False):
+        """Return the arrays of the iterations and of their summary per SCF cycle.
+
+        The wall time of an iteration is the difference of the times of day, with a resolution of one second, with the
+        previous iteration in the log, such that it is not defined for the first iteration.
+
+        :param summary: whether to only return the summary per SCF cycle and the histogram of the number of iterations
+            of the converged cycles.
+        :return: dictionary of the arrays.
+        """
+        rows = numpy.array(self.rows, dtype=float).reshape(-1, 6)
+        cycles = rows[:, 0].astype(int)
+        times = numpy.diff(rows[:, 2], prepend=numpy.nan) % 86400
+        iterations = numpy.bincount(cycles, minlength=len(self.converged))
+        converged = numpy.array(self.converged, dtype=bool)
+
+        arrays = {
+            'cycle_iterations': iterations,
+            'cycle_converged': converged,
+            'cycle_time': numpy.bincount(cycles, weights=numpy.nan_to_num(times), minlength=len(self.converged)),
+            'iterations_histogram': numpy.bincount(iterations[converged]),
+        }
+
+        if not summary:
+            energy_change = numpy.diff(rows[:, 3], prepend=numpy.nan)
+            energy_change[rows[:, 1] == 1] = numpy.nan
+            arrays.update({
+                'cycle': cycles,
+                'iteration': rows[:, 1].astype(int),
+                'time': times,
+                'energy': rows[:, 3],
+                'energy_change': energy_change,
+                'eigenstate_error': rows[:, 4],
+                'density_residual': rows[:, 5],
+            })
+
+        return arrays
+
+
+def find_error_signatures(line, errors):
+    """Add the name of the error signatures that are contained in a line to the set of errors.
+
+    :param line: a line of the log or stderr, in lower case.
+    :param errors: set to which the names of the found error signatures are added.
+    """
+    for name, signature in ERROR_SIGNATURES.items():
+        if signature in line:
+            errors.add(name)
+
+
+class _LogBlock:
+    """The data of a single block of the log, which starts with the positions of an ionic step."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, cell, pbc):
+        self.cell = cell
+        self.pbc = pbc
+        self.symbols = []
+        self.positions = []
+        self.magmoms = []
+        self.bz_kpts = None
+        self.ibz_kpts = None
+        self.energy = None
+        self.energy_contributions = None
+        self.fermi_energy = None
+        self.eigenvalues = []
+        self.dipole = None
+        self.forces = None
+        self.stress = None
+        self.vdw = None
+        self.section = 'positions'
+        self.remaining = None
+        self.skip = 0
+        self.rows = []
+        self.previous = ''
+        self.found = set()
+
+    def feed(self, line):
+        """Process the next line of the block.
+
+        Only the first occurrence of each section in the block is read, as in ``ase.io.gpaw_out``.
+
+        :param line: the line in lower case.
+        """
+        previous, self.previous = self.previous, line
+
+        if self.section is not None:
+            self._feed_section(line)
+        elif not self._feed_header(line):
+            self._feed_energies(line, line.strip())
+            self._feed_atomic(line, line.strip(), previous)
+
+    def _first(self, section):
+        """Return whether the section is encountered for the first time in this block and mark it as found."""
+        if section in self.found:
+            return False
+        self.found.add(section)
+        return True
+
+    def _start(self, section, remaining, skip=0):
+        """Start reading a section of ``remaining`` lines, or open-ended if ``None``, after ``skip`` lines."""
+        self.section = section
+        self.remaining = remaining
+        self.skip = skip
+        self.rows = []
+
+    def _feed_header(self, line):
+        """Process a line that may start the section of the cell or of the k-points, and return whether it did."""
+        if line == 'unit cell:\n' and self._first('cell'):
+            self._start('cell', 3, skip=1)
+        elif _KPOINTS.match(line) and self._first('kpts'):
+            try:
+                words = line.split()
+                self.bz_kpts = (int(words[2]), int(words[4]), int(words[6]))
+            except (ValueError, IndexError):
+                pass
+            else:
+                self._start('ibz_kpts', 1)
+        else:
+            return False
+        return True
+
+    def _feed_energies(self, line, stripped):
+        """Process a line that may contain the energies, the Fermi level, the eigenvalues or the dipole moment."""
+        if stripped.startswith('energy contributions relative to') and self._first('contributions'):
+            self.energy_contributions = {}
+            self._start('contributions', None, skip=1)
+        elif _FERMI_LEVEL.match(line) and self._first('fermi'):
+            fields = line.split()
+            try:
+                self.fermi_energy = [float(_strip(fields[-2])), float(_strip(fields[-1]))]
+            except ValueError:
+                self.fermi_energy = float(fields[-1])
+        elif stripped.startswith(_EIGENVALUES_HEADERS) and self._first('eigenvalues'):
+            self._start('eigenvalues', None)
+        elif stripped.startswith('dipole moment:') and self._first('dipole'):
+            for character in '()[],':
+                line = line.replace(character, '')
+            self.dipole = numpy.array([float(c) for c in line.split()[2:5]])
+
+    def _feed_atomic(self, line, stripped, previous):
+        """Process a line that may start the section of the magnetic moments, forces, stress or vdW correction."""
+        if stripped.startswith('local magnetic moments') and self._first('magmoms'):
+            self.magmoms = []
+            self._start('magmoms', len(self.symbols))
+        elif line == 'forces in ev/ang:\n' and self._first('forces'):
+            self._start('forces', len(self.symbols))
+        elif line == 'stress tensor:\n' and self._first('stress'):
+            self._start('stress', 3)
+        elif stripped.startswith('vdw correction:') and self._first('vdw'):
+            self.vdw = {'name': previous.strip()}
+            self._start('vdw', 3 + len(self.symbols))
+
+    def _feed_section(self, line):
+        """Process a line that belongs to the section that is currently being read."""
+        if self.skip:
+            self.skip -= 1
+        elif self.section == 'cell' and not self.rows and line.startswith('  -'):
+            pass  # old format with a separator line
+        elif self.section in ('positions', 'contributions', 'eigenvalues'):
+            self._feed_open_section(line)
+        elif self.remaining == 0:
+            self.section = None
+        else:
+            self.rows.append(line)
+            self.remaining -= 1
+            if self.remaining == 0:
+                section, self.section = self.section, None
+                self._end_section(section, self.rows)
+
+    def _feed_open_section(self, line):
+        """Process a line of a section whose end is determined by its content instead of its number of lines."""
+        words = line.split()
+
+        if self.section == 'positions':
+            if len(words) < 5:
+                self.section = None
+                return
+            self.symbols.append(words[1].split('.')[0].title())
+            self.positions.append([float(word) for word in words[2:5]])
+            if len(words) > 5:
+                self.magmoms.append(float(words[-1].rstrip(')')))
+        elif self.section == 'contributions':
+            fields = line.split(':')
+            if len(fields) == 2:
+                name = fields[0]
+                value = float(fields[1])
+                self.energy_contributions[name] = value
+                if name in ['zero kelvin', 'extrapolated']:
+                    self.energy = value
+                    self.section = None
+        elif len(words) > 2:
+            self.eigenvalues.append([float(word) for word in words])
+        else:
+            self.section = None
+
+    def _end_section(self, section, rows):
+        """Process the lines of a section with a fixed number of lines, once all of them were read."""
+        if section == 'cell':
+            self.cell, self.pbc = _read_cell(rows)
+        elif section == 'ibz_kpts':
+            try:
+                self.ibz_kpts = int(rows[0].split()[0])
+            except (ValueError, IndexError):
+                self.bz_kpts = None
+        elif section == 'magmoms':
+            for row in rows:
+                if '#' in row:  # new GPAW format
+                    self.magmoms.append(float(row.split()[-4].split(']')[0]))
+                else:
+                    self.magmoms.append(float(row.split()[-1].rstrip(')')))
+        elif section == 'forces':
+            self.forces = _read_vectors(rows)
+        elif section == 'stress':
+            self.stress = _read_vectors(rows)
+        elif section == 'vdw':
+            if not rows[0].startswith('energy:'):
+                raise OSError('Malformed GPAW log file: vdW correction energy is missing')
+            self.vdw['energy'] = float(rows[0].split()[-1])
+            self.vdw['forces'] = _read_vectors(rows[3:])
+
+    def to_atoms(self, charge, is_first):
+        """Return the ``ase.Atoms`` of this block, or ``None`` if the block is incomplete.
+
+        :param charge: the total charge of the system, if specified in the log.
+        :param is_first: whether this is the first block of the log, which is returned even if it is incomplete.
+        """
+        # pylint: disable=too-many-branches
+        from ase import Atoms
+        from ase.calculators.singlepoint import SinglePointDFTCalculator, SinglePointKPoint
+
+        if self.section == 'contributions':
+            raise ValueError('Malformed GPAW log file: the energy contributions are incomplete')
+
+        energy = self.energy
+        forces = self.forces
+        parameters = {}
+        name = 'gpaw'
+
+        if self.vdw is not None and 'energy' in self.vdw:
+            name = self.vdw['name']
+            parameters = {'calculator': 'gpaw', 'uncorrected_energy': energy}
+            energy = self.vdw['energy']
+            forces = self.vdw['forces']
+
+        if not is_first and energy is None:
+            return None
+
+        if self.symbols:
+            atoms = Atoms(symbols=self.symbols, positions=self.positions, cell=self.cell, pbc=self.pbc)
+        else:
+            atoms = Atoms(cell=self.cell, pbc=self.pbc)
+
+        if charge is not None and len(atoms) > 0:
+            atoms.set_initial_charges([charge / len(atoms)] * len(atoms))
+
+        magmoms = self.magmoms or None
+        if magmoms:
+            atoms.set_initial_magnetic_moments(magmoms)
+
+        if energy is not None or forces is not None:
+            calc = SinglePointDFTCalculator(
+                atoms,
+                energy=energy,
+                forces=forces,
+                dipole=self.dipole,
+                magmoms=magmoms,
+                efermi=self.fermi_energy,
+                bzkpts=self.bz_kpts,
+                ibzkpts=self.ibz_kpts,
+                stress=self.stress,
+            )
+            calc.name = name
+            calc.parameters = parameters
+            if self.energy_contributions is not None:
+                calc.energy_contributions = self.energy_contributions
+            if self.eigenvalues:
+                values = numpy.array(self.eigenvalues).transpose()
+                kpts = [SinglePointKPoint(1, 0, 0)]
+                kpts[0].eps_n = values[1]
+                kpts[0].f_n = values[2]
+                if values.shape[0] > 3:
+                    kpts.append(SinglePointKPoint(1, 1, 0))
+                    kpts[1].eps_n = values[3]
+                    kpts[1].f_n = values[4]
+                calc.kpts = kpts
+            atoms.calc = calc
+
+        return atoms
+
+
+def _strip(string):
+    """Remove the brackets and commas from a string."""
+    for rubbish in '[],':
+        string = string.replace(rubbish, '')
+    return string
+
+
+def _read_cell(rows):
+    """Return the cell and the periodic boundary conditions of the rows of the unit cell."""
+    cell = []
+    pbc = []
+    for row in rows:
+        words = row.split()
+        if len(words) == 5:  # old format
+            cell.append(float(words[2]))
+            pbc.append(words[1] == 'yes')
+        else:  # new format with GUC
+            cell.append([float(word) for word in words[3:6]])
+            pbc.append(words[2] == 'yes')
+    return cell, pbc
+
+
+def _read_vectors(rows):
+    """Return the last three columns of each row as floats."""
+    vectors = []
+    for row in rows:
+        try:
+            x, y, z = row.split()[-3:]
+            vectors.append((float(x), float(y), float(z)))
+        except (ValueError, IndexError) as exception:
+            raise OSError(f'Malformed GPAW log file: {exception}')
+    return vectors
+
+
+def iter_gpaw_log(handle, errors=None, scf_telemetry=None):
+    """Yield the ``ase.Atoms`` of each ionic step of a GPAW text log, reading the file line by line.
+
+    Incomplete steps after the first one, e.g. of a calculation that was interrupted, are skipped.
+
+    :param handle: filelike object of the log in text mode.
+    :param errors: optional set to which the names of the error signatures found in the log are added.
+    :param scf_telemetry: optional ``ScfTelemetry`` that is fed with each line of the log.
+    """
+    charge = None
+    block = None
+    is_first = True
+    cell = []
+    pbc = []
+
+    for line in handle:
+        line = line.lower()
+
+        if errors is not None:
+            find_error_signatures(line, errors)
+
+        if scf_telemetry is not None:
+            scf_telemetry.feed(line)
+
+        if charge is None and line.strip().startswith('total charge:'):
+            charge = float(line.split()[2])
+
+        if line == 'positions:\n':
+            if block is not None:
+                atoms = block.to_atoms(charge, is_first)
+                cell, pbc = block.cell, block.pbc
+                is_first = False
+                # an incomplete step is skipped, such that the lines of the following steps are still processed
+                if atoms is not None:
+                    yield atoms
+            block = _LogBlock(cell, pbc)
+        elif block is not None:
+            block.feed(line)
+
+    if block is not None:
+        atoms = block.to_atoms(charge, is_first)
+        if atoms is not None:
+            yield atoms
+
+
+def read_gpaw_log(handle, scf_telemetry=None, errors=None):
+    """Read all the ionic steps and the error signatures of a GPAW text log in a single pass.
+
+    :param handle: filelike object of the log in text mode.
+    :param scf_telemetry: optional ``ScfTelemetry`` that is fed with each line of the log, also if it raises.
+    :param errors: optional set to which the names of the error signatures are added, also if it raises.
+    :return: tuple of the list of ``ase.Atoms`` for each ionic step and the set of names of the error signatures.
+    :raises OSError: if the log does not contain any ionic step.
+    """
+    errors = set() if errors is None else errors
+    images = list(iter_gpaw_log(handle, errors, scf_telemetry))
+
+    if not images:
+        raise OSError('Corrupted GPAW-text file!')
+
+    return images, errors
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Utilities shared by the parsers of the ``AseCalculation``."""
+import json
+import re
+
+from aiida import orm
+import numpy
+
+from aiida_ase.calculations.ase import AseCalculation
+from aiida_ase.calculations.structure import get_structure_data
+
+# A step of the log of an ASE optimizer: name, step with the optional number of force calls of line search optimizers,
+# time, energy with the optional marker of a line search and the maximum force
+_OPTIMIZER_LOG_STEP = re.compile(
+    r'^\s*\w+:\s+(\d+)(?:\[\s*\d+\])?\s+(\d+):(\d+):(\d+)\s+(\S+?)\*?\s+(\S+)\s*$', re.MULTILINE
+)
+
+
+def split_batch_results(results):
+    """Split the results of a batched ``AseCalculation`` in scalar values and arrays.
+
+    The results of a batched calculation are keyed on the label of the structure. The scalar values are kept grouped per
+    label, whereas the arrays are flattened with the label as prefix, such that they can be stored in one ``ArrayData``.
+
+    :param results: dictionary with the results of each structure, keyed on the structure label.
+    :return: tuple of the dictionary of scalar values and the dictionary of arrays.
+    """
+    parameters = {}
+    arrays = {}
+
+    for label, values in results.items():
+        parameters[label] = {}
+        for key, value in values.items():
+            if isinstance(value, (list, tuple, numpy.ndarray)):
+                arrays[f'{label}__{key}'] = numpy.array(value)
+            else:
+                parameters[label][key] = value
+
+    return parameters, arrays
+
+
+def set_arrays_from_npz(array_data, handle):
+    """Store all arrays of an ``.npz`` archive in an ``ArrayData`` node.
+
+    The members of the archive are loaded one at a time, such that at most one array is held in memory at once, and
+    stored with ``ArrayData.set_array``.
+
+    :param array_data: the ``ArrayData`` node, which should not yet be stored.
+    :param handle: binary filelike object of the ``.npz`` archive.
+    :return: list of names of the arrays that were stored.
+    :raises ValueError: if one of the arrays requires pickling to be loaded.
+    """
+    names = []
+
+    with numpy.load(handle, allow_pickle=False) as archive:
+        for name in archive.files:
+            try:
+                array = archive[name]
+            except ValueError as exception:
+                raise ValueError(f'the array `{name}` contains Python objects and cannot be stored.') from exception
+
+            array_data.set_array(name, array)
+            names.append(name)
+
+    return names
+
+
+def create_array_data(retrieved, arrays):
+    """Return an ``ArrayData`` with the given arrays and those of the binary results file, if it was retrieved.
+
+    :param retrieved: the ``FolderData`` with the retrieved files.
+    :param arrays: dictionary of arrays, or objects that can be converted into one, to add to the node.
+    :return: the unstored ``ArrayData`` node, which may be empty.
+    """
+    array_data = orm.ArrayData()
+
+    filename = AseCalculation._OUTPUT_ARRAYS_FILE_NAME  # pylint: disable=protected-access
+
+    if filename in retrieved.base.repository.list_object_names():
+        with retrieved.base.repository.open(filename, 'rb') as handle:
+            set_arrays_from_npz(array_data, handle)
+
+    for key, value in arrays.items():
+        array_data.set_array(key, numpy.array(value))
+
+    return array_data
+
+
+def create_trajectory_data(images):
+    """Return a ``TrajectoryData`` built from the stacked arrays of a sequence of ``ase.Atoms``.
+
+    The positions and cells of all frames are stacked in a single array each, which are set directly on the node without
+    creating an intermediate ``StructureData`` for each frame. The energy, forces and stress of the frames are stored as
+    the additional arrays ``energies``, ``forces`` and ``stress``, if they are available for all frames.
+
+    The stress is always stored in Voigt notation, as the log of GPAW contains the full 3x3 tensor.
+
+    :param images: sequence of ``ase.Atoms``, all with the same atoms.
+    :return: the unstored ``TrajectoryData`` node.
+    """
+    from ase.stress import full_3x3_to_voigt_6_stress
+
+    images = list(images)
+
+    trajectory = orm.TrajectoryData()
+    trajectory.set_trajectory(
+        symbols=images[0].get_chemical_symbols(),
+        positions=numpy.array([atoms.positions for atoms in images]),
+        cells=numpy.array([atoms.cell.array for atoms in images]),
+    )
+
+    for name, key in (('energies', 'energy'), ('forces', 'forces'), ('stress', 'stress')):
+        values = [atoms.calc.results.get(key, None) if atoms.calc is not None else None for atoms in images]
+        if all(value is not None for value in values):
+            values = numpy.array(values)
+            if name == 'stress' and values.ndim == 3:
+                values = full_3x3_to_voigt_6_stress(values)
+            trajectory.set_array(name, values)
+
+    return trajectory
+
+
+def read_trajectory_data(handle):
+    """Return a ``TrajectoryData`` from the binary ASE trajectory written by the optimizer.
+
+    :param handle: binary filelike object of the ``.traj`` file.
+    :return: the unstored ``TrajectoryData`` node, or ``None`` if the file does not contain any frame.
+    """
+    from ase.io.trajectory import Trajectory
+
+    images = Trajectory(handle)
+
+    if len(images) == 0:
+        return None
+
+    return create_trajectory_data(images)
+
+
+def read_optimizer_state(retrieved):
+    """Return the restart file of the optimizer as a ``SinglefileData``, or ``None`` if it was not retrieved.
+
+    :param retrieved: the retrieved ``FolderData``.
+    """
+    filename = AseCalculation._OPTIMIZER_STATE_FILE_NAME  # pylint: disable=protected-access
+
+    if filename not in retrieved.base.repository.list_object_names():
+        return None
+
+    with retrieved.base.repository.open(filename, 'rb') as handle:
+        return orm.SinglefileData(handle, filename=filename)
+
+
+def parse_optimizer_log(content):
+    """Return the step, the time, the energy and the maximum force of each step in the log of an ASE optimizer.
+
+    The steps are matched in a single pass over the content and converted to arrays at once. The time is the wall time
+    in seconds since the first step, which is printed as the time of day, such that it is unwrapped at midnight.
+
+    :param content: the content of the log.
+    :return: dictionary with the arrays ``steps``, ``times``, ``energies`` and ``fmax``.
+    """
+    rows = numpy.array(_OPTIMIZER_LOG_STEP.findall(content), dtype=str).reshape(-1, 6)
+
+    clock = rows[:, 1:4].astype(int) @ numpy.array([3600, 60, 1])
+    times = clock + 86400 * numpy.cumsum(numpy.diff(clock, prepend=clock[:1]) < 0)
+
+    return {
+        'steps': rows[:, 0].astype(int),
+        'times': (times - times[:1]).astype(float),
+        'energies': rows[:, 4].astype(float),
+        'fmax': rows[:, 5].astype(float),
+    }
+
+
+def read_optimizer_log(retrieved):
+    """Return the steps of the log of the optimizer as an ``ArrayData``, or ``None`` if it was not retrieved.
+
+    :param retrieved: the retrieved ``FolderData``.
+    :return: the ``ArrayData`` with the arrays of ``parse_optimizer_log``.
+    """
+    filename = AseCalculation._OPTIMIZER_FILE_NAME  # pylint: disable=protected-access
+
+    if filename not in retrieved.base.repository.list_object_names():
+        return None
+
+    array_data = orm.ArrayData()
+    for name, array in parse_optimizer_log(retrieved.base.repository.get_object_content(filename, 'r')).items():
+        array_data.set_array(name, array)
+
+    return array_data
+
+
+def read_timings(retrieved):
+    """Return the timings of the phases of the script as a ``Dict``, or ``None`` if they were not retrieved.
+
+    :param retrieved: the retrieved ``FolderData``.
+    """
+    filename = AseCalculation._TIMINGS_FILE_NAME  # pylint: disable=protected-access
+
+    if filename not in retrieved.base.repository.list_object_names():
+        return None
+
+    with retrieved.base.repository.open(filename, 'r') as handle:
+        return orm.Dict(json.load(handle))
+
+
+def read_monitor_kill(retrieved):
+    """Return the exit code and the message of the marker written by a monitor that killed the job, if any.
+
+    :param retrieved: the retrieved ``FolderData``.
+    :return: dictionary with the label of the ``exit_code`` and the ``message``, or ``None`` if it was not retrieved.
+    """
+    filename = AseCalculation._MONITOR_FILE_NAME  # pylint: disable=protected-access
+
+    if filename not in retrieved.base.repository.list_object_names():
+        return None
+
+    with retrieved.base.repository.open(filename, 'r') as handle:
+        return json.load(handle)
+
+
+def read_walltime_marker(retrieved):
+    """Return the content of the marker written when a relaxation was stopped before the walltime, if any.
+
+    :param retrieved: the retrieved ``FolderData``.
+    :return: dictionary with the ``elapsed`` time, the number of ``steps`` of the optimizer and the longest
+        ``step_time``, or ``None`` if it was not retrieved.
+    """
+    filename = AseCalculation._WALLTIME_FILE_NAME  # pylint: disable=protected-access
+
+    if filename not in retrieved.base.repository.list_object_names():
+        return None
+
+    with retrieved.base.repository.open(filename, 'r') as handle:
+        return json.load(handle)
+
+
+def read_log_digest(retrieved):
+    """Return the digest of the log written by the script, or ``None`` if it was not retrieved.
+
+    :param retrieved: the retrieved ``FolderData``.
+    :return: dictionary with the names of the found ``errors`` and the ``parameters`` of the last step, which are
+        ``None`` if they could not be read from the log.
+    """
+    filename = AseCalculation._LOG_DIGEST_FILE_NAME  # pylint: disable=protected-access
+
+    if filename not in retrieved.base.repository.list_object_names():
+        return None
+
+    with retrieved.base.repository.open(filename, 'r') as handle:
+        return json.load(handle)
+
+
+def create_gpw_folder(node):
+    """Return a reference to the remote folder that contains the GPW file written by a calculation, if it was requested.
+
+    The GPW file is only referenced if it was left on the remote, see the ``gpw_storage`` option. It may not exist if
+    the calculation failed before writing it, in which case the calculator of a calculation that uses it as
+    ``parent_folder`` simply starts from scratch.
+
+    :param node: the ``CalcJobNode`` of the calculation.
+    :return: the unstored ``RemoteData`` or ``None``.
+    """
+    if not node.get_option('write_gpw') or node.get_option('gpw_storage') != 'remote':
+        return None
+
+    if 'remote_folder' not in node.outputs:
+        return None
+
+    return orm.RemoteData(computer=node.computer, remote_path=node.outputs.remote_folder.get_remote_path())
+
+
+def read_output_structure(retrieved, node):
+    """Return the output structure written by the script as a ``StructureData``, or ``None`` if it was not retrieved.
+
+    The file is read in the ``structure_format`` of the calculation and converted through arrays, see
+    ``get_structure_data``, which is much faster than site by site for large structures.
+
+    :param retrieved: the retrieved ``FolderData``.
+    :param node: the ``CalcJobNode`` of the calculation.
+    :return: the unstored ``StructureData`` or ``None``.
+    """
+    from ase.io import read
+
+    structure_format = node.get_option('structure_format') or 'json'
+    _, filename = AseCalculation.get_structure_filenames(structure_format)
+
+    if filename not in retrieved.base.repository.list_object_names():
+        return None
+
+    with retrieved.base.repository.open(filename, 'rb' if structure_format == 'traj' else 'r') as handle:
+        atoms = read(handle, format=structure_format)
+
+    return get_structure_data(atoms)
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 """Workchain to run a GPAW calculation with automated error handling and restarts."""
+import math
 
 from aiida import orm
 from aiida.common import AttributeDict, exceptions
 from aiida.engine import BaseRestartWorkChain, ProcessHandlerReport, process_handler, while_
-from aiida.plugins import CalculationFactory
 
-AseCalculation = CalculationFactory('ase.ase')  # pylint: disable=invalid-name
+from aiida_ase.calculations.ase import AseCalculation
+from aiida_ase.parsers.utils import read_walltime_marker
+
+from .scf_ladder import DEFAULT_SCF_LADDER, apply_rung, get_next_rung, get_scf_trend, validate_scf_ladder
+from .walltime import FMAX_DEFAULT, estimate_remaining_steps, fit_resources, get_step_time
+
+# the exit codes of the spec, through which pylint can resolve their names, contrary to ``AseCalculation.exit_codes``
+CALCULATION_EXIT_CODES = AseCalculation.spec().exit_codes
 
 
 class GpawBaseWorkChain(BaseRestartWorkChain):
@@ -20,6 +27,12 @@ class GpawBaseWorkChain(BaseRestartWorkChain):
             'nmaxold_default':5,
             'weight_default':50.0,
             'beta_factor':0.9,
+            'maxiter_max':1000,
+            'scf_density_convergence':1e-4,
+            'scf_min_improvement':0.1,
+            'scf_patience':2,
+            'walltime_safety':1.2,
+            'walltime_min':600,
     })
 
 
@@ -32,9 +45,21 @@ class GpawBaseWorkChain(BaseRestartWorkChain):
                     help='The input structure.')
         spec.input('kpoints', valid_type=orm.KpointsData, required=False,
                     help='k-points to use for the calculation.')
+        spec.input('scf_ladder', valid_type=orm.List, required=False, validator=validate_scf_ladder,
+                    help='Rungs of the arguments of the calculator to restart an SCF that did not converge, which '
+                    'replace the `DEFAULT_SCF_LADDER`, see the `scf_ladder` module.')
+        spec.input('max_wallclock_seconds_limit', valid_type=orm.Int, required=False,
+                    help='Maximum walltime in seconds of a calculation that is restarted after it ran out of walltime. '
+                    'By default, the walltime is not raised above the `max_wallclock_seconds` of the `gpaw` inputs.')
+        spec.input('num_machines_limit', valid_type=orm.Int, required=False,
+                    help='Maximum number of machines of a calculation that is restarted after it ran out of walltime, '
+                    'if the remaining steps do not fit in the walltime. By default, the number of machines is kept.')
 
         spec.expose_outputs(AseCalculation)
 
+        spec.exit_code(403, 'ERROR_SCF_UNRECOVERABLE',
+            message='The SCF did not converge and no rung of the SCF ladder is expected to help.')
+
         spec.outline(
             cls.setup,
             cls.validate_inputs,
@@ -55,10 +80,16 @@ class GpawBaseWorkChain(BaseRestartWorkChain):
         if 'kpoints' in self.inputs:
             self.ctx.inputs.kpoints = self.inputs.kpoints
         self.initial_calc = True
+        self.ctx.scf_rung = 0
+        self.ctx.scf_best = None
+        self.ctx.scf_fruitless = 0
 
     def validate_inputs(self):
         """Validate the inputs."""
         self.ctx.inputs.metadata.options.parser_name = 'ase.gpaw'
+        # the residuals of each SCF iteration are used to choose the restart of an SCF that did not converge
+        if 'scf_telemetry' not in self.ctx.inputs.metadata.options:
+            self.ctx.inputs.metadata.options.scf_telemetry = 'full'
         parameters = self.ctx.inputs.parameters.get_dict()
         self.ctx.inputs.parameters = orm.Dict(parameters)
 
@@ -88,47 +119,203 @@ class GpawBaseWorkChain(BaseRestartWorkChain):
         self.report('{}<{}> failed with exit status {}: {}'.format(*arguments))
         self.report(f'Action taken: {action}')
 
-    @process_handler(exit_codes=[AseCalculation.exit_codes.ERROR_RELAX_NOT_COMPLETE])
+    def set_optimizer_state(self, calculation):
+        """Continue the relaxation of the next calculation from the state of the optimizer of the given calculation.
+
+        This carries over e.g. the Hessian of BFGS, which would otherwise be reset to the identity on the restart.
+        """
+        if 'optimizer_state' in calculation.outputs:
+            self.ctx.inputs.optimizer_state = calculation.outputs.optimizer_state
+
+    def set_parent_folder(self, calculation):
+        """Start the calculator of the next calculation from the GPW file written by the given calculation, if any.
+
+        The GPW file is symlinked from the remote folder and only used by the script if it was actually written.
+        """
+        if 'gpw_folder' in calculation.outputs:
+            self.ctx.inputs.parent_folder = calculation.outputs.gpw_folder
+        elif calculation.get_option('write_gpw') and 'remote_folder' in calculation.outputs:
+            self.ctx.inputs.parent_folder = calculation.outputs.remote_folder
+
+    @process_handler(exit_codes=[CALCULATION_EXIT_CODES.ERROR_RELAX_NOT_COMPLETE])
     def handle_relax_not_complete(self, calculation):
         """Handle the relaxation not complete error."""
+        self.set_optimizer_state(calculation)
+        self.set_parent_folder(calculation)
         try:
-            self.ctx.inputs.structure = calculation.outputs.trajectory.get_step_structure()[-1]
+            self.ctx.inputs.structure = calculation.outputs.trajectory.get_step_structure(-1)
             self.report_error_handled(calculation, 'relaxation not complete; starting from final structure')
         except exceptions.NotExistent:
             self.report_error_handled(calculation, 'relaxation not complete; no structure found')
         return ProcessHandlerReport(True)
 
-    @process_handler(exit_codes=[AseCalculation.exit_codes.ERROR_SCF_NOT_COMPLETE])
-    def handle_scf_not_complete(self, calculation):  # pylint: disable=unused-argument
-        """Handle the SCF not complete error."""
-        new_mixer = self.defaults.beta_default * self.defaults.beta_factor
-        nmaxold = self.defaults.nmaxold_default
-        weight = self.defaults.weight_default
+    @staticmethod
+    def get_remaining_cost(calculation):
+        """Return the cost of the remaining ionic steps of a relaxation, extrapolated from the given calculation.
+
+        :return: tuple of the average duration of an ionic step, the duration before the first step and the number of
+            remaining steps, or ``None`` if the duration of the steps could not be extrapolated.
+        """
+        optimizer_log = calculation.outputs.optimizer_log if 'optimizer_log' in calculation.outputs else None
+        timings = calculation.outputs.timings.get_dict() if 'timings' in calculation.outputs else None
+        walltime = read_walltime_marker(calculation.outputs.retrieved) if 'retrieved' in calculation.outputs else None
+
+        step_time = get_step_time(optimizer_log, timings, walltime)
+        if step_time is None:
+            return None
+
+        run_args = calculation.inputs.parameters.get_dict().get('optimizer', {}).get('run_args', {})
+        run_args = run_args if isinstance(run_args, dict) else {}
+        fmax = optimizer_log.get_array('fmax') if optimizer_log is not None else []
+        steps = estimate_remaining_steps(fmax, run_args.get('fmax', FMAX_DEFAULT), run_args.get('steps', None))
+
+        return (*step_time, steps)
+
+    def set_walltime_resources(self, calculation):
+        """Set the walltime and the number of machines of the next calculation such that the remaining steps fit.
+
+        The average duration of an ionic step of the given calculation and the number of remaining steps are
+        extrapolated, see ``get_remaining_cost``. The walltime can also be lowered, to not request more than needed.
+
+        :return: a description of the resources that were set, or ``None`` if they could not be extrapolated.
+        """
+        options = self.ctx.inputs.metadata.options
+        max_seconds = self.inputs.gpaw.metadata.options.get('max_wallclock_seconds', None)
+        if 'max_wallclock_seconds_limit' in self.inputs:
+            max_seconds = self.inputs.max_wallclock_seconds_limit.value
+
+        if max_seconds is None or calculation.get_option('max_wallclock_seconds') is None:
+            return None
+
+        cost = self.get_remaining_cost(calculation)
+        if cost is None:
+            return None
+
+        resources = calculation.get_option('resources') or {}
+        num_machines = resources.get('num_machines', None)
+        max_machines = self.inputs.num_machines_limit.value if 'num_machines_limit' in self.inputs else None
+
+        seconds, machines, fits = fit_resources(
+            cost,
+            num_machines or 1,
+            max_seconds,
+            max_machines=max_machines if num_machines is not None else None,
+            safety=self.defaults.walltime_safety,
+            margin=calculation.get_option('walltime_margin') or 0,
+            min_seconds=self.defaults.walltime_min,
+        )
+
+        options.max_wallclock_seconds = seconds
+        if num_machines is not None:
+            options.resources = dict(resources, num_machines=machines)
+
+        action = f'{cost[2]} steps of {cost[0]:.0f} s on {machines} machines in {seconds} s'
+        return action if fits else f'{action}, which is too short for all of them'
+
+    @process_handler(exit_codes=[CALCULATION_EXIT_CODES.ERROR_OUT_OF_WALLTIME])
+    def handle_out_of_walltime(self, calculation):
+        """Handle the out of walltime error, resuming from the structure written before the walltime was reached.
+
+        The walltime and the number of machines of the restart are set from the cost of the ionic steps of the failed
+        calculation, see ``set_walltime_resources``.
+        """
+        self.set_optimizer_state(calculation)
+        self.set_parent_folder(calculation)
+        if 'structure' in calculation.outputs:
+            self.ctx.inputs.structure = calculation.outputs.structure
+            action = 'out of walltime; resuming from the checkpointed structure'
+        elif 'trajectory' in calculation.outputs:
+            self.ctx.inputs.structure = calculation.outputs.trajectory.get_step_structure(-1)
+            action = 'out of walltime; resuming from the last step of the trajectory'
+        else:
+            action = 'out of walltime; no structure found, restarting'
+
+        resources = self.set_walltime_resources(calculation)
+        self.report_error_handled(calculation, f'{action} with {resources}' if resources else action)
+        return ProcessHandlerReport(True)
+
+    @process_handler(exit_codes=[CALCULATION_EXIT_CODES.ERROR_RELAX_STALLED])
+    def handle_relax_stalled(self, calculation):
+        """Handle a relaxation that was killed by a monitor because the maximum force did not decrease.
+
+        The relaxation restarts from its last step with a fresh optimizer, since the state that was built up, e.g. the
+        Hessian of BFGS, is the likely cause of the stall.
+        """
+        self.set_parent_folder(calculation)
+        self.ctx.inputs.pop('optimizer_state', None)
+        if 'trajectory' in calculation.outputs:
+            self.ctx.inputs.structure = calculation.outputs.trajectory.get_step_structure(-1)
+            self.report_error_handled(calculation, 'relaxation stalled; restarting from the last step, fresh optimizer')
+        else:
+            self.report_error_handled(calculation, 'relaxation stalled; no trajectory found, fresh optimizer')
+        return ProcessHandlerReport(True)
+
+    @process_handler(
+        exit_codes=[CALCULATION_EXIT_CODES.ERROR_SCF_NOT_COMPLETE, CALCULATION_EXIT_CODES.ERROR_SCF_DIVERGED]
+    )
+    def handle_scf_not_complete(self, calculation):
+        """Handle the SCF not complete error, also if the job was killed by a monitor because the SCF diverged.
+
+        The restart is chosen from the trend of the density residual of the last SCF cycle, see ``get_scf_trend``. A
+        converging SCF is restarted with enough iterations, otherwise the next rung of the SCF ladder that addresses the
+        trend is applied. The restarts stop if ``scf_patience`` consecutive restarts did not lower the best residual by
+        ``scf_min_improvement``, or if no rung is left. Without the residuals, e.g. if the ``scf_telemetry`` option is
+        not ``full``, the next rung of the SCF ladder is applied regardless of the trend.
+        """
+        self.set_parent_folder(calculation)
+        ladder = self.inputs.scf_ladder.get_list() if 'scf_ladder' in self.inputs else list(DEFAULT_SCF_LADDER)
         parameters = self.ctx.inputs.parameters.get_dict()
-        mixer_dict = {'@function': 'Mixer', 'args': {'beta': new_mixer, 'nmaxold': nmaxold, 'weight': weight}}
-        parameters.setdefault('calculator', {}).setdefault('args', {})['mixer'] = mixer_dict
-        parameters['extra_imports'] = [['gpaw', 'Mixer']]
-        parameters.setdefault('calculator', {}).setdefault('args', {})['maxiter'] = 1000
+        calculator_args = parameters.setdefault('calculator', {}).setdefault('args', {})
+
+        density_convergence = calculator_args.get('convergence', {}).get('density', None)
+        target = math.log10(density_convergence or self.defaults.scf_density_convergence)
+
+        trend, needed = None, None
+        if 'scf_telemetry' in calculation.outputs:
+            analysis = get_scf_trend(calculation.outputs.scf_telemetry, target, self.defaults.maxiter_max)
+            if analysis is not None:
+                trend, best, needed = analysis
+                if self.ctx.scf_best is not None and best > self.ctx.scf_best - self.defaults.scf_min_improvement:
+                    self.ctx.scf_fruitless += 1
+                else:
+                    self.ctx.scf_fruitless = 0
+                self.ctx.scf_best = best if self.ctx.scf_best is None else min(best, self.ctx.scf_best)
+
+        label = trend or 'not complete'
+
+        if self.ctx.scf_fruitless >= self.defaults.scf_patience:
+            self.report_error_handled(calculation, f'SCF {label}; the last restarts did not lower the residual, abort')
+            return ProcessHandlerReport(True, self.exit_codes.ERROR_SCF_UNRECOVERABLE)
+
+        if trend == 'converging':
+            calculator_args['maxiter'] = max(calculator_args.get('maxiter', 0), needed + 10)
+            action = f"SCF converging; restarting with maxiter={calculator_args['maxiter']}"
+        else:
+            index = get_next_rung(ladder, self.ctx.scf_rung, trend)
+            if index is None:
+                self.report_error_handled(calculation, f'SCF {label}; no rung of the SCF ladder left')
+                return ProcessHandlerReport(True, self.exit_codes.ERROR_SCF_UNRECOVERABLE)
+            apply_rung(parameters, ladder[index])
+            self.ctx.scf_rung = index + 1
+            action = f"SCF {label}; restarting with the rung `{ladder[index].get('name', index)}`"
 
         self.ctx.inputs.parameters = orm.Dict(parameters)
-        self.report_error_handled(
-            calculation, 'SCF not complete; starting from inital structure with lower mixing and more iterations'
-        )
+        self.report_error_handled(calculation, action)
         return ProcessHandlerReport(True)
 
-    @process_handler(exit_codes=[AseCalculation.exit_codes.ERROR_UNEXPECTED_EXCEPTION])
+    @process_handler(exit_codes=[CALCULATION_EXIT_CODES.ERROR_UNEXPECTED_EXCEPTION])
     def handle_unexpected_exception(self, calculation):  # pylint: disable=unused-argument
         """Handle the unexpected exception error."""
         self.report_error_handled(calculation, 'unexpected exception; starting from initial structure')
-        return ProcessHandlerReport(True, AseCalculation.exit_codes.ERROR_UNEXPECTED_EXCEPTION)
+        return ProcessHandlerReport(True, CALCULATION_EXIT_CODES.ERROR_UNEXPECTED_EXCEPTION)
 
-    @process_handler(exit_codes=[AseCalculation.exit_codes.ERROR_PAW_NOT_FOUND])
+    @process_handler(exit_codes=[CALCULATION_EXIT_CODES.ERROR_PAW_NOT_FOUND])
     def handle_paw_not_found(self, calculation):  # pylint: disable=unused-argument
         """Handle the paw not found error."""
         self.report_error_handled(calculation, 'PAW not found; cancel the restart.')
-        return ProcessHandlerReport(True, AseCalculation.exit_codes.ERROR_PAW_NOT_FOUND)
+        return ProcessHandlerReport(True, CALCULATION_EXIT_CODES.ERROR_PAW_NOT_FOUND)
 
-    @process_handler(exit_codes=[AseCalculation.exit_codes.ERROR_FERMI_LEVEL_INF])
+    @process_handler(exit_codes=[CALCULATION_EXIT_CODES.ERROR_FERMI_LEVEL_INF])
     def handle_fermi_level_inf(self, calculation):
         """Handle the Fermi level is infinite error."""
         parameters = self.ctx.inputs.parameters.get_dict()
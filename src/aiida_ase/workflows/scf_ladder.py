@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Escalation ladder of the parameters of GPAW to restart a calculation whose SCF did not converge.
+
+Each rung of the ladder is a dictionary with the ``name`` of the rung, the ``args`` of the calculator that it sets and
+the ``trends`` of the density residual that it addresses. The rungs are cumulative: the arguments of a rung are set on
+top of those of the previous rungs. The functions of the ``@function`` arguments are imported from ``gpaw``.
+
+The trend of the last SCF cycle of the failed calculation is determined from its ``scf_telemetry`` output:
+
+* ``converging``: the residual decreases steadily and would reach the convergence criterion with more iterations.
+* ``diverging``: the residual increases.
+* ``stagnating``: the residual neither decreases nor increases, e.g. because it oscillates.
+"""
+import math
+
+import numpy
+
+SCF_TRENDS = ('converging', 'diverging', 'stagnating')
+
+DEFAULT_SCF_LADDER = (
+    {
+        'name': 'lower_beta',
+        'args': {
+            'mixer': {
+                '@function': 'Mixer',
+                'args': {
+                    'beta': 0.045,
+                    'nmaxold': 5,
+                    'weight': 50.0
+                }
+            },
+            'maxiter': 1000,
+        },
+        'trends': ['diverging', 'stagnating'],
+    },
+    {
+        'name': 'lowest_beta',
+        'args': {
+            'mixer': {
+                '@function': 'Mixer',
+                'args': {
+                    'beta': 0.02,
+                    'nmaxold': 8,
+                    'weight': 100.0
+                }
+            }
+        },
+        'trends': ['diverging', 'stagnating'],
+    },
+    {
+        'name': 'mixer_sum',
+        'args': {
+            'mixer': {
+                '@function': 'MixerSum',
+                'args': {
+                    'beta': 0.02,
+                    'nmaxold': 8,
+                    'weight': 100.0
+                }
+            }
+        },
+        'trends': ['stagnating'],
+    },
+    {
+        'name': 'fermi_dirac',
+        'args': {
+            'occupations': {
+                '@function': 'FermiDirac',
+                'args': {
+                    'width': 0.1
+                }
+            }
+        },
+        'trends': ['diverging', 'stagnating'],
+    },
+    {
+        'name': 'eigensolver',
+        'args': {
+            'eigensolver': 'cg'
+        },
+        'trends': ['stagnating'],
+    },
+)
+
+
+def validate_scf_ladder(value, _):
+    """Validate the ``scf_ladder`` input of the ``GpawBaseWorkChain``."""
+    for index, rung in enumerate(value.get_list()):
+        if not isinstance(rung, dict) or not isinstance(rung.get('args', None), dict):
+            return f'rung {index} of the `scf_ladder` should be a dictionary with the `args` of the calculator.'
+        unknown = set(rung.get('trends', SCF_TRENDS)) - set(SCF_TRENDS)
+        if unknown:
+            return f'rung {index} of the `scf_ladder` has unknown trends {sorted(unknown)}, use: {SCF_TRENDS}'
+    return None
+
+
+def get_scf_trend(scf_telemetry, target, max_iterations, window=10, threshold=0.02):
+    """Return the trend of the density residual of the last SCF cycle and its best value.
+
+    The trend is the slope of a linear fit of the log10 of the density residual over the last ``window`` iterations. A
+    decreasing residual is only ``converging`` if it would reach the target within ``max_iterations`` in total.
+
+    :param scf_telemetry: the ``scf_telemetry`` output ``ArrayData`` with the arrays of each iteration.
+    :param target: the log10 of the density residual at which the SCF is converged.
+    :param max_iterations: the maximum number of iterations of an SCF cycle that would be acceptable.
+    :param window: the number of last iterations of the fit.
+    :param threshold: the absolute value of the slope, per iteration, below which the residual is stagnating.
+    :return: tuple of the trend, the best log10 of the density residual, and the number of iterations that a converging
+        cycle needs in total, or ``None`` if the telemetry does not contain the residuals.
+    """
+    if 'density_residual' not in scf_telemetry.get_arraynames():
+        return None
+
+    cycles = scf_telemetry.get_array('cycle')
+    residuals = scf_telemetry.get_array('density_residual')[cycles == cycles.max()] if cycles.size else cycles
+    residuals = residuals[~numpy.isnan(residuals)]
+
+    if residuals.size < 2:
+        return None
+
+    recent = residuals[-window:]
+    slope = numpy.polyfit(numpy.arange(recent.size), recent, 1)[0]
+    best = float(residuals.min())
+    needed = None
+
+    if slope < -threshold:
+        needed = residuals.size + math.ceil((target - recent[-1]) / slope)
+        trend = 'converging' if needed <= max_iterations else 'stagnating'
+    elif slope > threshold:
+        trend = 'diverging'
+    else:
+        trend = 'stagnating'
+
+    return trend, best, needed
+
+
+def get_next_rung(ladder, start, trend=None):
+    """Return the index of the first rung of the ladder from ``start`` that addresses the trend.
+
+    :param ladder: the list of rungs.
+    :param start: the index of the first rung to consider.
+    :param trend: the trend of the density residual, or ``None`` if it is not known, in which case any rung applies.
+    :return: the index of the rung, or ``None`` if no rung applies.
+    """
+    for index in range(start, len(ladder)):
+        if trend is None or trend in ladder[index].get('trends', SCF_TRENDS):
+            return index
+    return None
+
+
+def apply_rung(parameters, rung):
+    """Set the arguments of the calculator of a rung in the parameters of an ``AseCalculation``.
+
+    :param parameters: the dictionary of the ``parameters`` input, which is updated in place.
+    :param rung: the rung of the ladder.
+    """
+    parameters.setdefault('calculator', {}).setdefault('args', {}).update(rung['args'])
+
+    extra_imports = parameters.setdefault('extra_imports', [])
+    for value in rung['args'].values():
+        if isinstance(value, dict) and '@function' in value and ['gpaw', value['@function']] not in extra_imports:
+            extra_imports.append(['gpaw', value['@function']])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Extrapolation of the cost of the remaining ionic steps of a relaxation that ran out of walltime.
+
+The average duration of an ionic step is measured from the outputs of the failed calculation, in order of preference:
+
+* ``timings``: the duration of each step of the optimizer, if the calculation was profiled.
+* ``optimizer_log``: the time stamps of the steps in the log of the optimizer.
+* the walltime marker: the elapsed time and the number of steps when the relaxation was stopped before the walltime.
+
+The number of remaining steps is extrapolated from the decrease of the maximum force in the log of the optimizer.
+"""
+import math
+
+import numpy
+
+FMAX_DEFAULT = 0.05  # default ``fmax`` of ``Optimizer.run`` of ASE
+
+
+def get_step_time(optimizer_log=None, timings=None, walltime=None):
+    """Return the average duration of an ionic step, and the duration of the part of the run before the first step.
+
+    The part before the first step includes the construction of the calculator and the first SCF cycle, which is
+    usually more expensive than those of the following steps that start from the previous wavefunctions.
+
+    :param optimizer_log: the ``optimizer_log`` output ``ArrayData``.
+    :param timings: the dictionary of the ``timings`` output.
+    :param walltime: the dictionary of the walltime marker, with the ``elapsed`` time and the number of ``steps``.
+    :return: tuple of the durations in seconds, or ``None`` if none of the sources has a complete ionic step.
+    """
+    steps = numpy.array((timings or {}).get('steps', []), dtype=float)
+
+    if steps.size > 1:
+        phases = timings.get('phases', {})
+        return float(steps[1:].mean()), float(steps[0] + phases.get('imports', 0.0) + phases.get('setup', 0.0))
+
+    times = optimizer_log.get_array('times') if optimizer_log is not None else numpy.array([])
+
+    if times.size > 1:
+        step_time = float(numpy.diff(times).mean())
+        if walltime is not None:
+            return step_time, max(walltime['elapsed'] - (times.size - 1) * step_time, step_time)
+        return step_time, step_time
+
+    if walltime is not None and walltime['elapsed'] > 0:
+        step_time = walltime['elapsed'] / (walltime['steps'] + 1)
+        return step_time, step_time
+
+    return None
+
+
+def estimate_remaining_steps(fmax, fmax_target, max_steps=None, window=10):
+    """Return the number of ionic steps that the relaxation still needs to reach the target maximum force.
+
+    The number is extrapolated from a linear fit of the log10 of the maximum force over the last ``window`` steps. If
+    the maximum force does not decrease, the relaxation is assumed to need as many steps as it already did.
+
+    :param fmax: the maximum force of each step of the failed calculation.
+    :param fmax_target: the maximum force at which the relaxation is converged.
+    :param max_steps: the maximum number of steps of a single run of the optimizer, if any.
+    :param window: the number of last steps of the fit.
+    :return: the number of remaining steps, at least one.
+    """
+    fmax = numpy.asarray(fmax, dtype=float)
+    fmax = fmax[fmax > 0]
+    remaining = None
+
+    if fmax.size > 1:
+        recent = numpy.log10(fmax[-window:])
+        slope = numpy.polyfit(numpy.arange(recent.size), recent, 1)[0]
+        if slope < 0:
+            remaining = math.ceil((math.log10(fmax_target) - recent[-1]) / slope)
+
+    if remaining is None:
+        remaining = max_steps if max_steps is not None else max(fmax.size, 1)
+
+    if max_steps is not None:
+        remaining = min(remaining, max_steps)
+
+    return max(remaining, 1)
+
+
+def fit_resources(cost, num_machines, max_seconds, *, max_machines=None, safety=1.2, margin=0, min_seconds=600):
+    """Return the walltime and the number of machines in which the remaining steps of a relaxation fit.
+
+    The duration of the steps is assumed to scale inversely with the number of machines, the part before the first step
+    is not. The number of machines is only increased if the steps do not fit within ``max_seconds``.
+
+    :param cost: tuple of the average duration of an ionic step, the duration before the first step and the number of
+        remaining steps, on ``num_machines`` machines.
+    :param num_machines: the number of machines of the failed calculation.
+    :param max_seconds: the maximum walltime in seconds.
+    :param max_machines: the maximum number of machines, or ``None`` to keep ``num_machines``.
+    :param safety: the factor of the extrapolated duration that is requested.
+    :param margin: the ``walltime_margin`` in seconds, at which the script stops the relaxation before the walltime.
+    :param min_seconds: the minimum walltime in seconds, unless ``max_seconds`` is smaller.
+    :return: tuple of the walltime in seconds, rounded up to a minute, the number of machines and whether the
+        remaining steps are expected to fit.
+    """
+    step_time, overhead, steps = cost
+
+    def get_seconds(machines):
+        duration = (overhead + steps * step_time * num_machines / machines) * safety + margin
+        return 60 * math.ceil(duration / 60)
+
+    machines = num_machines
+    while get_seconds(machines) > max_seconds and max_machines is not None and machines < max_machines:
+        machines += 1
+
+    seconds = get_seconds(machines)
+
+    return min(max(seconds, min_seconds), max_seconds), machines, seconds <= max_seconds
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 """Tests for the ``AseCalculation`` class."""
-from aiida.common import datastructures
+import io
+
+from aiida import engine, orm
+from aiida.common import InputValidationError, datastructures
+import pytest
 
 from aiida_ase.calculations.ase import AseCalculation
 
@@ -38,3 +42,389 @@ def test_gpw_file(fixture_sandbox, generate_calc_job, generate_inputs_ase, file_
 
     # Checks on the files written to the sandbox folder as raw input
     file_regression.check(input_written, encoding='utf-8', extension='.in')
+
+
+def test_batch(fixture_sandbox, generate_calc_job, generate_inputs_ase, generate_structure, file_regression):
+    """Test a batched ``AseCalculation`` that computes multiple structures with a single calculator."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    parameters = inputs['parameters'].get_dict()
+    parameters.pop('optimizer')
+    inputs['parameters'] = orm.Dict(parameters)
+    inputs['structures'] = {'first': inputs.pop('structure'), 'second': generate_structure(('Si', 'Si'))}
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    assert isinstance(calc_info, datastructures.CalcInfo)
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    file_regression.check(input_written, encoding='utf-8', extension='.in')
+
+
+def test_batch_optimizer(generate_inputs_ase, generate_structure):
+    """Test that the ``optimizer`` is rejected for a batched ``AseCalculation``."""
+    inputs = generate_inputs_ase()
+    inputs['structures'] = {'first': inputs.pop('structure'), 'second': generate_structure()}
+
+    with pytest.raises(ValueError, match=r'the `optimizer` is not supported for a batched calculation'):
+        engine.run(AseCalculation, **inputs)
+
+
+def test_results_npz(fixture_sandbox, generate_calc_job, generate_inputs_ase, file_regression):
+    """Test an ``AseCalculation`` with the ``npz`` results format."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['results_format'] = 'npz'
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    assert AseCalculation._OUTPUT_ARRAYS_FILE_NAME in calc_info.retrieve_list  # pylint: disable=protected-access
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    file_regression.check(input_written, encoding='utf-8', extension='.in')
+
+
+def test_walltime_margin(fixture_sandbox, generate_calc_job, generate_inputs_ase, file_regression):
+    """Test an ``AseCalculation`` relaxation that is stopped cleanly before the walltime."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['max_wallclock_seconds'] = 3600
+    inputs['metadata']['options']['walltime_margin'] = 120
+    inputs['metadata']['options']['write_gpw'] = True
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    assert AseCalculation._WALLTIME_FILE_NAME in calc_info.retrieve_list  # pylint: disable=protected-access
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    file_regression.check(input_written, encoding='utf-8', extension='.in')
+
+
+def test_optimizer_state(fixture_sandbox, generate_calc_job, generate_inputs_ase):
+    """Test that the ``optimizer_state`` input is copied to the restart file of the optimizer."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['optimizer_state'] = orm.SinglefileData(io.BytesIO(b'[]'), filename='state.json').store()
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    filename = AseCalculation._OPTIMIZER_STATE_FILE_NAME  # pylint: disable=protected-access
+    assert calc_info.local_copy_list == [(inputs['optimizer_state'].uuid, 'state.json', filename)]
+    assert filename in calc_info.retrieve_list
+
+
+def test_optimizer_without_restart(fixture_sandbox, generate_calc_job, generate_inputs_ase):
+    """Test that no restart file is passed to an optimizer that sets the ``restart`` argument itself."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    parameters = inputs['parameters'].get_dict()
+    parameters['optimizer'] = {'name': 'SciPyFminBFGS', 'run_args': {'fmax': 0.05}}
+    inputs['parameters'] = orm.Dict(parameters)
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    with fixture_sandbox.open('aiida_script.py') as handle:
+        assert 'restart=' not in handle.read()
+
+    filename = AseCalculation._OPTIMIZER_STATE_FILE_NAME  # pylint: disable=protected-access
+    assert filename not in calc_info.retrieve_list
+
+    inputs['optimizer_state'] = orm.SinglefileData(io.BytesIO(b'[]'), filename='state.json').store()
+
+    with pytest.raises(InputValidationError, match=r'requires an `optimizer` that takes a `restart` file'):
+        generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+
+def test_parent_folder(
+    fixture_sandbox, fixture_localhost, generate_calc_job, generate_inputs_ase, file_regression, tmp_path
+):
+    """Test that the GPW file of the ``parent_folder`` is symlinked and used to start the calculator."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['parent_folder'] = orm.RemoteData(computer=fixture_localhost, remote_path=str(tmp_path)).store()
+    (tmp_path / 'aiida_gpw.gpw').touch()
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    parent_gpw = (fixture_localhost.uuid, str(tmp_path / 'aiida_gpw.gpw'), AseCalculation._PARENT_GPW_FILE_NAME)  # pylint: disable=protected-access
+    assert calc_info.remote_symlink_list == [parent_gpw]
+    assert calc_info.remote_copy_list == []
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    file_regression.check(input_written, encoding='utf-8', extension='.in')
+
+
+@pytest.mark.parametrize('symlink', (True, False))
+def test_parent_folder_missing(
+    fixture_sandbox, fixture_localhost, generate_calc_job, generate_inputs_ase, tmp_path, symlink
+):
+    """Test that a GPW file that is missing on the ``parent_folder`` is neither symlinked nor copied."""
+    inputs = generate_inputs_ase()
+    inputs['parent_folder'] = orm.RemoteData(computer=fixture_localhost, remote_path=str(tmp_path)).store()
+    inputs['settings'] = orm.Dict({'PARENT_FOLDER_SYMLINK': symlink})
+
+    calc_info = generate_calc_job(fixture_sandbox, 'ase.ase', inputs)
+
+    assert calc_info.remote_symlink_list == []
+    assert calc_info.remote_copy_list == []
+
+
+def test_profile(fixture_sandbox, generate_calc_job, generate_inputs_ase, file_regression):
+    """Test an ``AseCalculation`` whose script records the timings of its phases."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['profile'] = True
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    assert AseCalculation._TIMINGS_FILE_NAME in calc_info.retrieve_list  # pylint: disable=protected-access
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    file_regression.check(input_written, encoding='utf-8', extension='.in')
+
+
+def test_log_digest(fixture_sandbox, generate_calc_job, generate_inputs_ase, file_regression):
+    """Test an ``AseCalculation`` whose script writes a digest of the log, which is then only retrieved temporarily."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['log_digest'] = True
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    assert AseCalculation._LOG_DIGEST_FILE_NAME in calc_info.retrieve_list  # pylint: disable=protected-access
+    assert AseCalculation._TXT_OUTPUT_FILE_NAME not in calc_info.retrieve_list  # pylint: disable=protected-access
+    assert calc_info.retrieve_temporary_list == [AseCalculation._TXT_OUTPUT_FILE_NAME]  # pylint: disable=protected-access
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    file_regression.check(input_written, encoding='utf-8', extension='.in')
+
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['log_digest'] = True
+    inputs['metadata']['options']['retrieve_log'] = False
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    assert not calc_info.retrieve_temporary_list
+
+
+@pytest.mark.parametrize(('gpw_storage', 'retrieve_list', 'retrieve_temporary_list'), (
+    ('remote', False, False),
+    ('retrieve', True, False),
+    ('retrieve_temporary', False, True),
+))
+def test_gpw_storage(
+    fixture_sandbox, generate_calc_job, generate_inputs_ase, gpw_storage, retrieve_list, retrieve_temporary_list
+):
+    """Test the ``gpw_storage`` option, which determines whether the GPW file is retrieved."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['write_gpw'] = True
+    inputs['metadata']['options']['gpw_storage'] = gpw_storage
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    gpw_filename = AseCalculation._GPW_FILE_NAME  # pylint: disable=protected-access
+    assert (gpw_filename in calc_info.retrieve_list) is retrieve_list
+    assert (gpw_filename in calc_info.retrieve_temporary_list) is retrieve_temporary_list
+
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['gpw_storage'] = 'invalid'
+
+    with pytest.raises(InputValidationError, match=r'unsupported GPW storage `invalid`'):
+        generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+
+def test_scratch_env(fixture_sandbox, generate_calc_job, generate_inputs_ase, file_regression):
+    """Test an ``AseCalculation`` whose script runs in a node-local scratch directory."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['scratch_env'] = 'TMPDIR'
+    inputs['metadata']['options']['write_gpw'] = True
+    inputs['metadata']['options']['freq_gpw_write'] = 5
+
+    generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    file_regression.check(input_written, encoding='utf-8', extension='.in')
+
+
+def test_gpw_checkpoint(fixture_sandbox, generate_calc_job, generate_inputs_ase):
+    """Test the options of the GPW checkpoints written during a relaxation."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options'].update({
+        'write_gpw': True,
+        'freq_gpw_write': 5,
+        'gpw_keep': 3,
+        'gpw_write_interval': 600,
+        'gpw_rotate_async': True,
+    })
+
+    generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    assert "checkpoint = Checkpoint('aiida_gpw.gpw', keep=3, background=True)" in input_written
+    assert 'calculator.attach(checkpoint.write_if_due, 1, 600)' in input_written
+    assert 'calculator.attach(checkpoint.write, 5)' not in input_written
+
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options'].update({'write_gpw': True, 'gpw_keep': 0})
+
+    with pytest.raises(InputValidationError, match=r'the `gpw_keep` option should be at least 1.'):
+        generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+
+def test_structure_format(fixture_sandbox, generate_calc_job, generate_inputs_ase):
+    """Test the binary ``traj`` format of the input and output structure files."""
+    from ase.io import read
+
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['structure_format'] = 'traj'
+
+    calc_info = generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    assert "atoms = ase.io.read('aiida_atoms.traj')" in input_written
+    assert "atoms.write('aiida_out_atoms.traj')" in input_written
+    assert 'aiida_out_atoms.traj' in calc_info.retrieve_list
+
+    atoms = read(fixture_sandbox.get_abs_path('aiida_atoms.traj'), format='traj')
+    assert atoms.get_chemical_symbols() == inputs['structure'].get_ase().get_chemical_symbols()
+
+
+def test_sidecar_arrays(fixture_sandbox, generate_calc_job, generate_inputs_ase):
+    """Test that large numeric arrays of the calculator arguments are written to sidecar files."""
+    import numpy
+
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    parameters = inputs['parameters'].get_dict()
+    parameters['calculator']['args']['magmoms'] = [0.5] * 10
+    parameters['calculator']['args']['charges'] = [0.1] * 9
+    inputs['parameters'] = orm.Dict(parameters)
+    inputs['metadata']['options']['sidecar_threshold'] = 10
+
+    generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    assert "magmoms=numpy.load('aiida_arg_magmoms.npy').tolist()" in input_written
+    assert f'charges={[0.1] * 9}' in input_written
+    content = ['aiida_arg_magmoms.npy', 'aiida_atoms.json', 'aiida_script.py']
+    assert sorted(fixture_sandbox.get_content_list()) == content
+
+    with fixture_sandbox.open('aiida_arg_magmoms.npy', 'rb') as handle:
+        assert numpy.load(handle).tolist() == [0.5] * 10
+
+
+def test_kpoints_list(fixture_sandbox, generate_calc_job, generate_inputs_ase):
+    """Test an explicit list of k-points, whose weights are passed to the calculator if they are not all equal."""
+    import numpy
+
+    entry_point_name = 'ase.ase'
+    kpoints = orm.KpointsData()
+    kpoints.set_kpoints([[0, 0, 0], [0.5, 0, 0]], weights=[1., 3.])
+
+    inputs = generate_inputs_ase()
+    inputs['kpoints'] = kpoints
+    inputs['metadata']['options']['kpoints_weights_arg'] = 'kpts_weights'
+
+    generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+    with fixture_sandbox.open(AseCalculation._INPUT_FILE_NAME) as handle:  # pylint: disable=protected-access
+        input_written = handle.read()
+
+    assert "kpts=numpy.load('aiida_arg_kpts.npy').tolist()" in input_written
+    assert "kpts_weights=numpy.load('aiida_arg_kpts_weights.npy').tolist()" in input_written
+
+    with fixture_sandbox.open('aiida_arg_kpts_weights.npy', 'rb') as handle:
+        assert numpy.load(handle).tolist() == [0.25, 0.75]
+
+    inputs = generate_inputs_ase()
+    inputs['kpoints'] = kpoints
+
+    with pytest.raises(InputValidationError, match=r'the k-points have different weights'):
+        generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+
+def test_reduce_kpoints_gpaw(fixture_sandbox, generate_calc_job, generate_inputs_ase):
+    """Test that the ``reduce_kpoints`` option is rejected for GPAW, which takes no weights of the k-points."""
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['reduce_kpoints'] = True
+    inputs['metadata']['options']['kpoints_weights_arg'] = 'kpts_weights'
+
+    with pytest.raises(ValueError, match=r'the `reduce_kpoints` option is not supported for GPAW'):
+        generate_calc_job(fixture_sandbox, 'ase.ase', inputs)
+
+
+def test_preflight_compile(fixture_sandbox, generate_calc_job, generate_inputs_ase):
+    """Test that a syntax error in the generated script is found before the job is submitted, by default."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    parameters = inputs['parameters'].get_dict()
+    parameters['pre_lines'] = ['print("unterminated)']
+    inputs['parameters'] = orm.Dict(parameters)
+
+    with pytest.raises(InputValidationError, match=r'has a syntax error at line'):
+        generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+
+ZEROS_VALID = {'magmoms': {'@function': 'numpy.zeros', 'args': {'shape': 1}}}
+ZEROS_INVALID = {'magmoms': {'@function': 'numpy.zeros', 'args': {'wrong_argument': 1}}}
+
+
+@pytest.mark.parametrize(('level', 'calculator_args', 'extra_imports', 'message'), (
+    ('imports', {}, ['numpy.linalg'], None),
+    ('imports', {}, ['nonexistent_module'], r'the import lines failed: `import nonexistent_module`'),
+    ('imports', ZEROS_INVALID, [], None),
+    ('construct', ZEROS_VALID, [], None),
+    ('construct', ZEROS_INVALID, [], r'wrong_argument'),
+))
+def test_preflight_subprocess(
+    fixture_sandbox, generate_calc_job, generate_inputs_ase, level, calculator_args, extra_imports, message
+):
+    """Test the levels of the preflight validation that run the script in a local interpreter in a dry run."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    parameters = inputs['parameters'].get_dict()
+    parameters['calculator'] = {'name': 'emt', 'args': calculator_args}
+    parameters['extra_imports'] = extra_imports
+    inputs['parameters'] = orm.Dict(parameters)
+    inputs['metadata']['options']['preflight'] = level
+    inputs['metadata']['dry_run'] = True
+
+    if message is None:
+        generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+    else:
+        with pytest.raises(InputValidationError, match=message):
+            generate_calc_job(fixture_sandbox, entry_point_name, inputs)
+
+
+@pytest.mark.parametrize('level', ('imports', 'construct'))
+def test_preflight_subprocess_submit(fixture_sandbox, generate_calc_job, generate_inputs_ase, level):
+    """Test that the levels of the preflight validation that run a subprocess are rejected outside of a dry run."""
+    entry_point_name = 'ase.ase'
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['preflight'] = level
+
+    with pytest.raises(ValueError, match=r'only supported in a dry run'):
+        generate_calc_job(fixture_sandbox, entry_point_name, inputs)
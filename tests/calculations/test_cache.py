@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Tests for the result cache and the canonical hash of the ``AseCalculation``."""
+import copy
+import json
+
+from aiida import engine, orm
+from aiida.common import LinkType
+import numpy
+
+from aiida_ase.calculations.ase import AseCalculation
+from aiida_ase.calculations.cache import (
+    RESULT_CACHE_EXTRA,
+    RESULT_CACHE_SOURCE_EXTRA,
+    canonicalize,
+    evict_result_cache,
+    get_atom_mapping,
+    get_cached_outputs,
+    get_result_cache_key,
+    get_structure_fingerprint,
+)
+from aiida_ase.calculations.node import AseCalcJobNode
+
+
+def generate_structure(positions, symbols=('Si', 'Si', 'O')):
+    """Return a periodic ``StructureData`` with the given positions."""
+    structure = orm.StructureData(cell=[[4, 0, 0], [0, 4, 0], [0, 0, 4]])
+    for position, symbol in zip(positions, symbols):
+        structure.append_atom(position=position, symbols=symbol)
+    return structure
+
+
+def test_canonicalize():
+    """Test that semantically identical parameters have the same canonical form."""
+    first = {'kpts': {'size': (2, 2, 2), 'gamma': True}, 'ecut': 300, 'imports': [('gpaw', 'Mixer')]}
+    second = {'ecut': 300, 'imports': [['gpaw', 'Mixer']], 'kpts': {'gamma': True, 'size': [2, 2, 2]}}
+    assert canonicalize(first) == canonicalize(second)
+    assert canonicalize({'beta': 0.05}) != canonicalize({'beta': 0.06})
+
+    # the type of numbers is kept, e.g. an integer and a float ``nbands`` are interpreted differently by GPAW
+    assert json.dumps(canonicalize({'nbands': 1})) != json.dumps(canonicalize({'nbands': 1.0}))
+
+
+def test_structure_fingerprint():
+    """Test that the fingerprint ignores permutations, translations and displacements below the tolerance."""
+    positions = [(0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (2.0, 0.5, 0.5)]
+    reference = get_structure_fingerprint(generate_structure(positions), 1e-4)
+
+    within_tolerance = generate_structure([(0.0, 0.0, 0.0), (1.0, 1.0, 1.00001), (2.0, 0.5, 0.5)])
+    coarse = get_structure_fingerprint(generate_structure(positions), 1e-3)
+    assert get_structure_fingerprint(within_tolerance, 1e-3) == coarse
+
+    permuted = generate_structure([positions[2], positions[1], positions[0]], symbols=('O', 'Si', 'Si'))
+    assert get_structure_fingerprint(permuted, 1e-4) == reference
+
+    translated = generate_structure([(x + 3.5, y - 1.2, z + 0.3) for x, y, z in positions])
+    assert get_structure_fingerprint(translated, 1e-4) == reference
+
+    displaced = generate_structure([(0.0, 0.0, 0.0), (1.0, 1.0, 1.1), (2.0, 0.5, 0.5)])
+    assert get_structure_fingerprint(displaced, 1e-4) != reference
+
+
+def test_result_cache(aiida_localhost, generate_calc_job_node, generate_inputs_ase):
+    """Test that the outputs of a calculation with the same result cache key are reused without submitting a job."""
+    from aiida.engine.utils import instantiate_process
+    from aiida.manage.manager import get_manager
+
+    inputs = generate_inputs_ase()
+    inputs['structure'] = generate_structure([(0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (2.0, 0.5, 0.5)])
+    inputs['metadata']['options']['result_cache'] = True
+
+    # the key is computed from the inputs with the defaults of the options filled in by the process
+    key = get_result_cache_key(instantiate_process(get_manager().get_runner(), AseCalculation, **inputs).inputs, 1e-4)
+
+    cached = generate_calc_job_node('ase.ase', aiida_localhost, 'default_ase', dict(inputs))
+    parameters = orm.Dict({'total_energy': -1.0})
+    parameters.base.links.add_incoming(cached, link_type=LinkType.CREATE, link_label='parameters')
+    parameters.store()
+    cached.set_exit_status(0)
+    cached.base.extras.set(RESULT_CACHE_EXTRA, key)
+
+    # the same structure, with differences of the positions below the tolerance
+    inputs = generate_inputs_ase()
+    inputs['structure'] = generate_structure([(0.0, 0.0, 0.0), (1.0, 1.0, 1.00001), (2.0, 0.5, 0.5)])
+    inputs['metadata']['options']['result_cache'] = True
+
+    results, node = engine.run_get_node(AseCalculation, **inputs)
+
+    assert node.is_finished_ok
+    assert results['parameters'].get_dict() == {'total_energy': -1.0}
+    assert node.base.extras.get(RESULT_CACHE_EXTRA) == key
+    assert node.base.extras.get(RESULT_CACHE_SOURCE_EXTRA) == cached.uuid
+
+    assert evict_result_cache(max_entries=1) == 1
+    assert RESULT_CACHE_EXTRA not in cached.base.extras.all
+
+
+def test_result_cache_key(aiida_localhost, generate_inputs_ase):
+    """Test that the key of the result cache depends on the inputs and options that change the outputs."""
+    inputs = generate_inputs_ase()
+    inputs['structure'] = generate_structure([(0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (2.0, 0.5, 0.5)])
+    inputs['metadata'] = {'options': {'parser_name': 'ase.ase', 'write_gpw': False}}
+    reference = get_result_cache_key(inputs, 1e-4)
+
+    for option, value in (('scf_telemetry', 'full'), ('reduce_kpoints', True), ('gpw_keep', 2), ('profile', True)):
+        options = {**inputs['metadata']['options'], option: value}
+        assert get_result_cache_key({**inputs, 'metadata': {'options': options}}, 1e-4) != reference
+
+    parent_folder = orm.RemoteData(computer=aiida_localhost, remote_path='/tmp')
+    assert get_result_cache_key({**inputs, 'parent_folder': parent_folder}, 1e-4) != reference
+
+    # explicit k-points are not rounded with the tolerance of the positions
+    keys = []
+    for offset in (0.0, 1e-5):
+        kpoints = orm.KpointsData()
+        kpoints.set_kpoints([[0.0, 0.0, 0.0], [0.25 + offset, 0.0, 0.0]], weights=[0.5, 0.5])
+        keys.append(get_result_cache_key({**inputs, 'kpoints': kpoints}, 1e-4))
+    assert keys[0] != keys[1]
+
+
+def test_atom_mapping():
+    """Test the mapping of the atoms of a permuted and translated structure onto those of the source structure."""
+    positions = [(0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (2.0, 0.5, 0.5)]
+    source = generate_structure(positions)
+
+    permutation, translation = get_atom_mapping(source, source, 1e-4)
+    assert permutation.tolist() == [0, 1, 2]
+    assert translation.tolist() == [0.0, 0.0, 0.0]
+
+    shifted = [(x + 0.5, y + 0.5, z + 0.5) for x, y, z in positions]
+    structure = generate_structure([shifted[2], shifted[1], shifted[0]], symbols=('O', 'Si', 'Si'))
+    permutation, translation = get_atom_mapping(structure, source, 1e-4)
+    assert permutation.tolist() == [2, 1, 0]
+    assert numpy.allclose(translation, 0.5)
+
+    assert get_atom_mapping(
+        generate_structure([(0.0, 0.0, 0.0), (1.0, 1.0, 1.1), (2.0, 0.5, 0.5)]), source, 1e-4
+    ) is None
+
+
+def test_cached_outputs(aiida_localhost, generate_calc_job_node, generate_inputs_ase):
+    """Test that the per-atom outputs of a cached calculation are mapped onto the atoms of the structure."""
+    positions = [(0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (2.0, 0.5, 0.5)]
+    inputs = generate_inputs_ase()
+    inputs['structure'] = generate_structure(positions)
+
+    cached = generate_calc_job_node('ase.ase', aiida_localhost, 'default_ase', dict(inputs))
+
+    array = orm.ArrayData()
+    array.set_array('forces', numpy.array([[0.0, 0.0, 0.1], [0.0, 0.2, 0.0], [0.3, 0.0, 0.0]]))
+    array.set_array('stress', numpy.zeros(6))
+
+    structure = generate_structure([(0.0, 0.0, 0.1), (1.0, 1.0, 1.0), (2.0, 0.5, 0.5)])
+
+    trajectory = orm.TrajectoryData()
+    trajectory.set_trajectory(
+        symbols=['Si', 'Si', 'O'],
+        positions=numpy.array([positions, structure.get_ase().positions]),
+        cells=numpy.array([structure.cell] * 2),
+    )
+    trajectory.set_array('forces', numpy.array([array.get_array('forces')] * 2))
+
+    for link_label, node in (('array', array), ('structure', structure), ('trajectory', trajectory)):
+        node.base.links.add_incoming(cached, link_type=LinkType.CREATE, link_label=link_label)
+        node.store()
+
+    # the atoms of the structure are in the reverse order and translated by half an Angstrom along each direction
+    inputs['structure'] = generate_structure([(x + 0.5, y + 0.5, z + 0.5) for x, y, z in reversed(positions)],
+                                             symbols=('O', 'Si', 'Si'))
+    outputs = get_cached_outputs(cached, inputs, 1e-4)
+
+    assert numpy.allclose(outputs['array'].get_array('forces'), array.get_array('forces')[::-1])
+    assert numpy.allclose(outputs['array'].get_array('stress'), 0.0)
+    assert [site.kind_name for site in outputs['structure'].sites] == ['O', 'Si', 'Si']
+    assert numpy.allclose(outputs['structure'].sites[2].position, (0.5, 0.5, 0.6))
+    assert outputs['trajectory'].symbols == ['O', 'Si', 'Si']
+    assert numpy.allclose(outputs['trajectory'].get_positions()[-1, 2], (0.5, 0.5, 0.6))
+    assert numpy.allclose(outputs['trajectory'].get_array('forces')[:, 0], [[0.3, 0.0, 0.0]] * 2)
+    assert 'retrieved' in outputs
+
+    # the files of the GPW file on the remote cannot be mapped, so the outputs are only taken for the same atoms
+    gpw_folder = orm.RemoteData(computer=aiida_localhost, remote_path='/tmp')
+    gpw_folder.base.links.add_incoming(cached, link_type=LinkType.CREATE, link_label='gpw_folder')
+    gpw_folder.store()
+
+    assert get_cached_outputs(cached, inputs, 1e-4) is None
+    assert 'gpw_folder' in get_cached_outputs(cached, {'structure': generate_structure(positions)}, 1e-4)
+
+
+def test_canonical_hash(generate_inputs_ase):
+    """Test that the hash of the node does not depend on the form of semantically identical parameters."""
+    from aiida.engine.utils import instantiate_process
+    from aiida.manage.manager import get_manager
+
+    runner = get_manager().get_runner()
+    inputs = generate_inputs_ase()
+    parameters = copy.deepcopy(inputs['parameters'].get_dict())
+
+    equivalent = copy.deepcopy(dict(reversed(list(parameters.items()))))
+    equivalent['calculator']['args'] = dict(reversed(list(equivalent['calculator']['args'].items())))
+
+    different = copy.deepcopy(parameters)
+    different['calculator']['args']['mode']['args']['ecut'] = 400
+
+    different_type = copy.deepcopy(parameters)
+    different_type['calculator']['args']['mode']['args']['ecut'] = 300.0
+
+    hashes = []
+    for value in (parameters, equivalent, different, different_type):
+        process = instantiate_process(runner, AseCalculation, **{**inputs, 'parameters': orm.Dict(value)})
+        hashes.append(process.node.base.caching.get_hash())
+
+    assert hashes[0] == hashes[1]
+    assert hashes[0] != hashes[2]
+    assert hashes[0] != hashes[3]
+
+    # the hash is the same when recomputed for the node loaded from the database
+    node = orm.load_node(process.node.pk)
+    assert isinstance(node, AseCalcJobNode)
+    assert node.base.caching.compute_hash() == hashes[3]
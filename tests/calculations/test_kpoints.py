@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Tests for the reduction of a mesh of k-points by symmetry."""
+import itertools
+
+import numpy
+import pytest
+
+from aiida_ase.calculations.kpoints import get_rotations, reduce_kpoints_mesh
+
+
+def get_cubic_rotations():
+    """Return the 48 rotations of the cubic point group, i.e. the signed permutation matrices."""
+    rotations = []
+    for permutation in itertools.permutations(range(3)):
+        for signs in itertools.product((1, -1), repeat=3):
+            rotation = numpy.zeros((3, 3), dtype=int)
+            rotation[range(3), permutation] = signs
+            rotations.append(rotation)
+    return numpy.array(rotations)
+
+
+@pytest.mark.parametrize(('mesh', 'offset', 'expected'), (
+    ((4, 4, 4), (0, 0, 0), 10),
+    ((4, 4, 4), (0.5, 0.5, 0.5), 4),
+    ((6, 6, 6), (0, 0, 0), 20),
+    ((3, 3, 3), (0, 0, 0), 4),
+))
+def test_reduce_kpoints_mesh(mesh, offset, expected):
+    """Test the number of irreducible k-points of a simple cubic lattice, and that the weights sum to one."""
+    points, weights = reduce_kpoints_mesh(mesh, offset, get_cubic_rotations())
+
+    assert len(points) == len(weights) == expected
+    assert numpy.isclose(weights.sum(), 1)
+    assert numpy.allclose(points[0], numpy.array(offset) / mesh)
+
+
+def test_reduce_kpoints_mesh_time_reversal():
+    """Test that without rotations only the time reversal symmetry reduces the mesh."""
+    identity = numpy.eye(3, dtype=int)[None]
+
+    assert len(reduce_kpoints_mesh((4, 4, 4), (0, 0, 0), identity, time_reversal=False)[0]) == 64
+    assert len(reduce_kpoints_mesh((4, 4, 4), (0, 0, 0), identity)[0]) == (64 + 8) // 2
+
+
+def test_reduce_kpoints_mesh_offset():
+    """Test that an offset other than 0 or 0.5 raises."""
+    with pytest.raises(ValueError, match=r'only offsets of 0 or 0.5 are supported'):
+        reduce_kpoints_mesh((4, 4, 4), (0.25, 0, 0), get_cubic_rotations())
+
+
+def test_get_rotations(generate_structure):
+    """Test the rotations of a simple cubic structure."""
+    pytest.importorskip('spglib')
+
+    assert len(get_rotations(generate_structure())) == 48
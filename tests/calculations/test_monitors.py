@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=redefined-outer-name
+"""Tests for the monitors of a running ``AseCalculation``."""
+import json
+
+from aiida import orm
+from aiida.transports.plugins.local import LocalTransport
+import pytest
+
+from aiida_ase.calculations.ase import AseCalculation
+from aiida_ase.calculations.monitors import is_stalled, monitor_relaxation, monitor_scf
+
+
+@pytest.fixture
+def generate_running_node(aiida_localhost, tmp_path):
+    """Return a ``CalcJobNode`` whose remote working directory is a temporary directory."""
+
+    def _generate_running_node():
+        node = orm.CalcJobNode(computer=aiida_localhost, process_type='aiida.calculations:ase.ase')
+        node.set_option('log_filename', AseCalculation._TXT_OUTPUT_FILE_NAME)  # pylint: disable=protected-access
+        node.set_option('optimizer_stdout', AseCalculation._OPTIMIZER_FILE_NAME)  # pylint: disable=protected-access
+        node.set_remote_workdir(str(tmp_path))
+        return node.store()
+
+    return _generate_running_node
+
+
+@pytest.mark.parametrize(('values', 'expected'), (
+    ([3, 2, 1], False),
+    ([1, 2, 3], False),
+    ([3, 1, 2, 2, 3], True),
+    ([3, 2, 2, 2, 1], False),
+))
+def test_is_stalled(values, expected):
+    """Test that a quantity is stalled if its last values do not reach a new minimum."""
+    assert is_stalled(values, window=3) is expected
+
+
+@pytest.mark.parametrize('diverged', (False, True))
+def test_monitor_scf(generate_running_node, tmp_path, diverged):
+    """Test that the job is killed if the density change of the current SCF cycle oscillates."""
+    node = generate_running_node()
+
+    # a converged SCF cycle followed by one that oscillates or converges slowly
+    lines = [f'iter: {number:3d}  11:29:50  -2.00  {-number / 10:.2f}   -21.867772' for number in range(1, 41)]
+    for number in range(1, 41):
+        density = -1.0 - (number % 4) / 10 if diverged else -1.0 - number / 100
+        lines.append(f'iter: {number:3d}  11:29:50  -2.00  {density:.2f}   -21.867772')
+    (tmp_path / AseCalculation._TXT_OUTPUT_FILE_NAME).write_text('\n'.join(lines) + '\n')  # pylint: disable=protected-access
+
+    with LocalTransport() as transport:
+        result = monitor_scf(node, transport)
+
+    marker = tmp_path / AseCalculation._MONITOR_FILE_NAME  # pylint: disable=protected-access
+
+    if not diverged:
+        assert result is None
+        assert not marker.exists()
+    else:
+        assert not result.override_exit_code
+        assert json.loads(marker.read_text())['exit_code'] == 'ERROR_SCF_DIVERGED'
+
+
+def test_monitor_relaxation(generate_running_node, tmp_path):
+    """Test that the job is killed if the maximum force of the relaxation stalls, and not if the log is missing."""
+    node = generate_running_node()
+
+    with LocalTransport() as transport:
+        assert monitor_relaxation(node, transport) is None
+
+    lines = ['                Step     Time          Energy          fmax']
+    for step, fmax in enumerate([1.0, 0.5, 0.2] + [0.3, 0.25] * 5):
+        lines.append(f'QuasiNewton:   {step:2d} 11:29:53      -21.867772        {fmax:.4f}')
+    (tmp_path / AseCalculation._OPTIMIZER_FILE_NAME).write_text('\n'.join(lines) + '\n')  # pylint: disable=protected-access
+
+    with LocalTransport() as transport:
+        result = monitor_relaxation(node, transport)
+
+    marker = json.loads((tmp_path / AseCalculation._MONITOR_FILE_NAME).read_text())  # pylint: disable=protected-access
+    assert marker['exit_code'] == 'ERROR_RELAX_STALLED'
+    assert marker['message'] == result.message
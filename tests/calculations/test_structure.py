@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Tests for the conversion between ``StructureData`` and ``ase.Atoms`` through arrays."""
+from aiida import orm
+import numpy
+import pytest
+
+from aiida_ase.calculations.structure import get_ase_atoms, get_structure_data
+
+
+def get_atoms():
+    """Return an ``ase.Atoms`` with tags and a custom mass."""
+    import ase
+
+    atoms = ase.Atoms('Fe3O2', positions=numpy.arange(15).reshape(5, 3) / 4, cell=numpy.eye(3) * 4, pbc=True)
+    atoms.set_tags([0, 1, 0, 2, 0])
+    masses = atoms.get_masses()
+    masses[4] = 18.
+    atoms.set_masses(masses)
+    return atoms
+
+
+def test_get_structure_data():
+    """Test that ``get_structure_data`` gives the same structure as ``StructureData(ase=atoms)``."""
+    atoms = get_atoms()
+    structure = get_structure_data(atoms).store()
+    reference = orm.StructureData(ase=atoms).store()
+
+    assert structure.base.attributes.all == reference.base.attributes.all
+
+
+@pytest.mark.parametrize('names', (('Fe', 'Fe1', 'O'), ('Fe', 'Feup', 'O'), ('Fe1', 'Fe2', 'O3')))
+def test_get_ase_atoms(names):
+    """Test that ``get_ase_atoms`` gives the same atoms as ``StructureData.get_ase``, including the tags."""
+    structure = orm.StructureData(cell=[[4, 0, 0], [0, 4, 0], [0, 0, 4]])
+    for index, name in enumerate(names):
+        symbol = 'O' if name.startswith('O') else 'Fe'
+        structure.append_atom(position=(index, index, index), symbols=symbol, name=name)
+    atoms = get_ase_atoms(structure)
+    reference = structure.get_ase()
+
+    assert atoms.get_chemical_symbols() == reference.get_chemical_symbols()
+    assert atoms.get_tags().tolist() == reference.get_tags().tolist()
+    assert numpy.allclose(atoms.get_masses(), reference.get_masses())
+    assert numpy.allclose(atoms.get_positions(), reference.get_positions())
+    assert numpy.allclose(atoms.get_cell(), reference.get_cell())
+    assert sorted(atoms.arrays) == sorted(reference.arrays)
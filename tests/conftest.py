@@ -252,3 +252,57 @@ def generate_kpoints_mesh():
         return kpoints
 
     return _generate_kpoints_mesh
+
+
+@pytest.fixture
+def generate_workchain_gpaw(generate_inputs_ase):
+    """Return a ``GpawBaseWorkChain`` instance whose ``setup`` and ``validate_inputs`` steps have run."""
+
+    def _generate_workchain_gpaw(options=None):
+        from aiida.engine.utils import instantiate_process
+        from aiida.manage.manager import get_manager
+
+        from aiida_ase.workflows.base import GpawBaseWorkChain
+
+        inputs = generate_inputs_ase()
+        structure = inputs.pop('structure')
+        kpoints = inputs.pop('kpoints')
+        inputs['metadata']['options'].update(options or {})
+
+        runner = get_manager().get_runner()
+        process = instantiate_process(runner, GpawBaseWorkChain, gpaw=inputs, structure=structure, kpoints=kpoints)
+        process.setup()
+        process.validate_inputs()
+
+        return process
+
+    return _generate_workchain_gpaw
+
+
+@pytest.fixture
+def generate_failed_calculation(aiida_localhost, generate_inputs_ase):
+    """Return a finished ``AseCalculation`` node that failed with the given exit code and has the given outputs."""
+
+    def _generate_failed_calculation(exit_code, outputs=None, options=None):
+        from aiida.common import LinkType
+        from aiida.engine import ProcessState
+
+        node = orm.CalcJobNode(computer=aiida_localhost, process_type='aiida.calculations:ase.ase')
+        node.set_process_label('AseCalculation')
+        for name, option in (options or {}).items():
+            node.set_option(name, option)
+        parameters = generate_inputs_ase()['parameters'].store()
+        node.base.links.add_incoming(parameters, link_type=LinkType.INPUT_CALC, link_label='parameters')
+        node.store()
+
+        for link_label, output in (outputs or {}).items():
+            output.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label=link_label)
+            output.store()
+
+        node.set_process_state(ProcessState.FINISHED)
+        node.set_exit_status(exit_code.status)
+        node.set_exit_message(exit_code.message)
+
+        return node
+
+    return _generate_failed_calculation
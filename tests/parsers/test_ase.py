@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=unused-argument
 """Tests for the ``AseParser``."""
+import io
+
+from aiida import orm
 from aiida.plugins import CalculationFactory
+import numpy
+import pytest
+
+from aiida_ase.parsers.utils import set_arrays_from_npz
 
 AseCalculation = CalculationFactory('ase.ase')
 
@@ -61,8 +68,14 @@ def test_default_gpaw(aiida_localhost, generate_calc_job_node, generate_parser,
     })
 
 
-def test_failed_relax_gpaw(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
-    """Test a failed GPAW relaxation."""
+@pytest.mark.parametrize(('exit_status', 'expected'), (
+    (None, 'ERROR_RELAX_NOT_COMPLETE'),
+    (120, 'ERROR_OUT_OF_WALLTIME'),
+))
+def test_failed_relax_gpaw(
+    aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase, exit_status, expected
+):
+    """Test a failed GPAW relaxation, also one that was killed by the scheduler at the walltime."""
     name = 'failed_relax_gpaw'
     entry_point_calc_job = 'ase.ase'
     entry_point_parser = 'ase.gpaw'
@@ -70,6 +83,8 @@ def test_failed_relax_gpaw(aiida_localhost, generate_calc_job_node, generate_par
     attributes = {
         'log_filename': AseCalculation._TXT_OUTPUT_FILE_NAME,  # pylint: disable=protected-access
     }
+    if exit_status is not None:
+        attributes['exit_status'] = exit_status
 
     node = generate_calc_job_node(
         entry_point_calc_job, aiida_localhost, name, generate_inputs_ase(), attributes=attributes
@@ -79,7 +94,27 @@ def test_failed_relax_gpaw(aiida_localhost, generate_calc_job_node, generate_par
 
     assert calcfunction.is_finished, calcfunction.exception
     assert calcfunction.is_failed, calcfunction.exit_message
-    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_RELAX_NOT_COMPLETE.status
+    assert calcfunction.exit_status == node.process_class.exit_codes[expected].status
+
+
+def test_paw_not_found_gpaw(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
+    """Test a GPAW calculation whose missing PAW dataset is only reported in the log, which has no ionic step."""
+    name = 'paw_not_found_gpaw'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.gpaw'
+
+    attributes = {
+        'log_filename': AseCalculation._TXT_OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+    }
+
+    node = generate_calc_job_node(
+        entry_point_calc_job, aiida_localhost, name, generate_inputs_ase(), attributes=attributes
+    )
+    parser = generate_parser(entry_point_parser)
+    _, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished, calcfunction.exception
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_PAW_NOT_FOUND.status
 
 
 def test_failed_unexpected(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
@@ -99,3 +134,252 @@ def test_failed_unexpected(aiida_localhost, generate_calc_job_node, generate_par
     assert calcfunction.is_finished, calcfunction.exception
     assert calcfunction.is_failed, calcfunction.exit_message
     assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_UNEXPECTED_EXCEPTION.status
+
+
+def test_batch_ase(
+    aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase, generate_structure, data_regression
+):
+    """Test a batched calculation, which contains the results of multiple structures."""
+    name = 'batch_ase'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.ase'
+
+    attributes = {'output_filename': AseCalculation._OUTPUT_FILE_NAME}  # pylint: disable=protected-access
+
+    inputs = generate_inputs_ase()
+    inputs['structures'] = {'first': inputs.pop('structure'), 'second': generate_structure(('Si', 'Si'))}
+
+    node = generate_calc_job_node(entry_point_calc_job, aiida_localhost, name, inputs, attributes=attributes)
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished, calcfunction.exception
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    assert 'structure' not in results
+    assert sorted(results['array'].get_arraynames()) == ['first__forces', 'second__forces']
+    assert results['array'].get_array('second__forces').shape == (2, 3)
+
+    data_regression.check(results['parameters'].get_dict())
+
+
+def test_default_ase_npz(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
+    """Test a default ASE calculator with the ``npz`` results format."""
+    name = 'default_ase_npz'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.ase'
+
+    attributes = {'output_filename': AseCalculation._OUTPUT_FILE_NAME}  # pylint: disable=protected-access
+
+    node = generate_calc_job_node(
+        entry_point_calc_job, aiida_localhost, name, generate_inputs_ase(), attributes=attributes
+    )
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    assert results['parameters'].get_dict() == {'total_energy': -21.867772543332897, 'warnings': []}
+    assert sorted(results['array'].get_arraynames()) == ['forces', 'stress']
+    assert results['array'].get_array('forces').shape == (5, 3)
+    assert results['array'].get_array('forces')[0, 2] == 0.01
+
+
+def test_set_arrays_from_npz():
+    """Test the arrays of an ``.npz`` archive, also of one with a version 3.0 header and of one with objects."""
+    handle = io.BytesIO()
+    with pytest.warns(UserWarning, match='format 3.0'):
+        numpy.savez(handle, forces=numpy.ones((2, 3)), labels=numpy.zeros(2, dtype=[('\u80fd\u91cf', 'f8')]))
+    handle.seek(0)
+
+    array_data = orm.ArrayData()
+    assert sorted(set_arrays_from_npz(array_data, handle)) == ['forces', 'labels']
+    assert array_data.get_shape('forces') == (2, 3)
+    assert array_data.get_array('labels').dtype.names == ('\u80fd\u91cf',)
+
+    handle = io.BytesIO()
+    numpy.savez(handle, objects=numpy.array([{}, None], dtype=object))
+    handle.seek(0)
+
+    with pytest.raises(ValueError, match='contains Python objects'):
+        set_arrays_from_npz(orm.ArrayData(), handle)
+
+
+def test_relax_traj_gpaw(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
+    """Test a GPAW relaxation for which the optimizer wrote the binary trajectory."""
+    name = 'relax_traj_gpaw'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.gpaw'
+
+    attributes = {
+        'output_filename': AseCalculation._OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+        'log_filename': AseCalculation._TXT_OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+    }
+
+    node = generate_calc_job_node(
+        entry_point_calc_job, aiida_localhost, name, generate_inputs_ase(), attributes=attributes
+    )
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+
+    trajectory = results['trajectory']
+    assert trajectory.numsteps == 3
+    assert trajectory.get_array('positions').shape == (3, 5, 3)
+    assert trajectory.get_array('cells').shape == (3, 3, 3)
+    assert trajectory.get_array('forces').shape == (3, 5, 3)
+    assert trajectory.get_array('energies').tolist() == [-21.86, -21.861, -21.862]
+
+    optimizer_state = results['optimizer_state']
+    assert optimizer_state.filename == AseCalculation._OPTIMIZER_STATE_FILE_NAME  # pylint: disable=protected-access
+    assert optimizer_state.get_content().startswith('[')
+
+    timings = results['timings'].get_dict()
+    assert list(timings['phases']) == ['imports', 'setup', 'optimizer', 'results', 'dump']
+    assert len(timings['steps']) == 2
+
+    assert results['optimizer_log'].get_array('steps').tolist() == [0, 1, 2]
+    assert results['optimizer_log'].get_array('times').tolist() == [0., 6., 11.]
+    assert results['optimizer_log'].get_array('energies').tolist() == [-21.86, -21.861, -21.862]
+    assert results['optimizer_log'].get_array('fmax').tolist() == [0.2415, 0.0873, 0.0312]
+    assert trajectory.get_array('positions')[0, 2, 2] == 0.02
+
+
+def test_walltime_gpaw(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
+    """Test a GPAW relaxation that was stopped by the script before reaching the walltime."""
+    name = 'walltime_gpaw'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.gpaw'
+
+    attributes = {
+        'output_filename': AseCalculation._OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+        'log_filename': AseCalculation._TXT_OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+    }
+
+    node = generate_calc_job_node(
+        entry_point_calc_job, aiida_localhost, name, generate_inputs_ase(), attributes=attributes
+    )
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished, calcfunction.exception
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_OUT_OF_WALLTIME.status
+    assert 'structure' in results
+    assert results['trajectory'].numsteps == 3
+
+
+@pytest.mark.parametrize('scf_telemetry', ('summary', 'full'))
+def test_scf_telemetry_gpaw(
+    aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase, scf_telemetry
+):
+    """Test the SCF telemetry of a GPAW calculation, which is extracted from the log."""
+    name = 'default_gpaw'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.gpaw'
+
+    attributes = {
+        'output_filename': AseCalculation._OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+        'log_filename': AseCalculation._TXT_OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+    }
+
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['scf_telemetry'] = scf_telemetry
+
+    node = generate_calc_job_node(entry_point_calc_job, aiida_localhost, name, inputs, attributes=attributes)
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+
+    telemetry = results['scf_telemetry']
+    assert telemetry.get_array('cycle_iterations').tolist() == [29]
+    assert telemetry.get_array('cycle_converged').tolist() == [True]
+    assert ('density_residual' in telemetry.get_arraynames()) is (scf_telemetry == 'full')
+
+
+def test_monitor_gpaw(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
+    """Test a GPAW relaxation that was killed by a monitor, whose marker determines the exit code."""
+    name = 'monitor_gpaw'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.gpaw'
+
+    attributes = {
+        'output_filename': AseCalculation._OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+        'log_filename': AseCalculation._TXT_OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+    }
+
+    node = generate_calc_job_node(
+        entry_point_calc_job, aiida_localhost, name, generate_inputs_ase(), attributes=attributes
+    )
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished, calcfunction.exception
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_SCF_DIVERGED.status
+    assert results['trajectory'].numsteps == 3
+
+
+def test_log_digest_gpaw(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
+    """Test a GPAW relaxation for which the script wrote a digest of the log, which was not retrieved."""
+    name = 'log_digest_gpaw'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.gpaw'
+
+    attributes = {
+        'output_filename': AseCalculation._OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+        'log_filename': AseCalculation._TXT_OUTPUT_FILE_NAME,  # pylint: disable=protected-access
+    }
+
+    node = generate_calc_job_node(
+        entry_point_calc_job, aiida_localhost, name, generate_inputs_ase(), attributes=attributes
+    )
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    assert 'structure' in results
+    assert results['trajectory'].numsteps == 3
+
+    parameters = results['parameters'].get_dict()
+    assert parameters['energy'] == -21.867772
+    assert parameters['fermi_energy'] == 9.10829
+    assert parameters['energy_contributions']['kinetic'] == -58.892375
+    assert sorted(results['array'].get_arraynames()) == ['dipole', 'eigenvalues', 'forces', 'magmoms', 'pbc', 'stress']
+
+
+def test_gpw_folder(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
+    """Test that the remote folder with the GPW file is referenced if the file was left on the remote."""
+    name = 'default_ase'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.ase'
+
+    attributes = {'output_filename': AseCalculation._OUTPUT_FILE_NAME}  # pylint: disable=protected-access
+
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options'].update({'write_gpw': True, 'gpw_storage': 'remote'})
+
+    node = generate_calc_job_node(entry_point_calc_job, aiida_localhost, name, inputs, attributes=attributes)
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    assert results['gpw_folder'].get_remote_path() == node.outputs.remote_folder.get_remote_path()
+
+
+def test_default_ase_traj(aiida_localhost, generate_calc_job_node, generate_parser, generate_inputs_ase):
+    """Test a default ASE calculator that wrote the output structure in the binary ``traj`` format."""
+    name = 'default_ase_traj'
+    entry_point_calc_job = 'ase.ase'
+    entry_point_parser = 'ase.ase'
+
+    attributes = {'output_filename': AseCalculation._OUTPUT_FILE_NAME}  # pylint: disable=protected-access
+
+    inputs = generate_inputs_ase()
+    inputs['metadata']['options']['structure_format'] = 'traj'
+
+    node = generate_calc_job_node(entry_point_calc_job, aiida_localhost, name, inputs, attributes=attributes)
+    parser = generate_parser(entry_point_parser)
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    assert results['structure'].get_formula() == 'BaO3Ti'
+    assert len(results['structure'].sites) == 5
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=redefined-outer-name
+"""Tests for the single-pass parser of the GPAW text log."""
+import io
+import pathlib
+
+from ase.io import read
+import numpy
+import pytest
+
+from aiida_ase.parsers.gpaw_log import ScfTelemetry, parse_scf_iteration, read_gpaw_log
+
+FIXTURES = pathlib.Path(__file__).parent / 'fixtures' / 'ase'
+
+
+@pytest.fixture
+def generate_log():
+    """Return the content of a GPAW log with a given number of ionic steps, based on the ``default_gpaw`` log."""
+
+    def _generate_log(num_steps, truncate=False):
+        content = (FIXTURES / 'default_gpaw' / 'aiida.out').read_text()
+        start = content.index('Positions:')
+        end = content.index('Timing:')
+        block = content[start:end]
+
+        steps = []
+        for step in range(num_steps):
+            steps.append(block.replace('Extrapolated:   -21.867772', f'Extrapolated:   {-21.867772 - step:.6f}'))
+
+        if truncate:
+            steps.append(block[:block.index('Energy contributions')])
+
+        return content[:start] + ''.join(steps) + content[end:]
+
+    return _generate_log
+
+
+@pytest.mark.parametrize('truncate', (False, True))
+def test_read_gpaw_log(generate_log, truncate):
+    """Test that ``read_gpaw_log`` returns the same frames as ``ase.io.read``."""
+    content = generate_log(3, truncate)
+
+    images, errors = read_gpaw_log(io.StringIO(content))
+    reference = read(io.StringIO(content), index=':', format='gpaw-out')
+
+    assert not errors
+    assert len(images) == len(reference) == 3
+    assert [atoms.get_potential_energy() for atoms in images] == [-21.867772, -22.867772, -23.867772]
+
+    for atoms, atoms_reference in zip(images, reference):
+        assert atoms.get_chemical_symbols() == atoms_reference.get_chemical_symbols()
+        assert numpy.allclose(atoms.positions, atoms_reference.positions)
+        assert numpy.allclose(atoms.cell, atoms_reference.cell)
+        assert atoms.calc.energy_contributions == atoms_reference.calc.energy_contributions
+        assert atoms.calc.eFermi == atoms_reference.calc.eFermi
+        assert numpy.allclose(atoms.calc.get_eigenvalues(), atoms_reference.calc.get_eigenvalues())
+        for key, value in atoms_reference.calc.results.items():
+            assert numpy.allclose(atoms.calc.results[key], value)
+
+
+def test_read_gpaw_log_errors():
+    """Test that ``read_gpaw_log`` reports the error signatures and raises for a log without ionic steps."""
+    with pytest.raises(OSError, match='Corrupted GPAW-text file'):
+        read_gpaw_log(io.StringIO('Did not converge!\n'))
+
+    content = (FIXTURES / 'default_gpaw' / 'aiida.out').read_text() + '\nDid not converge!\n'
+    _, errors = read_gpaw_log(io.StringIO(content))
+    assert errors == {'scf_not_converged'}
+
+
+def test_read_gpaw_log_incomplete_step():
+    """Test that an incomplete step in the middle of the log is skipped and that the following lines are processed."""
+    content = (FIXTURES / 'default_gpaw' / 'aiida.out').read_text()
+    start = content.index('Positions:')
+    end = content.index('Timing:')
+    block = content[start:end]
+    second = block.replace('Extrapolated:   -21.867772', 'Extrapolated:   -22.867772')
+    content = content[:start] + block + block[:block.index('Energy contributions')] + second + content[end:]
+
+    scf_telemetry = ScfTelemetry()
+    images, errors = read_gpaw_log(io.StringIO(content + '\nDid not converge!\n'), scf_telemetry)
+
+    assert [atoms.get_potential_energy() for atoms in images] == [-21.867772, -22.867772]
+    assert errors == {'scf_not_converged'}
+    assert scf_telemetry.get_arrays()['cycle_iterations'].tolist() == [29, 29, 29]
+
+
+@pytest.mark.parametrize(('line', 'expected'), (
+    ('iter:   1  11:29:50                 -24.332893           ', (1, 41390, -24.332893, None, None)),
+    ('iter:   2  11:29:50  -0.85  -1.03   -23.849422           ', (2, 41390, -23.849422, -0.85, -1.03)),
+    ('iter:  27  11:29:53  -8.31  -4.98c  -21.867772           ', (27, 41393, -21.867772, -8.31, -4.98)),
+    ('iter:   2 10:27:37   -10.756009  -0.96  -0.99  +1.0000', (2, 37657, -10.756009, -0.96, -0.99)),
+    ('Converged after 27 iterations.', None),
+))
+def test_parse_scf_iteration(line, expected):
+    """Test the iteration lines of the SCF, of older and newer versions of GPAW."""
+    assert parse_scf_iteration(line) == expected
+
+
+def test_scf_telemetry(generate_log):
+    """Test the iterations of the SCF cycles that are collected while the log is read."""
+    scf_telemetry = ScfTelemetry()
+    images, _ = read_gpaw_log(io.StringIO(generate_log(2, truncate=True)), scf_telemetry)
+
+    arrays = scf_telemetry.get_arrays()
+
+    # the truncated step has no energy, such that it is not an image, but its iterations are collected
+    assert len(images) == 2
+    assert arrays['cycle_iterations'].tolist() == [29, 29, 29]
+    assert arrays['cycle_converged'].tolist() == [True, True, True]
+    assert arrays['iterations_histogram'].tolist() == [0] * 29 + [3]
+    assert arrays['cycle'].tolist() == [0] * 29 + [1] * 29 + [2] * 29
+    assert numpy.isnan(arrays['time'][0]) and numpy.nansum(arrays['time']) == arrays['cycle_time'].sum()
+    assert numpy.isnan(arrays['energy_change'][[0, 29, 58]]).all()
+    assert numpy.isclose(arrays['energy_change'][1], -23.849422 + 24.332893)
+    assert numpy.isnan(arrays['density_residual'][0]) and arrays['density_residual'][1] == -1.03
+
+    summary = scf_telemetry.get_arrays(summary=True)
+    assert sorted(summary) == ['cycle_converged', 'cycle_iterations', 'cycle_time', 'iterations_histogram']
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Guard the import time of the modules of the plugin that are loaded through entry points."""
+import subprocess
+import sys
+
+ENTRY_POINT_MODULES = (
+    'aiida_ase.calculations.ase',
+    'aiida_ase.parsers.ase',
+    'aiida_ase.parsers.gpaw',
+    'aiida_ase.workflows.base',
+)
+
+# Packages that should only be imported when they are first used, e.g. by the parsers
+DEFERRED_PACKAGES = ('ase', 'gpaw')
+
+# Upper bound in microseconds of the summed import time of the modules of the plugin itself
+PLUGIN_IMPORT_BUDGET = 200000
+
+
+def get_import_times(*modules):
+    """Return the self and cumulative import time in microseconds of each module imported when importing ``modules``.
+
+    The modules are imported in a new interpreter with ``-X importtime``, after ``aiida`` itself.
+    """
+    statement = f"import aiida.engine, aiida.orm, aiida.parsers; import {', '.join(modules)}"
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                             capture_output=True,
+                             text=True,
+                             check=True)
+
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_time), int(cumulative))
+
+    return times
+
+
+def test_deferred_imports():
+    """Test that importing the entry point modules does not import the packages that are only needed when used."""
+    times = get_import_times(*ENTRY_POINT_MODULES)
+    imported = sorted(name for name in times if name.split('.')[0] in DEFERRED_PACKAGES)
+    assert not imported, f'the entry point modules import: {imported}'
+
+
+def test_import_time():
+    """Test that the summed import time of the modules of the plugin stays within budget."""
+    times = get_import_times(*ENTRY_POINT_MODULES)
+    plugin_times = {name: value[0] for name, value in times.items() if name.startswith('aiida_ase')}
+    assert sum(plugin_times.values()) < PLUGIN_IMPORT_BUDGET, plugin_times
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Tests for the error handlers of the ``GpawBaseWorkChain``."""
+from aiida import orm
+
+from aiida_ase.workflows.base import CALCULATION_EXIT_CODES
+from aiida_ase.workflows.scf_ladder import DEFAULT_SCF_LADDER
+
+
+def test_handle_relax_not_complete(
+    aiida_localhost, generate_workchain_gpaw, generate_failed_calculation, generate_structure
+):
+    """Test that a relaxation that ran out of steps is continued from its last structure, optimizer state and GPW."""
+    process = generate_workchain_gpaw()
+
+    first = generate_structure(('Ar', 'Ar'))
+    atoms = first.get_ase()
+    atoms.positions[1] += 0.1
+    last = orm.StructureData(ase=atoms)
+    trajectory = orm.TrajectoryData([first, last])
+    optimizer_state = orm.SinglefileData.from_string('[]', filename='aiida_optimizer_state.json')
+    gpw_folder = orm.RemoteData(computer=aiida_localhost, remote_path='/tmp')
+
+    outputs = {'trajectory': trajectory, 'optimizer_state': optimizer_state, 'gpw_folder': gpw_folder}
+    calculation = generate_failed_calculation(CALCULATION_EXIT_CODES.ERROR_RELAX_NOT_COMPLETE, outputs)
+    result = process.handle_relax_not_complete(calculation)
+
+    assert result.do_break
+    assert process.ctx.inputs.structure.get_ase().positions.tolist() == last.get_ase().positions.tolist()
+    assert process.ctx.inputs.optimizer_state.uuid == optimizer_state.uuid
+    assert process.ctx.inputs.parent_folder.uuid == gpw_folder.uuid
+
+
+def test_handle_scf_not_complete_without_telemetry(generate_workchain_gpaw, generate_failed_calculation):
+    """Test that an SCF that did not converge is restarted with the first rung without the ``scf_telemetry``."""
+    process = generate_workchain_gpaw({'scf_telemetry': 'none'})
+    assert process.ctx.inputs.metadata.options.scf_telemetry == 'none'
+
+    calculation = generate_failed_calculation(
+        CALCULATION_EXIT_CODES.ERROR_SCF_NOT_COMPLETE, options={'scf_telemetry': 'none'}
+    )
+    result = process.handle_scf_not_complete(calculation)
+
+    assert result.do_break
+    assert result.exit_code.status == 0
+    assert process.ctx.scf_rung == 1
+    mixer = process.ctx.inputs.parameters['calculator']['args']['mixer']
+    assert mixer == DEFAULT_SCF_LADDER[0]['args']['mixer']
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Tests for the escalation ladder of the restarts of an SCF that did not converge."""
+from aiida import orm
+import numpy
+import pytest
+
+from aiida_ase.workflows.scf_ladder import (
+    DEFAULT_SCF_LADDER,
+    apply_rung,
+    get_next_rung,
+    get_scf_trend,
+    validate_scf_ladder,
+)
+
+
+def generate_scf_telemetry(residuals, cycle=0):
+    """Return an ``ArrayData`` with the density residuals of the iterations of an SCF cycle after a converged one."""
+    residuals = numpy.concatenate([[-1.0, -2.0, -4.5], residuals])
+    cycles = numpy.concatenate([[cycle - 1] * 3, [cycle] * (len(residuals) - 3)])
+    scf_telemetry = orm.ArrayData()
+    scf_telemetry.set_array('cycle', cycles)
+    scf_telemetry.set_array('density_residual', residuals)
+    return scf_telemetry
+
+
+@pytest.mark.parametrize(('residuals', 'expected'), (
+    (numpy.linspace(-1.0, -3.0, 40), 'converging'),
+    (numpy.linspace(-1.0, -1.5, 40), 'stagnating'),
+    (numpy.linspace(-2.0, 0.0, 40), 'diverging'),
+    (-2.0 + 0.3 * (-1)**numpy.arange(40), 'stagnating'),
+))
+def test_get_scf_trend(residuals, expected):
+    """Test the trend of the density residual of the last SCF cycle."""
+    trend, best, needed = get_scf_trend(generate_scf_telemetry(residuals, cycle=1), -4.0, 1000)
+
+    assert trend == expected
+    assert best == pytest.approx(residuals.min())
+
+    if expected == 'converging':
+        # the slope is -2 / 39 per iteration, such that the residual reaches -4 from -3 after 19.5 more iterations
+        assert needed == 40 + 20
+
+
+def test_get_scf_trend_too_many_iterations():
+    """Test that a converging residual that needs more than the maximum number of iterations is stagnating."""
+    trend, _, needed = get_scf_trend(generate_scf_telemetry(numpy.linspace(-1.0, -3.0, 40)), -4.0, 50)
+
+    assert trend == 'stagnating'
+    assert needed == 60
+
+
+def test_get_scf_trend_missing():
+    """Test that the trend is not known without the density residuals."""
+    scf_telemetry = orm.ArrayData()
+    scf_telemetry.set_array('cycle_iterations', numpy.array([333]))
+    assert get_scf_trend(scf_telemetry, -4.0, 1000) is None
+
+    residuals = numpy.array([numpy.nan, -1.0])
+    assert get_scf_trend(generate_scf_telemetry(residuals), -4.0, 1000) is None
+
+
+def test_get_next_rung():
+    """Test the choice of the next rung of the ladder that addresses a trend."""
+    ladder = list(DEFAULT_SCF_LADDER)
+
+    assert get_next_rung(ladder, 0) == 0
+    assert get_next_rung(ladder, 1, 'diverging') == 1
+    assert get_next_rung(ladder, 2, 'diverging') == 3
+    assert get_next_rung(ladder, 2, 'stagnating') == 2
+    assert get_next_rung(ladder, 4, 'diverging') is None
+    assert get_next_rung(ladder, len(ladder)) is None
+    assert get_next_rung([{'args': {}}], 0, 'converging') == 0
+
+
+def test_apply_rung():
+    """Test that the rungs are applied cumulatively and that the functions are imported once."""
+    parameters = {'calculator': {'name': 'gpaw', 'args': {'mode': 'pw'}}, 'extra_imports': [['gpaw', 'Mixer']]}
+
+    for rung in DEFAULT_SCF_LADDER[:4]:
+        apply_rung(parameters, rung)
+
+    args = parameters['calculator']['args']
+    assert args['mode'] == 'pw'
+    assert args['maxiter'] == 1000
+    assert args['mixer'] == DEFAULT_SCF_LADDER[2]['args']['mixer']
+    assert args['occupations'] == {'@function': 'FermiDirac', 'args': {'width': 0.1}}
+    assert parameters['extra_imports'] == [['gpaw', 'Mixer'], ['gpaw', 'MixerSum'], ['gpaw', 'FermiDirac']]
+
+
+def test_validate_scf_ladder():
+    """Test the validation of the ``scf_ladder`` input."""
+    assert validate_scf_ladder(orm.List(list(DEFAULT_SCF_LADDER)), None) is None
+    assert 'dictionary' in validate_scf_ladder(orm.List([{'name': 'no_args'}]), None)
+    assert 'unknown trends' in validate_scf_ladder(orm.List([{'args': {}, 'trends': ['oscillating']}]), None)
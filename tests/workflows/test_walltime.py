@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=redefined-outer-name
+"""Tests for the extrapolation of the cost of the remaining ionic steps of a relaxation."""
+from aiida import orm
+import numpy
+import pytest
+
+from aiida_ase.workflows.walltime import estimate_remaining_steps, fit_resources, get_step_time
+
+
+@pytest.fixture
+def optimizer_log():
+    """Return an ``optimizer_log`` with three steps, of which the last two took 6 and 5 seconds."""
+    array_data = orm.ArrayData()
+    array_data.set_array('times', numpy.array([0., 6., 11.]))
+    array_data.set_array('fmax', numpy.array([0.2415, 0.0873, 0.0312]))
+    return array_data
+
+
+def test_get_step_time(optimizer_log):
+    """Test the sources of the duration of the ionic steps in their order of preference."""
+    timings = {'phases': {'imports': 1.0, 'setup': 2.0}, 'steps': [20.0, 6.0, 5.0]}
+    walltime = {'elapsed': 30.0, 'steps': 2, 'step_time': 6.0}
+
+    assert get_step_time(optimizer_log, timings, walltime) == (5.5, 23.0)
+    assert get_step_time(optimizer_log, None, walltime) == (5.5, 19.0)
+    assert get_step_time(optimizer_log) == (5.5, 5.5)
+    assert get_step_time(None, {'steps': [20.0]}, walltime) == (10.0, 10.0)
+    assert get_step_time(None, None, None) is None
+
+
+def test_estimate_remaining_steps():
+    """Test the extrapolation of the number of steps from the decrease of the maximum force."""
+    fmax = 10**(-0.25 * numpy.arange(5))
+
+    # the log10 of the maximum force decreases from -1 by 0.25 per step, to reach log10(0.012) = -1.92 in 3.7 steps
+    assert estimate_remaining_steps(fmax, 0.012) == 4
+    assert estimate_remaining_steps(fmax, 0.012, max_steps=3) == 3
+
+    # a maximum force that does not decrease needs as many steps as were done, or the maximum of the optimizer
+    assert estimate_remaining_steps(fmax[::-1], 0.012) == 5
+    assert estimate_remaining_steps(fmax[::-1], 0.012, max_steps=100) == 100
+    assert estimate_remaining_steps([], 0.05) == 1
+
+
+@pytest.mark.parametrize(('cost', 'margin', 'max_machines', 'expected'), (
+    ((10, 100, 50), 0, None, (720, 1, True)),
+    ((10, 100, 50), 300, None, (1020, 1, True)),
+    ((1, 10, 5), 0, None, (600, 1, True)),
+    ((100, 100, 100), 0, None, (3600, 1, False)),
+    ((100, 100, 100), 0, 8, (3120, 4, True)),
+    ((100, 100, 100), 0, 2, (3600, 2, False)),
+))
+def test_fit_resources(cost, margin, max_machines, expected):
+    """Test the walltime and the number of machines in which the remaining steps fit within one hour."""
+    assert fit_resources(cost, 1, 3600, max_machines=max_machines, margin=margin) == expected